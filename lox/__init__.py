@@ -9,8 +9,12 @@ Lox is a distributed locking library for Python, with schmear.
 
 Currently supported backends:
 
-1. Redis
+1. Redis, on one node or a quorum of them
 2. PostgreSQL
+3. In-memory, for threads of one process
+4. Lock files, for processes on one host
+
+Keys can also be sharded over several of these.
 
 Redis on localhost with default port & db is the default backend.
 
@@ -33,6 +37,8 @@ __license__ = "MIT"
 
 
 from .lox import Lox
-from .core.lock import Lock
+from .core.lock import Lock, MODE_EXCLUSIVE, MODE_SHARED
+from .core.semaphore import Semaphore
+from .core.metrics import LoxObserver, HistogramCollector
 from .core.errors import *
 from .core.states import *
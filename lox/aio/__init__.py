@@ -0,0 +1,13 @@
+"""
+asyncio API for lox (python 3 only).
+
+    >>> from lox.aio import AsyncLox
+    >>> async with AsyncLox() as lox:
+    ...     await do_something_with_race_conditions()
+
+Same configuration, lock keys, states and retry options as Lox, over async clients:
+redis.asyncio (redis>=4.2) for Redis and asyncpg for PostgreSQL.
+"""
+
+from .lox import AsyncLox
+from .lock import AsyncLock
@@ -0,0 +1,64 @@
+import asyncio
+
+from lox.backends.base_lox_backend import BaseLoxBackend
+
+
+class AsyncBaseLoxBackend(object):
+    """
+    Base class for asyncio lox providers. Locks use the same keys as the blocking backends,
+    so blocking and asyncio code can contend for the same locks.
+    """
+
+    server_handles_expiration = True
+
+    key = staticmethod(BaseLoxBackend.key)
+
+    def __init__(self, config):
+        self.config = config
+        self.connection = None
+
+    async def wait_for_release(self, lox_name, lock_id, timeout):
+        """
+        Wait until the lock may have been released, or until timeout seconds have passed.
+        By default this just sleeps, which makes retrying a plain poll.
+        """
+        await asyncio.sleep(timeout)
+
+    async def close(self):
+        pass
+
+
+class ReleaseWaiters(object):
+    """
+    Futures waiting for release notifications, by lock key. One listener per backend
+    resolves them, so any number of waiters costs no extra connections.
+    """
+
+    def __init__(self):
+        self._waiters = {}
+
+    def add(self, key):
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(key, set()).add(future)
+        return future
+
+    def remove(self, key, future):
+        futures = self._waiters.get(key)
+        if futures is not None:
+            futures.discard(future)
+            if not futures:
+                del self._waiters[key]
+
+    def notify(self, key):
+        for future in self._waiters.pop(key, ()):
+            if not future.done():
+                future.set_result(None)
+
+    async def wait(self, key, future, timeout):
+        """ Wait for future to be resolved by notify, for at most timeout seconds. """
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.remove(key, future)
@@ -0,0 +1,159 @@
+import asyncio
+
+import asyncpg
+
+from lox.core.errors import *
+from lox.backends.base_lox_backend import BackendLock
+from lox.backends.postgres_lox_backend import (DEFAULT_POOL_MIN_CONNECTIONS, DEFAULT_POOL_MAX_CONNECTIONS,
+                                               RELEASE_CHANNEL, configured_table, table_names, table_options)
+from lox.aio.backends.base_lox_backend import AsyncBaseLoxBackend, ReleaseWaiters
+
+
+class AsyncPostgresLoxBackend(AsyncBaseLoxBackend):
+    """
+    An asyncio lox provider that uses PostgreSQL (through an asyncpg pool) as the backend lock store.
+    Uses the same lox table as PostgresLoxBackend, with the same server-side expiration, and every
+    operation is a single autocommitted statement. Waiters share one LISTEN connection.
+    Shared locks are not supported here, and acquire doesn't look for shared holders taken
+    through PostgresLoxBackend, so don't mix the two on the same keys.
+    The table settings ("postgres_schema", "postgres_table", "postgres_unlogged", "postgres_storage_parameters"
+    and "postgres_synchronous_commit") mean the same as there.
+    """
+
+    server_handles_expiration = True
+
+    def __init__(self, config):
+        super(AsyncPostgresLoxBackend, self).__init__(config)
+        self.pool = None
+        self.waiters = ReleaseWaiters()
+        self._listener = None
+        self._listener_lock = asyncio.Lock()
+        self.schema, self.table = configured_table(self.config)
+        self.tables = table_names(self.schema, self.table)
+
+    async def connect(self):
+        url = self.config["backend"]["postgres"]
+        min_connections = self.config.get("postgres_pool_min_connections", DEFAULT_POOL_MIN_CONNECTIONS)
+        max_connections = self.config.get("postgres_pool_max_connections", DEFAULT_POOL_MAX_CONNECTIONS)
+        if max_connections < 1 or min_connections > max_connections:
+            raise BackendConfigException("Postgres pool needs 1 <= min connections <= max connections.")
+        # every operation is a statement of its own, so this is set for the whole session rather than per transaction
+        server_settings = {} if self.config.get("postgres_synchronous_commit", True) else {"synchronous_commit": "off"}
+        self.pool = await asyncpg.create_pool(url, min_size=min_connections, max_size=max_connections,
+                                              server_settings=server_settings)
+        await self.ensure_schema()
+
+    async def close(self):
+        if self._listener is not None:
+            await self._listener.close()
+            self._listener = None
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    ## ------- schema ------- ##
+
+    async def ensure_schema(self):
+        """ Same checks as PostgresLoxBackend.ensure_schema, in one transaction. """
+        names = dict(table_options(self.config), schema=self.schema, table=self.table, **self.tables)
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                if not await connection.fetchval("""
+                    SELECT EXISTS (SELECT 1 FROM pg_catalog.pg_namespace WHERE nspname = $1);
+                """, self.schema):
+                    await connection.execute("""CREATE SCHEMA IF NOT EXISTS "{schema}";""".format(**names))
+                await connection.execute("""
+                    CREATE {unlogged} TABLE IF NOT EXISTS {lox} (
+                        key text NOT NULL,
+                        acquire_ts timestamp with time zone NOT NULL,
+                        expire_ts timestamp with time zone NULL,
+                        CONSTRAINT "pk_{table}" PRIMARY KEY (key)
+                    ) {storage};
+                """.format(**names))
+                try:
+                    await connection.execute("""SELECT key, acquire_ts, expire_ts FROM {lox} LIMIT 1;""".format(
+                        **names))
+                except asyncpg.UndefinedColumnError:
+                    raise SchemaConflictException("Incorrect columns for postgres table {schema}.{table}".format(
+                        **names))
+                if await connection.fetchval("""SELECT to_regclass('"{schema}"."pk_{table}"') IS NULL;""".format(
+                        **names)):
+                    await connection.execute("""ALTER TABLE {lox} ADD CONSTRAINT "pk_{table}" PRIMARY KEY (key);""".format(
+                        **names))
+                await connection.execute("""
+                    CREATE INDEX IF NOT EXISTS "ix_{table}_expire_ts" ON {lox} (expire_ts)
+                    WHERE expire_ts IS NOT NULL;
+                """.format(**names))
+
+    ## ------- acquire, release, clear ------- ##
+
+    async def acquire(self, lox_name, lock_id, expires_seconds=None, timeout=None):
+        key = self.key(lox_name, lock_id)
+        try:
+            async with self.pool.acquire(timeout=timeout) as connection:
+                row = await connection.fetchrow("""
+                   INSERT INTO {lox} AS l (key, acquire_ts, expire_ts)
+                   VALUES ($1, now(), now() + $2::double precision * interval '1 second')
+                   ON CONFLICT (key) DO UPDATE
+                   SET    acquire_ts = EXCLUDED.acquire_ts, expire_ts = EXCLUDED.expire_ts
+                   WHERE  l.expire_ts <= EXCLUDED.acquire_ts
+                   RETURNING acquire_ts, expire_ts;
+                """.format(**self.tables), key, expires_seconds, timeout=timeout)
+        except asyncio.TimeoutError:
+            raise LockTimeoutException("Timed out acquiring lock {}, it is probably being acquired "
+                                       "by another thread/process.".format(key))
+        if row is None:
+            raise LockInUseException("Lock {} has been acquired previously, possibly by another thread/process, "
+                                     "and is not available.".format(key))
+        return BackendLock(key, lox_name, lock_id, acquire_ts=row["acquire_ts"], expire_ts=row["expire_ts"])
+
+    async def release(self, lock):
+        async with self.pool.acquire() as connection:
+            if self.config.get("wait_for_release", False):
+                # one statement, and only announces a release if the row was still ours
+                await connection.execute("""
+                   WITH released AS (
+                       DELETE FROM {lox}
+                       WHERE key = $1 and acquire_ts = $2
+                       RETURNING key
+                   )
+                   SELECT pg_notify($3, key) FROM released;
+                """.format(**self.tables), lock.key, lock.acquire_ts, RELEASE_CHANNEL)
+            else:
+                await connection.execute("""
+                   DELETE FROM {lox}
+                   WHERE key = $1 and acquire_ts = $2;
+                """.format(**self.tables), lock.key, lock.acquire_ts)
+
+    async def clear(self, lox_name, lock_id):
+        async with self.pool.acquire() as connection:
+            await connection.execute("""DELETE FROM {lox} WHERE key = $1;""".format(**self.tables), self.key(lox_name, lock_id))
+
+    ## ------- release notifications ------- ##
+
+    async def wait_for_release(self, lox_name, lock_id, timeout):
+        key = self.key(lox_name, lock_id)
+        await self.__ensure_listener()
+        future = self.waiters.add(key)
+        # it may have been released between the failed acquire and the LISTEN
+        async with self.pool.acquire() as connection:
+            held = await connection.fetchval("""
+                SELECT EXISTS (
+                    SELECT 1 FROM {lox}
+                    WHERE key = $1 AND (expire_ts IS NULL OR expire_ts > now())
+                );
+            """.format(**self.tables), key)
+        if not held:
+            self.waiters.remove(key, future)
+            return
+        await self.waiters.wait(key, future, timeout)
+
+    async def __ensure_listener(self):
+        async with self._listener_lock:
+            if self._listener is not None and not self._listener.is_closed():
+                return
+            self._listener = await asyncpg.connect(self.config["backend"]["postgres"])
+            await self._listener.add_listener(RELEASE_CHANNEL, self.__on_notify)
+
+    def __on_notify(self, connection, pid, channel, payload):
+        self.waiters.notify(payload)
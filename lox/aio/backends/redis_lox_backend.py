@@ -0,0 +1,93 @@
+import asyncio
+
+from redis import asyncio as aioredis
+
+from lox.core.errors import *
+from lox.core.ids import new_id
+from lox.backends.base_lox_backend import BackendLock, DEFAULT_WRITER_PREFERENCE_SECONDS
+from lox.backends.redis_lox_backend import RELEASE_CHANNEL_PREFIX
+from lox.backends import redis_scripts
+from lox.aio.backends.base_lox_backend import AsyncBaseLoxBackend, ReleaseWaiters
+
+
+async def aclose(client):
+    """ Close a redis client or pubsub: with aclose from redis 5 on, which deprecates close, and close before that. """
+    close = getattr(client, "aclose", None) or client.close
+    await close()
+
+
+class AsyncRedisLoxBackend(AsyncBaseLoxBackend):
+    """
+    An asyncio lox provider that uses Redis as the backend lock store. Each lock key holds
+    its owner's token with a TTL, set by the same script RedisLoxBackend uses (so shared holders
+    taken through it are respected), and is released by a compare-and-delete script.
+    Waiters share one pattern subscription to the release channels.
+    """
+
+    server_handles_expiration = True
+
+    def __init__(self, config):
+        super(AsyncRedisLoxBackend, self).__init__(config)
+        self.waiters = ReleaseWaiters()
+        self._pubsub = None
+        self._listener = None
+        self._listener_lock = asyncio.Lock()
+
+    async def connect(self):
+        url = self.config["backend"]["redis"]
+        socket_timeout = self.config.get("redis_socket_timeout")
+        self.connection = aioredis.StrictRedis.from_url(url, socket_timeout=socket_timeout,
+                                                        socket_connect_timeout=socket_timeout)
+        self.acquire_many_script = self.connection.register_script(redis_scripts.ACQUIRE_MANY)
+        self.release_many_script = self.connection.register_script(redis_scripts.RELEASE_MANY)
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        if self._pubsub is not None:
+            await aclose(self._pubsub)
+            self._pubsub = None
+        await aclose(self.connection)
+
+    async def acquire(self, lox_name, lock_id, expires_seconds=None, timeout=None):
+        key = self.key(lox_name, lock_id)
+        token = new_id()
+        px = max(int(expires_seconds * 1000), 1) if expires_seconds else 0
+        preference = int(self.config.get("writer_preference_seconds", DEFAULT_WRITER_PREFERENCE_SECONDS) * 1000)
+        if await self.acquire_many_script(keys=[key], args=[token, px, preference]):
+            raise LockInUseException("Lock {} has been acquired previously, possibly by another thread/process, "
+                                     "and is not available.".format(key))
+        return BackendLock(key, lox_name, lock_id, provider_lock=token)
+
+    async def release(self, lock):
+        channel_prefix = RELEASE_CHANNEL_PREFIX if self.config.get("wait_for_release", False) else ""
+        await self.release_many_script(keys=[lock.key], args=[channel_prefix, lock.provider_lock])
+
+    async def clear(self, lox_name, lock_id):
+        await self.connection.delete(self.key(lox_name, lock_id))
+
+    async def wait_for_release(self, lox_name, lock_id, timeout):
+        key = self.key(lox_name, lock_id)
+        await self.__ensure_listener()
+        future = self.waiters.add(key)
+        # it may have been released between the failed acquire and now
+        if not await self.connection.exists(key):
+            self.waiters.remove(key, future)
+            return
+        await self.waiters.wait(key, future, timeout)
+
+    async def __ensure_listener(self):
+        async with self._listener_lock:
+            if self._listener is not None and not self._listener.done():
+                return
+            if self._pubsub is None:
+                self._pubsub = self.connection.pubsub(ignore_subscribe_messages=True)
+                await self._pubsub.psubscribe(RELEASE_CHANNEL_PREFIX + "*")
+            self._listener = asyncio.ensure_future(self.__listen())
+
+    async def __listen(self):
+        # if this dies, waiters still wake up at their poll interval, and the next wait restarts it
+        async for message in self._pubsub.listen():
+            if message["type"] == "pmessage":
+                self.waiters.notify(message["channel"].decode("utf-8")[len(RELEASE_CHANNEL_PREFIX):])
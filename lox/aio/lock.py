@@ -0,0 +1,110 @@
+import asyncio
+
+from lox.core.states import *
+from lox.core.errors import *
+from lox.core.lock import Lock
+from lox.core.retry import Retrier, get_retry_policy
+
+
+class AsyncLock(object):
+    """
+    asyncio counterpart of Lock: same states and retry options, but waiting between tries
+    happens on the event loop, so any number of pending acquires costs no threads.
+    """
+
+    def __init__(self, parent, id=None):
+        # immediately set state
+        self.state = STATE_INIT
+        # parent AsyncLox wrapper class
+        self.parent = parent
+        self.backend = parent.backend
+        self.lox_name = parent.name
+        self.config = parent.config
+        self.id = id or Lock.generate_id()
+        # this will hold the lock object from the backend
+        self._lock = None
+        # default to not auto-expire
+        self.expires_seconds = None
+
+    @property
+    def key(self):
+        if self._lock:
+            return self._lock.key
+
+    async def acquire(self, expires_seconds=None, retry=False, num_tries=None, retry_interval_seconds=None,
+                      wait_for_release=None, timeout=None):
+        """
+        Acquire a lock, with optional retry logic. See Lox.acquire for param details.
+        """
+        if self.state not in OK_TO_ACQUIRE:
+            raise UnexpectedStateException("Unable to acquire lock {} because state is {}".format(self.id, self.state))
+        if timeout is not None and timeout < 0:
+            raise ValueError("Param 'timeout' must be None, or at least 0")
+        if expires_seconds == 0:
+            raise ValueError("Param 'expires_seconds' must be None, or greater than 0")
+        if expires_seconds and not self.backend.server_handles_expiration:
+            raise BackendConfigException("Backend {} can't expire locks".format(type(self.backend).__name__))
+
+        self.state = STATE_ACQUIRING
+
+        if timeout is not None:
+            retry = True
+        if not retry:
+            num_tries = 1
+        if not num_tries and timeout is None:
+            num_tries = self.config.get("num_tries", 3)
+        if retry_interval_seconds is None:
+            retry_interval_seconds = self.config.get("retry_interval_seconds", 1)
+        if wait_for_release is None:
+            wait_for_release = self.config.get("wait_for_release", False)
+
+        retrier = Retrier(get_retry_policy(self.config, retry_interval_seconds), num_tries=num_tries, timeout=timeout)
+        while True:
+            try:
+                self._lock = await self.backend.acquire(self.lox_name, self.id, expires_seconds=expires_seconds,
+                                                        timeout=retrier.remaining())
+            except LockInUseException:
+                if not retry:
+                    self.state = STATE_ACQUIRING_EXCEPTION
+                    raise LockInUseException("Could not acquire lock {} because it is in use. "
+                                             "Not retrying.".format(self.id))
+                delay = retrier.next_delay()
+                if delay is None:
+                    break
+                self.state = STATE_ACQUIRING_RETRYING
+                if delay and wait_for_release:
+                    await self.backend.wait_for_release(self.lox_name, self.id, delay)
+                elif delay:
+                    await asyncio.sleep(delay)
+            else:
+                self.expires_seconds = expires_seconds
+                self.state = STATE_ACQUIRED
+                break
+
+        if self.state != STATE_ACQUIRED:
+            self.state = STATE_ACQUIRING_TIMEDOUT
+            if retrier.timed_out:
+                raise LockTimeoutException("Could not acquire lock {} because it is in use after "
+                                           "{} seconds".format(self.id, timeout))
+            raise LockInUseException("Could not acquire lock {} because it is in use after "
+                                     "{} attempts".format(self.id, retrier.tries))
+
+        return self
+
+    async def release(self):
+        """
+        Explicitly release a lock.
+        """
+        if self.state not in OK_TO_RELEASE or not self._lock:
+            raise UnexpectedStateException("Unable to release lock {} because state is {}".format(self.id, self.state))
+
+        self.state = STATE_RELEASING
+        await self.backend.release(self._lock)
+        self.state = STATE_RELEASED
+        return self
+
+    async def clear(self):
+        """
+        Delete a lock without releasing it (meant as a cleanup / admin / testing function).
+        """
+        await self.backend.clear(self.lox_name, self.id)
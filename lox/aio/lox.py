@@ -0,0 +1,100 @@
+import asyncio
+
+from lox.core.errors import *
+from lox.lox import DEFAULT_LOX_CONFIG
+from lox.aio.lock import AsyncLock
+
+
+class AsyncLox(object):
+    """
+    asyncio API for distributed locking, with schmear. Mirrors Lox, but every call that talks to
+    the backend is a coroutine, and the backend connects on first use (or on await connect()).
+    """
+    def __init__(self, name=None, config=None):
+        self.name = name or "Lox"
+        if not config:
+            self.config = DEFAULT_LOX_CONFIG
+        else:
+            self.config = config
+        # will hold a list of locks we're managing here
+        self.locks = {}
+        # will hold the lock when used as a context manager
+        self.context_lock = None
+        self.backend = None
+        self._connecting = asyncio.Lock()
+
+    async def connect(self):
+        async with self._connecting:
+            if self.backend is not None:
+                return
+            # the async clients are optional dependencies, so only import the one that's configured
+            if "redis" in self.config.get("backend"):
+                from lox.aio.backends.redis_lox_backend import AsyncRedisLoxBackend
+                backend = AsyncRedisLoxBackend(self.config)
+            elif "postgres" in self.config.get("backend"):
+                if self.config.get("postgres_mode", "table") != "table":
+                    raise BackendConfigException("Only the postgres table mode is supported with asyncio.")
+                from lox.aio.backends.postgres_lox_backend import AsyncPostgresLoxBackend
+                backend = AsyncPostgresLoxBackend(self.config)
+            else:
+                raise BackendConfigException("No backend specified in settings.")
+            await backend.connect()
+            self.backend = backend
+
+    async def close(self):
+        if self.backend is not None:
+            await self.backend.close()
+            self.backend = None
+
+    async def acquire(self, id=None, expires_seconds=None, retry=False, num_tries=None, retry_interval_seconds=None,
+                      wait_for_release=None, timeout=None):
+        """
+        Get a lock with the given ID. See Lox.acquire for param details.
+        :return: the acquired AsyncLock object
+        """
+        if id and id in self.locks:
+            raise LockAlreadyAcquiredException("Lock %s cannot be acquired more than once." % id)
+        await self.connect()
+        lock = AsyncLock(self, id)
+        self.locks[lock.id] = lock
+        try:
+            return await lock.acquire(expires_seconds=expires_seconds,
+                                      retry=retry,
+                                      num_tries=num_tries,
+                                      retry_interval_seconds=retry_interval_seconds,
+                                      wait_for_release=wait_for_release,
+                                      timeout=timeout)
+        except BaseException:
+            # includes being cancelled while waiting
+            self.locks.pop(lock.id, None)
+            raise
+
+    async def release(self, id=None):
+        """
+        Release the lock with the given ID.
+        :return: the released lock object
+        """
+        if not self.locks:
+            raise LockNotFoundException("No locks to release")
+        # free it from the instance level tracking
+        lock = self.locks.pop(id, None)
+        if lock is None:
+            raise LockNotFoundException("Lock %s not found" % id)
+        return await lock.release()
+
+    async def clear_all(self):
+        """
+        Purge all locks from the backend without releasing them.
+        Should only be used for admin, testing, etc.
+        """
+        for id, lock in list(self.locks.items()):
+            await lock.clear()
+        self.locks = {}
+
+    async def __aenter__(self):
+        self.context_lock = await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.context_lock.release()
+        return False
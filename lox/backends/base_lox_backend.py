@@ -1,30 +1,175 @@
 from __future__ import unicode_literals
 
+from datetime import datetime
+import time
+
+import pytz
+
+# how long an exclusive acquire that found shared holders keeps new shared acquires out
+DEFAULT_WRITER_PREFERENCE_SECONDS = 2
+
 
 class BaseLoxBackend(object):
     """
     Base class for lox providers.
     """
+
+    # if not, Lock sets up client-side timers to expire locks
+    server_handles_expiration = False
+
     def __init__(self, config):
         self.config = config
         self.connection = None
+        # backends are shared, so one that was closed has to be replaced rather than reused
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def abandon(self):
+        """
+        Give up the backend in a child process forked after it connected, without closing anything:
+        its connections belong to the parent, which is still using them. Backends whose clients
+        would close them when garbage collected keep them referenced for good instead.
+        """
+        self.closed = True
 
     @staticmethod
     def key(lox_name, lock_id):
         return "{}_{}".format(lox_name, lock_id)
 
+    def local_key(self, lox_name, lock_id):
+        """
+        Identifies the lock within this process, for local coordination: the same key on the same
+        configured backend is the same lock, whichever Lox or backend instance it goes through.
+        """
+        return type(self).__name__, repr(sorted(self.config["backend"].items())), self.key(lox_name, lock_id)
+
+    def acquire_many(self, lox_name, lock_ids, expires_seconds=None, timeout=None):
+        """
+        Acquire all of lock_ids or none of them, returning BackendLocks in the same order.
+        Backends that can do this in one round trip override it; by default the locks are taken
+        one at a time, and the ones already taken are released if a later one is in use.
+        """
+        kwargs = {"expires_seconds": expires_seconds}
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        locks = []
+        try:
+            for lock_id in lock_ids:
+                locks.append(self.acquire(lox_name, lock_id, **kwargs))
+        except BaseException:
+            for lock in reversed(locks):
+                self.release(lock)
+            raise
+        return locks
+
+    def acquire_shared(self, lox_name, lock_id, expires_seconds=None, timeout=None, permits=None):
+        """
+        Acquire lock_id in shared mode: any number of shared holders at once, but never alongside
+        an exclusive holder (which is what acquire takes). Returns a BackendLock with shared set,
+        which release, release_many and extend_many tell apart from exclusive ones.
+        With permits, this is a semaphore permit: it is only granted while there are fewer than
+        that many shared holders. Backends that support reader-writer locks override this,
+        and raise NotImplementedError for permits if they can't count holders.
+        """
+        raise NotImplementedError("{} doesn't support shared locks".format(type(self).__name__))
+
+    def acquire_fair(self, lox_name, lock_id, ticket, ticket_seconds, expires_seconds=None, timeout=None):
+        """
+        One attempt at lock_id in turn: join its line of waiters with ticket (or keep our place in it for
+        ticket_seconds more), and take the lock only if it is free and ticket is at the head of the line,
+        leaving the line then. Otherwise raise LockInUseException, with the ticket still in line.
+        Tickets that aren't renewed in time are dropped, so waiters that went away don't hold up the rest.
+        Backends that support fair locks override this, along with leave_queue, and have their releases
+        wake up the waiter at the head of the line (see wait_for_release's ticket).
+        """
+        raise NotImplementedError("{} doesn't support fair locks".format(type(self).__name__))
+
+    def leave_queue(self, lox_name, lock_id, ticket):
+        """ Give up a place in lock_id's line, waking up whoever is at its head now. """
+        raise NotImplementedError("{} doesn't support fair locks".format(type(self).__name__))
+
+    @property
+    def writer_preference_seconds(self):
+        """
+        When an exclusive acquire finds the lock shared, it keeps new shared acquires out for this long,
+        so that a steady stream of readers can't starve it. Set with the "writer_preference_seconds"
+        config setting; 0 turns writer preference off.
+        """
+        return self.config.get("writer_preference_seconds", DEFAULT_WRITER_PREFERENCE_SECONDS)
+
+    def release_many(self, locks):
+        """ Release a group of BackendLocks, by default one at a time. """
+        for lock in locks:
+            self.release(lock)
+
+    def extend_many(self, locks, expires_seconds):
+        """
+        Renew a group of BackendLocks, each to expire its own number of seconds (a parallel list) from now,
+        in one round trip. Returns the locks that turned out to be lost already.
+        Backends whose locks are expired by the client just have nothing to do on the server.
+        """
+        if self.server_handles_expiration:
+            raise NotImplementedError("{} can't extend locks".format(type(self).__name__))
+        return []
+
+    def wait_for_release(self, lox_name, lock_id, timeout, shared=False, permits=None, ticket=None):
+        """
+        Block until the lock may have been released, or until timeout seconds have passed.
+        With shared, the caller wants a shared lock, so only an exclusive holder (or waiting writer) is in its way,
+        and with permits too, as many shared holders as that.
+        With ticket, the caller waits in line for a fair lock, and is only woken up once it is at the head.
+        Backends that can be notified of releases override this; by default it just sleeps,
+        which makes retrying a plain poll.
+        """
+        time.sleep(timeout)
+
 
 class BackendLock(object):
     """
-    Simple object to hold implementation-specific backend lock details
+    Simple object to hold implementation-specific backend lock details.
+    Kept small, since a process may hold a great many: the key is only built when first asked for,
+    if the backend didn't pass one, and backends whose timestamps come from the client's clock pass
+    time.time() floats, only turned into datetimes if somebody reads acquire_ts or expire_ts.
     """
-    def __init__(self, key, lox_name, lock_id, acquire_ts=None, expire_ts=None, provider_lock=None):
+    __slots__ = ("lox_name", "lock_id", "_key", "_acquire_ts", "_expire_ts", "provider_lock", "shared")
+
+    def __init__(self, key, lox_name, lock_id, acquire_ts=None, expire_ts=None, provider_lock=None, shared=False):
         self.lox_name = lox_name
         self.lock_id = lock_id
-        self.key = key or BaseLoxBackend.key(lox_name, lock_id)
+        self._key = key
 
-        self.acquire_ts = acquire_ts
-        self.expire_ts = expire_ts
+        self._acquire_ts = acquire_ts
+        self._expire_ts = expire_ts
 
         self.provider_lock = provider_lock
+        # taken with acquire_shared
+        self.shared = shared
+
+    @property
+    def key(self):
+        if not self._key:
+            self._key = BaseLoxBackend.key(self.lox_name, self.lock_id)
+        return self._key
+
+    @property
+    def acquire_ts(self):
+        if isinstance(self._acquire_ts, float):
+            self._acquire_ts = datetime.fromtimestamp(self._acquire_ts, pytz.UTC)
+        return self._acquire_ts
+
+    @acquire_ts.setter
+    def acquire_ts(self, value):
+        self._acquire_ts = value
+
+    @property
+    def expire_ts(self):
+        if isinstance(self._expire_ts, float):
+            self._expire_ts = datetime.fromtimestamp(self._expire_ts, pytz.UTC)
+        return self._expire_ts
+
+    @expire_ts.setter
+    def expire_ts(self, value):
+        self._expire_ts = value
 
@@ -0,0 +1,103 @@
+from __future__ import unicode_literals
+
+import threading
+
+from lox.core.errors import *
+from lox.core.fork import at_fork_in_child, check_pid
+
+
+def create_backend(config):
+    """
+    Instantiate (without connecting) the backend that config["backend"] names.
+    """
+    # imported here, since some backends are built out of others
+    from lox.backends.redis_lox_backend import RedisLoxBackend
+    from lox.backends.redlock_lox_backend import RedlockLoxBackend
+    from lox.backends.postgres_lox_backend import PostgresLoxBackend
+    from lox.backends.postgres_advisory_lox_backend import PostgresAdvisoryLoxBackend
+    from lox.backends.sharded_lox_backend import ShardedLoxBackend
+    from lox.backends.memory_lox_backend import MemoryLoxBackend
+    from lox.backends.file_lox_backend import FileLoxBackend
+
+    backend = config.get("backend") or {}
+    if "redis" in backend:
+        return RedisLoxBackend(config)
+    elif "redis_quorum" in backend:
+        return RedlockLoxBackend(config)
+    elif "postgres" in backend:
+        if config.get("postgres_mode") == "advisory":
+            return PostgresAdvisoryLoxBackend(config)
+        return PostgresLoxBackend(config)
+    elif "sharded" in backend:
+        return ShardedLoxBackend(config)
+    elif "memory" in backend:
+        return MemoryLoxBackend(config)
+    elif "file" in backend:
+        return FileLoxBackend(config)
+    raise BackendConfigException("No backend specified in settings.")
+
+
+_backends = {}
+# how many times each of them was got, and not given back with release_backend since
+_holders = {}
+# reentrant, since a backend may get the backends it is built out of while connecting
+_backends_lock = threading.RLock()
+
+
+def get_backend(config):
+    """
+    The process-wide backend for config, created and connected on first use.
+    Every Lox with the same settings shares it, and with it its clients and connection pool.
+    Callers that are done with it, like a sharded backend closing, give it back with release_backend.
+    """
+    check_pid()
+    key = _freeze(config)
+    with _backends_lock:
+        backend = _backends.get(key)
+        if backend is None or backend.closed:
+            backend = create_backend(config)
+            backend.connect()
+            _backends[key] = backend
+            _holders[key] = 0
+        _holders[key] += 1
+        return backend
+
+
+def release_backend(config):
+    """
+    Give back a backend got with get_backend(config), closing it once nobody else has it:
+    not the other callers that got it, like every Lox with the same settings, which never give theirs back.
+    """
+    key = _freeze(config)
+    with _backends_lock:
+        if key not in _backends:
+            return
+        _holders[key] -= 1
+        if _holders[key] <= 0:
+            del _holders[key]
+            _backends.pop(key).close()
+
+
+def _abandon_backends():
+    """
+    In a forked child, the backends are the parent's, and so are their connections: abandon them,
+    and have every Lox connect a backend of its own when it next needs one.
+    """
+    global _backends_lock
+    for backend in list(_backends.values()):
+        backend.abandon()
+    _backends.clear()
+    _holders.clear()
+    _backends_lock = threading.RLock()
+
+
+at_fork_in_child(_abandon_backends)
+
+
+def _freeze(value):
+    """ A hashable copy of a config value, the same for equal configs. """
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
@@ -0,0 +1,93 @@
+from __future__ import unicode_literals
+
+import errno
+import hashlib
+import os
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
+
+from lox.core.errors import *
+from lox.backends.base_lox_backend import BaseLoxBackend, BackendLock
+
+# keys longer than this are hashed, to keep file names within file system limits
+MAX_FILE_NAME_KEY_LENGTH = 200
+LOCKED_ERRNOS = {errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK}
+
+
+class FileLoxBackend(BaseLoxBackend):
+    """
+    A lox provider for processes (and threads) on one host: each key is an flock on a file in a
+    shared directory, so there are no round trips at all. Configure with {"backend": {"file": directory}}.
+    The kernel releases a lock as soon as its holder's process dies, so nothing is ever left stale;
+    expires_seconds is handled by the client, as for the advisory Postgres backend.
+    Lock files are left in place after release, since deleting them would race with other acquirers.
+    Shared locks are shared flocks; flock has no notion of a waiting writer, so there is no writer preference.
+    There is no way to tell whether a file is flocked without taking the flock, which would make a concurrent
+    acquire fail for nothing, so wait_for_release just sleeps and retrying is a plain poll.
+    """
+
+    server_handles_expiration = False
+
+    def connect(self):
+        if fcntl is None:
+            raise BackendConfigException("The file backend needs fcntl, which this platform doesn't have.")
+        self.directory = self.config["backend"]["file"]
+        try:
+            os.makedirs(self.directory)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+
+    def path(self, key):
+        if len(key) > MAX_FILE_NAME_KEY_LENGTH or os.sep in key or key.startswith("."):
+            key = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, "{}.lock".format(key))
+
+    def acquire(self, lox_name, lock_id, expires_seconds=None, timeout=None):
+        return self.__flock(lox_name, lock_id, shared=False)
+
+    def acquire_shared(self, lox_name, lock_id, expires_seconds=None, timeout=None, permits=None):
+        if permits:
+            raise NotImplementedError("flock can't count holders, so the file backend has no semaphores")
+        return self.__flock(lox_name, lock_id, shared=True)
+
+    def __flock(self, lox_name, lock_id, shared):
+        key = self.key(lox_name, lock_id)
+        path = self.path(key)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+            # it may have been cleared (unlinked) between our open and flock, which makes ours a dead file
+            if os.fstat(fd).st_ino != os.stat(path).st_ino:
+                raise LockInUseException("Lock {} was cleared while we were acquiring it.".format(key))
+        except (IOError, OSError) as ex:
+            os.close(fd)
+            if ex.errno in LOCKED_ERRNOS or ex.errno == errno.ENOENT:
+                raise LockInUseException("Lock {} has been acquired previously, possibly by another "
+                                         "thread/process, and is not available.".format(key))
+            raise
+        except BaseException:
+            os.close(fd)
+            raise
+        return BackendLock(key, lox_name, lock_id, provider_lock=fd, shared=shared)
+
+    def release(self, lock):
+        fd, lock.provider_lock = lock.provider_lock, None
+        # never touch a descriptor twice: its number may belong to another file by now
+        if fd is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+
+    def clear(self, lox_name, lock_id):
+        """ Delete the lock file; whoever holds it keeps a lock on a file nobody else will open. """
+        try:
+            os.unlink(self.path(self.key(lox_name, lock_id)))
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
@@ -0,0 +1,64 @@
+from __future__ import unicode_literals
+
+import bisect
+import hashlib
+import struct
+
+# points on the ring per unit of weight; more of them spread keys more evenly
+DEFAULT_REPLICAS = 128
+
+
+class HashRing(object):
+    """
+    Consistent hash ring: every node owns the arcs that end at its points, and a key belongs
+    to the node owning the first point at or after the key's hash. A node gets points in
+    proportion to its weight, and adding or removing a node only moves the keys on its own arcs.
+    Nodes are identified by name, which should stay the same across restarts (e.g. a URL),
+    since that is what places them on the ring.
+    """
+
+    def __init__(self, replicas=DEFAULT_REPLICAS):
+        self.replicas = replicas
+        # sorted point hashes, and the node name at each of them
+        self._points = []
+        self._names = []
+        self.nodes = {}
+
+    @staticmethod
+    def hash(value):
+        return struct.unpack(">Q", hashlib.md5(value.encode("utf-8")).digest()[:8])[0]
+
+    def add(self, name, node=None, weight=1):
+        """ Put node on the ring under name, with weight times the default number of points. """
+        if name in self.nodes:
+            raise ValueError("Node {} is already on the ring".format(name))
+        if weight <= 0:
+            raise ValueError("Param 'weight' must be greater than 0")
+        self.nodes[name] = node if node is not None else name
+        for i in range(max(int(self.replicas * weight), 1)):
+            point = self.hash("{}#{}".format(name, i))
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._names.insert(index, name)
+
+    def remove(self, name):
+        del self.nodes[name]
+        kept = [(point, owner) for point, owner in zip(self._points, self._names) if owner != name]
+        self._points = [point for point, owner in kept]
+        self._names = [owner for point, owner in kept]
+
+    def get_name(self, key):
+        if not self._points:
+            raise LookupError("The ring is empty")
+        index = bisect.bisect_left(self._points, self.hash(key))
+        if index == len(self._points):
+            # wrap around
+            index = 0
+        return self._names[index]
+
+    def get(self, key):
+        """ The node that key belongs to. """
+        return self.nodes[self.get_name(key)]
+
+    def __len__(self):
+        return len(self.nodes)
@@ -0,0 +1,248 @@
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import itertools
+import threading
+
+from lox.core.errors import *
+from lox.core.fork import at_fork_in_child
+from lox.core.retry import monotonic
+from lox.backends.base_lox_backend import BaseLoxBackend, BackendLock
+
+
+class MemoryStore(object):
+    """
+    The locks of one in-memory namespace: key -> (owner token, monotonic expiration or None) for
+    exclusive holders, key -> {token: expiration} for shared ones, key -> expiration for writers
+    waiting on shared holders, and key -> ordered {ticket: expiration} for the line of a fair lock.
+    All guarded by a condition that is notified whenever a key is let go.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.held = {}
+        self.shared = {}
+        self.writers_waiting = {}
+        self.queues = {}
+        self.tokens = itertools.count(1)
+
+    def in_use(self, key, now):
+        entry = self.held.get(key)
+        return entry is not None and (entry[1] is None or entry[1] > now)
+
+    def shared_count(self, key, now):
+        """ How many live shared holders key has, forgetting the expired ones. """
+        holders = self.shared.get(key)
+        if not holders:
+            return 0
+        for token, expire_at in list(holders.items()):
+            if expire_at is not None and expire_at <= now:
+                del holders[token]
+        if not holders:
+            del self.shared[key]
+        return len(holders)
+
+    def shared_in_use(self, key, now):
+        return self.shared_count(key, now) > 0
+
+    def writer_waiting(self, key, now):
+        expire_at = self.writers_waiting.get(key)
+        return expire_at is not None and expire_at > now
+
+    def blocked(self, key, now, shared, permits=None):
+        """ Whether a shared (or else an exclusive) acquire of key, for one of permits if given, would find it in use. """
+        if shared:
+            return (self.in_use(key, now) or self.writer_waiting(key, now) or
+                    bool(permits) and self.shared_count(key, now) >= permits)
+        return self.in_use(key, now) or self.shared_in_use(key, now)
+
+    def queue_head(self, key, now):
+        """ The ticket at the head of key's line, dropping expired ones off the front, or None. """
+        queue = self.queues.get(key)
+        while queue:
+            ticket, expire_at = next(iter(queue.items()))
+            if expire_at > now:
+                return ticket
+            del queue[ticket]
+        self.queues.pop(key, None)
+        return None
+
+    def next_expiration(self, key, now):
+        """ The earliest time after now that something in key's way goes away on its own, or None. """
+        expirations = list(self.shared.get(key, {}).values()) + list(self.queues.get(key, {}).values())
+        expirations += [self.held.get(key, (None, None))[1], self.writers_waiting.get(key)]
+        expirations = [expire_at for expire_at in expirations if expire_at is not None and expire_at > now]
+        return min(expirations) if expirations else None
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(name):
+    """ The process-wide store for a namespace, created on first use. """
+    with _stores_lock:
+        store = _stores.get(name)
+        if store is None:
+            store = _stores[name] = MemoryStore()
+        return store
+
+
+def _reset_after_fork():
+    # a forked child is a process of its own, with locks of its own: the parent's holders aren't in it
+    global _stores, _stores_lock
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+
+at_fork_in_child(_reset_after_fork)
+
+
+class MemoryLoxBackend(BaseLoxBackend):
+    """
+    A lox provider that keeps locks in this process's memory, for threads of one process:
+    no round trips, so locking takes microseconds. Also handy for tests and benchmarks.
+    Configure with {"backend": {"memory": namespace}}; every Lox using the same namespace
+    sees the same locks. Expiration works like it does in Postgres: an expired lock is simply
+    taken over by the next acquire, and waiters are woken up as soon as a lock is released.
+    Shared locks are supported, with writer preference, and so are fair locks.
+    """
+
+    server_handles_expiration = True
+
+    def connect(self):
+        self.store = get_store(self.config["backend"]["memory"])
+
+    def acquire(self, lox_name, lock_id, expires_seconds=None, timeout=None):
+        return self.acquire_many(lox_name, [lock_id], expires_seconds=expires_seconds)[0]
+
+    def acquire_many(self, lox_name, lock_ids, expires_seconds=None, timeout=None):
+        keys = [self.key(lox_name, lock_id) for lock_id in lock_ids]
+        store = self.store
+        with store.condition:
+            now = monotonic()
+            for key in keys:
+                if store.in_use(key, now):
+                    raise LockInUseException("Lock {} has been acquired previously, possibly by another thread, "
+                                             "and is not available.".format(key))
+                if store.shared_in_use(key, now):
+                    if self.writer_preference_seconds:
+                        store.writers_waiting[key] = now + self.writer_preference_seconds
+                    raise LockInUseException("Lock {} is shared by other threads, "
+                                             "and is not available.".format(key))
+            token = next(store.tokens)
+            entry = token, now + expires_seconds if expires_seconds else None
+            for key in keys:
+                store.held[key] = entry
+                store.writers_waiting.pop(key, None)
+        return [BackendLock(key, lox_name, lock_id, provider_lock=token) for key, lock_id in zip(keys, lock_ids)]
+
+    def acquire_shared(self, lox_name, lock_id, expires_seconds=None, timeout=None, permits=None):
+        key = self.key(lox_name, lock_id)
+        store = self.store
+        with store.condition:
+            now = monotonic()
+            if store.blocked(key, now, shared=True, permits=permits):
+                raise LockInUseException("Lock {} has been acquired (or is wanted) exclusively, or has no permits "
+                                         "left, and is not available.".format(key))
+            token = next(store.tokens)
+            store.shared.setdefault(key, {})[token] = now + expires_seconds if expires_seconds else None
+        return BackendLock(key, lox_name, lock_id, provider_lock=token, shared=True)
+
+    def acquire_fair(self, lox_name, lock_id, ticket, ticket_seconds, expires_seconds=None, timeout=None):
+        key = self.key(lox_name, lock_id)
+        store = self.store
+        with store.condition:
+            now = monotonic()
+            queue = store.queues.setdefault(key, OrderedDict())
+            # renewing keeps our place
+            queue[ticket] = now + ticket_seconds
+            if store.blocked(key, now, shared=False) or store.queue_head(key, now) != ticket:
+                raise LockInUseException("Lock {} has been acquired previously, or others are in line for it, "
+                                         "and is not available.".format(key))
+            del queue[ticket]
+            if not queue:
+                del store.queues[key]
+            token = next(store.tokens)
+            store.held[key] = token, now + expires_seconds if expires_seconds else None
+        return BackendLock(key, lox_name, lock_id, provider_lock=token)
+
+    def leave_queue(self, lox_name, lock_id, ticket):
+        key = self.key(lox_name, lock_id)
+        store = self.store
+        with store.condition:
+            store.queues.get(key, {}).pop(ticket, None)
+            store.condition.notify_all()
+
+    def release(self, lock):
+        self.release_many([lock])
+
+    def release_many(self, locks):
+        """ Delete every key (or share of one) that is still ours, waking up anyone waiting for one. """
+        store = self.store
+        with store.condition:
+            for lock in locks:
+                if lock.shared:
+                    holders = store.shared.get(lock.key, {})
+                    holders.pop(lock.provider_lock, None)
+                    if not holders:
+                        store.shared.pop(lock.key, None)
+                    continue
+                entry = store.held.get(lock.key)
+                if entry is not None and entry[0] == lock.provider_lock:
+                    del store.held[lock.key]
+            store.condition.notify_all()
+
+    def extend_many(self, locks, expires_seconds):
+        store = self.store
+        lost = []
+        with store.condition:
+            now = monotonic()
+            for lock, seconds in zip(locks, expires_seconds):
+                if lock.shared:
+                    holders = store.shared.get(lock.key, {})
+                    expire_at = holders.get(lock.provider_lock, now)
+                    if expire_at is not None and expire_at <= now:
+                        lost.append(lock)
+                    else:
+                        holders[lock.provider_lock] = now + seconds
+                    continue
+                entry = store.held.get(lock.key)
+                if entry is None or entry[0] != lock.provider_lock or not store.in_use(lock.key, now):
+                    lost.append(lock)
+                else:
+                    store.held[lock.key] = lock.provider_lock, now + seconds
+        return lost
+
+    def clear(self, lox_name, lock_id):
+        key = self.key(lox_name, lock_id)
+        store = self.store
+        with store.condition:
+            store.held.pop(key, None)
+            store.shared.pop(key, None)
+            store.writers_waiting.pop(key, None)
+            store.queues.pop(key, None)
+            store.condition.notify_all()
+
+    def wait_for_release(self, lox_name, lock_id, timeout, shared=False, permits=None, ticket=None):
+        """
+        Wait on the store's condition until the key is free (released or expired), or timeout passes.
+        Waiters in a fair lock's line wait until it is their turn, too; they share the one condition,
+        so the others are woken up as well, but only to go back to waiting, without taking the lock.
+        """
+        key = self.key(lox_name, lock_id)
+        store = self.store
+        deadline = monotonic() + timeout
+        with store.condition:
+            while True:
+                now = monotonic()
+                if now >= deadline:
+                    return
+                if not store.blocked(key, now, shared, permits) and \
+                        (ticket is None or store.queue_head(key, now) in (ticket, None)):
+                    return
+                wait = deadline - now
+                expire_at = store.next_expiration(key, now)
+                if expire_at is not None:
+                    wait = min(wait, expire_at - now)
+                store.condition.wait(wait)
@@ -0,0 +1,299 @@
+from __future__ import unicode_literals
+
+import hashlib
+import struct
+import threading
+import time
+
+import psycopg2
+
+from lox.core.errors import *
+from lox.backends.base_lox_backend import BaseLoxBackend, BackendLock
+from lox.backends import postgres_lox_backend
+from lox.backends.postgres_lox_backend import PostgresLoxBackend, RELEASE_CHANNEL
+
+
+class AdvisorySession(object):
+    """
+    A dedicated autocommit connection that owns advisory locks, plus the set of advisory keys
+    it holds, and how many times it holds each shared key. Postgres advisory locks are reentrant
+    within a session, in either mode, so those are what keep two threads in this process from
+    both "getting" the same lock.
+    Every connection is a new epoch: locks taken in an earlier one were lost with its session.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.connection = None
+        self.mutex = threading.Lock()
+        self.held = set()
+        self.shared = {}
+        self.epoch = 0
+
+    def connect(self):
+        self.connection = psycopg2.connect(self.url)
+        self.connection.autocommit = True
+        self.epoch += 1
+        # a new session holds nothing: whatever the old one held was released by the server
+        self.held.clear()
+        self.shared.clear()
+
+    def holds(self, epoch):
+        """ Whether locks taken in epoch may still be held: their session is still up, as far as we know. """
+        return epoch == self.epoch and self.connection is not None and not self.connection.closed
+
+    def ping(self):
+        """ A round trip to find out whether the session is still up, closing it if not. Call with mutex held. """
+        if self.connection is None or self.connection.closed:
+            return
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("""SELECT 1;""")
+        except psycopg2.Error:
+            # whatever went wrong, the locks can't be counted on any more
+            if not self.connection.closed:
+                self.connection.close()
+        finally:
+            cursor.close()
+
+    def execute(self, sql, params):
+        """ Run sql and return the first column of the last result. Call with mutex held. """
+        if self.connection is None or self.connection.closed:
+            self.connect()
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(sql, params)
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+
+    def close(self):
+        if self.connection is not None and not self.connection.closed:
+            self.connection.close()
+        self.held.clear()
+        self.shared.clear()
+
+
+class PostgresAdvisoryLoxBackend(PostgresLoxBackend):
+    """
+    A PostgreSQL lox provider that uses session-level advisory locks instead of rows in the lox table,
+    so acquire and release never write to disk. Select it with the "postgres_mode": "advisory" config setting.
+
+    Ownership: advisory locks belong to the session that took them, so locks are held on a small set of
+    dedicated connections ("postgres_advisory_connections", default 1) that are never returned to the pool.
+    Each key always maps to the same session. If the process dies or a session is lost, the server
+    releases everything that session held right away. The session is connected again for the next acquire,
+    but the locks it held stay lost: extending them (which pings their sessions) reports them lost,
+    and releasing one raises LockExpiredException.
+
+    Expiration: the server has no notion of expiry for advisory locks, so expires_seconds is enforced by
+    the client's expiration timers, exactly like the table mode; crash recovery comes from the session ending.
+    The xact-level variants are not used because they end with the transaction, not with release.
+
+    Keys: each lox key is hashed to the signed 64 bit integer advisory locks are keyed by. A hash collision
+    can only make two different locks contend, never let two holders in.
+    clear can only release locks held by this backend, since nobody else can unlock another session's locks.
+
+    Shared locks are shared advisory locks. The server grants them as long as nobody holds the key exclusively,
+    with no notion of a waiting writer, so there is no writer preference in this mode.
+    Nor are there fair locks, since the server has no line of waiters for advisory locks either.
+    """
+
+    server_handles_expiration = False
+
+    def __init__(self, config):
+        super(PostgresAdvisoryLoxBackend, self).__init__(config)
+        self.sessions = []
+
+    def connect(self):
+        # the pool still serves wait_for_release
+        super(PostgresAdvisoryLoxBackend, self).connect()
+        url = self.config["backend"]["postgres"]
+        count = self.config.get("postgres_advisory_connections", 1)
+        if count < 1:
+            raise BackendConfigException("Postgres advisory mode needs at least 1 connection.")
+        self.sessions = [AdvisorySession(url) for _ in range(count)]
+
+    def close(self):
+        for session in self.sessions:
+            with session.mutex:
+                session.close()
+        super(PostgresAdvisoryLoxBackend, self).close()
+
+    def abandon(self):
+        # the parent's advisory locks live in these sessions
+        postgres_lox_backend._inherited.append(self.sessions)
+        self.sessions = []
+        super(PostgresAdvisoryLoxBackend, self).abandon()
+
+    def ensure_schema(self):
+        """ Advisory locks don't need the lox table. """
+        pass
+
+    def ensure_schema_once(self):
+        """ Nor check it, so don't tell table mode backends on the same DSN that it was. """
+        pass
+
+    def start_sweeper(self):
+        """ Nothing to sweep: advisory locks leave no rows behind. """
+        pass
+
+    @staticmethod
+    def advisory_key(key):
+        """ Stable signed 64 bit hash of a lox key. """
+        return struct.unpack(str(">q"), hashlib.sha1(key.encode("utf-8")).digest()[:8])[0]
+
+    def session_for(self, advisory_key):
+        return self.sessions[advisory_key % len(self.sessions)]
+
+    ## ------- acquire, release, clear ------- ##
+
+    def acquire(self, lox_name, lock_id, expires_seconds=None, timeout=None):
+        """
+        pg_try_advisory_lock never waits on the server, so there is nothing for timeout to bound
+        """
+        key = self.key(lox_name, lock_id)
+        advisory_key = self.advisory_key(key)
+        session = self.session_for(advisory_key)
+        with session.mutex:
+            if advisory_key in session.held or advisory_key in session.shared or \
+                    not session.execute("""SELECT pg_try_advisory_lock(%s);""", (advisory_key,)):
+                raise LockInUseException("Lock {} has been acquired previously, possibly by another thread/process, "
+                                         "and is not available.".format(key))
+            session.held.add(advisory_key)
+            epoch = session.epoch
+        return self.__backend_lock(key, lox_name, lock_id, expires_seconds, advisory_key, epoch, shared=False)
+
+    def acquire_fair(self, lox_name, lock_id, ticket, ticket_seconds, expires_seconds=None, timeout=None):
+        raise NotImplementedError("Advisory locks have no line of waiters, so advisory mode has no fair locks")
+
+    def leave_queue(self, lox_name, lock_id, ticket):
+        raise NotImplementedError("Advisory locks have no line of waiters, so advisory mode has no fair locks")
+
+    def acquire_shared(self, lox_name, lock_id, expires_seconds=None, timeout=None, permits=None):
+        if permits:
+            raise NotImplementedError("Advisory locks can't count holders, so advisory mode has no semaphores")
+        key = self.key(lox_name, lock_id)
+        advisory_key = self.advisory_key(key)
+        session = self.session_for(advisory_key)
+        with session.mutex:
+            if advisory_key in session.held or \
+                    not session.execute("""SELECT pg_try_advisory_lock_shared(%s);""", (advisory_key,)):
+                raise LockInUseException("Lock {} has been acquired exclusively, possibly by another thread/process, "
+                                         "and is not available.".format(key))
+            session.shared[advisory_key] = session.shared.get(advisory_key, 0) + 1
+            epoch = session.epoch
+        return self.__backend_lock(key, lox_name, lock_id, expires_seconds, advisory_key, epoch, shared=True)
+
+    @staticmethod
+    def __backend_lock(key, lox_name, lock_id, expires_seconds, advisory_key, epoch, shared):
+        acquire_ts = time.time()
+        expire_ts = None
+        if expires_seconds:
+            expire_ts = acquire_ts + expires_seconds
+        # the session's epoch tells whether the lock is still held by it, or was lost with an earlier session
+        return BackendLock(key, lox_name, lock_id, acquire_ts=acquire_ts, expire_ts=expire_ts,
+                           provider_lock=(advisory_key, epoch), shared=shared)
+
+    def acquire_many(self, lox_name, lock_ids, expires_seconds=None, timeout=None):
+        """
+        keys may belong to different sessions, so take them one at a time, unwinding on failure
+        """
+        return BaseLoxBackend.acquire_many(self, lox_name, lock_ids, expires_seconds=expires_seconds, timeout=timeout)
+
+    def release(self, lock):
+        """ Raises LockExpiredException if the lock was lost with its session, which the server released it with. """
+        advisory_key, epoch = lock.provider_lock
+        if lock.shared:
+            self.__unlock_shared(lock.key, advisory_key, epoch)
+        else:
+            self.__unlock(lock.key, advisory_key, epoch)
+
+    def extend_many(self, locks, expires_seconds):
+        """
+        Nothing to extend on the server: the client's expiration timers are simply rescheduled. But each
+        session the locks are held by is pinged, and the locks of those that turn out to be lost are returned.
+        """
+        sessions = {}
+        for lock in locks:
+            session = self.session_for(lock.provider_lock[0])
+            sessions[id(session)] = session
+        for session in sessions.values():
+            with session.mutex:
+                session.ping()
+        return [lock for lock in locks if not self.session_for(lock.provider_lock[0]).holds(lock.provider_lock[1])]
+
+    def release_many(self, locks):
+        """ One at a time, all of them even if some were lost, and then raising for the first of those. """
+        lost = None
+        for lock in locks:
+            try:
+                self.release(lock)
+            except LockExpiredException as ex:
+                lost = lost or ex
+        if lost is not None:
+            raise lost
+
+    def clear(self, lox_name, lock_id):
+        key = self.key(lox_name, lock_id)
+        advisory_key = self.advisory_key(key)
+        self.__unlock(key, advisory_key)
+        session = self.session_for(advisory_key)
+        for i in range(session.shared.get(advisory_key, 0)):
+            self.__unlock_shared(key, advisory_key)
+
+    def __unlock(self, key, advisory_key, epoch=None):
+        """ Release our exclusive hold of the key; with epoch, that of the lock taken in it. """
+        session = self.session_for(advisory_key)
+        with session.mutex:
+            if epoch is not None and not session.holds(epoch):
+                raise LockExpiredException("Lock {} was lost with its postgres session".format(key))
+            # not held means it went away with a lost session, and the server already let it go
+            if advisory_key not in session.held:
+                return
+            sql = """SELECT pg_advisory_unlock(%s);"""
+            params = (advisory_key,)
+            if self.config.get("wait_for_release", False):
+                sql += """SELECT pg_notify(%s, %s);"""
+                params += (RELEASE_CHANNEL, key)
+            try:
+                session.execute(sql, params)
+            finally:
+                session.held.discard(advisory_key)
+
+    def __unlock_shared(self, key, advisory_key, epoch=None):
+        session = self.session_for(advisory_key)
+        with session.mutex:
+            if epoch is not None and not session.holds(epoch):
+                raise LockExpiredException("Lock {} was lost with its postgres session".format(key))
+            count = session.shared.get(advisory_key, 0)
+            if not count:
+                return
+            sql = """SELECT pg_advisory_unlock_shared(%s);"""
+            params = (advisory_key,)
+            if self.config.get("wait_for_release", False):
+                sql += """SELECT pg_notify(%s, %s);"""
+                params += (RELEASE_CHANNEL, key)
+            try:
+                session.execute(sql, params)
+            finally:
+                if count > 1:
+                    session.shared[advisory_key] = count - 1
+                else:
+                    del session.shared[advisory_key]
+
+    def held_query(self, key, shared=False, permits=None, ticket=None):
+        # a bigint advisory key shows up in pg_locks split into its high and low 32 bits;
+        # shared holders only keep out exclusive acquires
+        advisory_key = self.advisory_key(key)
+        return """
+            SELECT EXISTS (
+                SELECT 1
+                FROM   pg_catalog.pg_locks
+                WHERE  locktype = 'advisory'
+                AND    classid = %s::bigint::oid
+                AND    objid = %s::bigint::oid
+                AND    objsubid = 1
+                AND    granted
+                AND    (mode = 'ExclusiveLock' OR NOT %s)
+            );
+        """, ((advisory_key >> 32) & 0xffffffff, advisory_key & 0xffffffff, shared)
@@ -1,88 +1,656 @@
 from __future__ import unicode_literals
 
-from datetime import datetime, timedelta
+from contextlib import contextmanager
+import re
+import select
 import threading
+import time
 
 import psycopg2
-import pytz
+from psycopg2.extensions import connection as Psycopg2Connection
+from psycopg2.extensions import QueryCanceledError, TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+from psycopg2.pool import ThreadedConnectionPool
 
 from lox.core.errors import *
-from base_lox_backend import BaseLoxBackend, BackendLock
+from lox.core.fork import at_fork_in_child
+from lox.core.ids import new_id
+from lox.backends.base_lox_backend import BaseLoxBackend, BackendLock
+
+DEFAULT_POOL_MIN_CONNECTIONS = 1
+DEFAULT_POOL_MAX_CONNECTIONS = 10
+RELEASE_CHANNEL = "lox_release"
+# plus a ticket, the channel that tells a fair lock's waiter it's its turn
+TICKET_CHANNEL_PREFIX = "lox_ticket_"
+# first half of the transaction-level advisory locks that serialize shared and exclusive acquires of a key
+SHARED_LOCK_NAMESPACE = 0x6c6f78
+# lox_shared rows with this token aren't shared holders, but writers waiting for them to leave
+WRITER_WAITING_TOKEN = ""
+DEFAULT_SCHEMA = "public"
+DEFAULT_TABLE = "lox"
+# for tables that are mostly dead rows: vacuum them after a fixed number of changes rather than a fraction
+# of their size, and leave room in each page for the next version of a row
+DEFAULT_STORAGE_PARAMETERS = {
+    "fillfactor": 70,
+    "autovacuum_vacuum_scale_factor": 0,
+    "autovacuum_vacuum_threshold": 1000,
+    "autovacuum_analyze_scale_factor": 0,
+    "autovacuum_analyze_threshold": 1000,
+}
+IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+# (DSN, schema, table) that this process has already checked, so each backend doesn't have to again
+_ensured_schemas = set()
+_ensured_schemas_lock = threading.Lock()
+# connections a forked child inherited: closing them, or letting them be garbage collected, would end
+# the parent's sessions on the server, so the child keeps them around, unused, for as long as it lives
+_inherited = []
+
+
+def _reset_after_fork():
+    global _ensured_schemas_lock
+    _ensured_schemas_lock = threading.Lock()
+
+
+at_fork_in_child(_reset_after_fork)
+
+
+class LoxConnection(Psycopg2Connection):
+    """
+    A pooled connection that remembers the names of the statements it has prepared,
+    or has None for them when that is unknown (after an error).
+    """
+    def __init__(self, *args, **kwargs):
+        super(LoxConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class Statement(object):
+    """
+    One of the statements the hot paths run. Its SQL refers to params as {name}, which become
+    $1, $2... in a server-side prepared statement, or %(name)s psycopg2 params when sent as text,
+    and to the tables as {lox}, {lox_shared} and {lox_queue}, which become those of tables (see table_names).
+    params is a list of (name, type) pairs.
+    """
+
+    def __init__(self, name, params, sql, tables=None):
+        self.name = name
+        self.params = params
+        self.sql = sql
+        self.param_names = [param for param, type in params]
+        tables = tables or table_names(DEFAULT_SCHEMA, DEFAULT_TABLE)
+        positions = dict((param, "${}".format(i)) for i, param in enumerate(self.param_names, 1))
+        self.prepare_sql = """PREPARE {} ({}) AS {};""".format(
+            name, ", ".join(type for param, type in params),
+            sql.format(**dict(tables, **positions)).strip().rstrip(";"))
+        self.execute_sql = """EXECUTE {} ({});""".format(
+            name, ", ".join("%({})s".format(param) for param in self.param_names))
+        self.text_sql = sql.format(**dict(tables, **dict((param, "%({})s::{}".format(param, type))
+                                                         for param, type in params)))
+
+    def for_tables(self, tables):
+        """ The same statement, run against other tables. """
+        return Statement(self.name, self.params, self.sql, tables)
+
+
+def configured_table(config):
+    """ The (schema, table) config asks for, checked to be plain identifiers, since they go into SQL as is. """
+    schema = config.get("postgres_schema", DEFAULT_SCHEMA)
+    table = config.get("postgres_table", DEFAULT_TABLE)
+    for name in (schema, table):
+        if not IDENTIFIER.match(name or ""):
+            raise BackendConfigException("Postgres schema and table names must be plain identifiers, "
+                                         "not {!r}".format(name))
+    return schema, table
+
+
+def table_options(config):
+    """ The UNLOGGED and WITH (storage parameters) clauses of a CREATE TABLE, as config asks for them. """
+    parameters = config.get("postgres_storage_parameters", DEFAULT_STORAGE_PARAMETERS)
+    for name, value in parameters.items():
+        if not IDENTIFIER.match(name) or isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise BackendConfigException("Bad postgres storage parameter {!r} = {!r}".format(name, value))
+    return dict(unlogged="UNLOGGED" if config.get("postgres_unlogged", False) else "",
+                storage="WITH ({})".format(", ".join("{} = {}".format(name, value)
+                                                     for name, value in sorted(parameters.items())))
+                if parameters else "")
+
+
+def table_names(schema, table):
+    """ The qualified, quoted names of the lock, shared holder and queue tables, by the name used in SQL. """
+    return dict(lox='"{}"."{}"'.format(schema, table),
+                lox_shared='"{}"."{}_shared"'.format(schema, table),
+                lox_queue='"{}"."{}_queue"'.format(schema, table))
+
+
+# takes the transaction-level advisory locks for a group of keys, in hash order so overlapping groups can't deadlock
+LOCK_KEYS = Statement("lox_lock_keys", [("namespace", "integer"), ("keys", "text[]")], """
+   SELECT pg_advisory_xact_lock({namespace}, h)
+   FROM   (SELECT DISTINCT hashtext(k) AS h FROM unnest({keys}) AS k ORDER BY 1) AS hashes;
+""")
+
+# inserts (or takes over expired) rows for every key, or none of them if one is in use, exclusively or shared;
+# run after LOCK_KEYS, nobody else can insert in the meantime, so the check holds for the insert.
+# Deletes the keys' waiting writer markers if it took them, and otherwise, with writer_seconds > 0,
+# marks the keys that have shared holders as wanted by a writer for that long
+ACQUIRE_KEYS = Statement("lox_acquire_keys", [("keys", "text[]"), ("seconds", "double precision"),
+                                              ("writer", "text"), ("writer_seconds", "double precision")], """
+   WITH wanted AS (
+       SELECT k AS key FROM unnest({keys}) AS k
+   ), in_use AS (
+       SELECT 1 FROM wanted w
+       WHERE  EXISTS (
+           SELECT 1 FROM {lox} l
+           WHERE  l.key = w.key AND (l.expire_ts IS NULL OR l.expire_ts > now())
+       ) OR EXISTS (
+           SELECT 1 FROM {lox_shared} s
+           WHERE  s.key = w.key AND s.token <> {writer} AND (s.expire_ts IS NULL OR s.expire_ts > now())
+       )
+       LIMIT 1
+   ), taken AS (
+       INSERT INTO {lox} AS l (key, acquire_ts, expire_ts)
+       SELECT key, now(), now() + {seconds} * interval '1 second'
+       FROM   wanted
+       WHERE  NOT EXISTS (SELECT 1 FROM in_use)
+       ORDER BY key
+       ON CONFLICT (key) DO UPDATE
+       SET    acquire_ts = EXCLUDED.acquire_ts, expire_ts = EXCLUDED.expire_ts
+       WHERE  l.expire_ts <= EXCLUDED.acquire_ts
+       RETURNING key, acquire_ts, expire_ts
+   ), writers_done AS (
+       DELETE FROM {lox_shared}
+       WHERE  key = ANY({keys}) AND token = {writer} AND EXISTS (SELECT 1 FROM taken)
+   ), writers_waiting AS (
+       INSERT INTO {lox_shared} (key, token, acquire_ts, expire_ts)
+       SELECT DISTINCT s.key, {writer}, now(), now() + {writer_seconds} * interval '1 second'
+       FROM   {lox_shared} s
+       WHERE  s.key = ANY({keys}) AND s.token <> {writer} AND (s.expire_ts IS NULL OR s.expire_ts > now())
+       AND    {writer_seconds} > 0 AND NOT EXISTS (SELECT 1 FROM taken)
+       ON CONFLICT (key, token) DO UPDATE
+       SET    acquire_ts = EXCLUDED.acquire_ts, expire_ts = EXCLUDED.expire_ts
+   )
+   SELECT key, acquire_ts, expire_ts FROM taken;
+""")
+
+RELEASE_KEYS = Statement("lox_release_keys", [("keys", "text[]"), ("acquire_ts", "timestamptz[]")], """
+   DELETE FROM {lox}
+   WHERE (key, acquire_ts) IN (SELECT * FROM unnest({keys}, {acquire_ts}));
+""")
+
+RELEASE_SHARED = Statement("lox_release_shared", [("shared_keys", "text[]"), ("tokens", "text[]")], """
+   DELETE FROM {lox_shared}
+   WHERE (key, token) IN (SELECT * FROM unnest({shared_keys}, {tokens}));
+""")
+
+NOTIFY_RELEASED = Statement("lox_notify_released", [("channel", "text"), ("released", "text[]")], """
+   SELECT pg_notify({channel}, key) FROM unnest({released}) AS released(key);
+""")
+
+# notifies the waiter at the head of each key's line that it's its turn
+WAKE_QUEUE_HEADS = Statement("lox_wake_queue_heads", [("ticket_prefix", "text"), ("released", "text[]")], """
+   SELECT pg_notify({ticket_prefix} || ticket, '')
+   FROM   (SELECT DISTINCT ON (key) ticket FROM {lox_queue}
+           WHERE key = ANY({released}) AND expire_ts > now() ORDER BY key, seq) AS heads;
+""")
+
+STATEMENTS = [LOCK_KEYS, ACQUIRE_KEYS, RELEASE_KEYS, RELEASE_SHARED, NOTIFY_RELEASED, WAKE_QUEUE_HEADS]
+
+
+class ReleaseListener(object):
+    """
+    The one connection, outside the pool, on which a backend LISTENs for release notifications on behalf
+    of all of its waiters, so waiting never ties up pooled connections (which the releases we wait for need).
+    A thread of its own reads the notifications and sets the events of the waiters they are for:
+    waiters on RELEASE_CHANNEL by the key in the payload, fair waiters by their ticket's channel.
+    Connected on first use, and again after the connection is lost, which wakes up every waiter.
+    """
+
+    # how often the thread checks whether it should stop, when nothing comes in
+    POLL_SECONDS = 1
+
+    def __init__(self, url):
+        self.url = url
+        self.mutex = threading.Lock()
+        self.connection = None
+        # (channel, payload, or None for any) -> set of threading.Events
+        self.waiters = {}
+        # channel -> how many waiters want it LISTENed to
+        self.channels = {}
+        self.closed = False
+
+    def subscribe(self, channel, payload=None):
+        """ LISTEN on channel, if not already, and return an Event set when a notification with payload comes in. """
+        event = threading.Event()
+        with self.mutex:
+            if self.connection is None:
+                self.__connect()
+            self.waiters.setdefault((channel, payload), set()).add(event)
+            try:
+                if not self.channels.get(channel):
+                    self.connection.cursor().execute("""LISTEN {};""".format(channel))
+                self.channels[channel] = self.channels.get(channel, 0) + 1
+                self.__dispatch()
+            except BaseException as ex:
+                self.waiters[(channel, payload)].discard(event)
+                if isinstance(ex, psycopg2.Error):
+                    self.__lost()
+                raise
+        return event
+
+    def unsubscribe(self, channel, payload, event):
+        with self.mutex:
+            waiters = self.waiters.get((channel, payload), set())
+            waiters.discard(event)
+            if not waiters:
+                self.waiters.pop((channel, payload), None)
+            if channel not in self.channels:
+                # the connection was lost since, and with it the LISTEN
+                return
+            self.channels[channel] -= 1
+            if not self.channels[channel]:
+                del self.channels[channel]
+                try:
+                    self.connection.cursor().execute("""UNLISTEN {};""".format(channel))
+                except psycopg2.Error:
+                    self.__lost()
+
+    def __connect(self):
+        connection = psycopg2.connect(self.url)
+        connection.autocommit = True
+        self.connection = connection
+        thread = threading.Thread(target=self.__listen, args=(connection,), name="lox-listener")
+        thread.daemon = True
+        thread.start()
+
+    def __listen(self, connection):
+        while not self.closed and self.connection is connection:
+            try:
+                select.select([connection], [], [], self.POLL_SECONDS)
+                with self.mutex:
+                    if self.connection is connection:
+                        connection.poll()
+                        self.__dispatch()
+            except (psycopg2.Error, select.error, ValueError, OSError):
+                with self.mutex:
+                    if self.connection is connection:
+                        self.__lost()
+                return
+
+    def __dispatch(self):
+        notifies = self.connection.notifies
+        while notifies:
+            notify = notifies.pop(0)
+            for payload in (notify.payload, None):
+                for event in self.waiters.get((notify.channel, payload), ()):
+                    event.set()
+
+    def __lost(self):
+        """ Forget the connection, and wake up everyone: they can't hear about releases until they wait again. """
+        connection, self.connection = self.connection, None
+        self.channels = {}
+        for waiters in self.waiters.values():
+            for event in waiters:
+                event.set()
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def close(self):
+        self.closed = True
+        with self.mutex:
+            if self.connection is not None:
+                self.__lost()
+
+    def abandon(self):
+        """ In a forked child: the connection is the parent's, see _inherited. """
+        self.closed = True
+        _inherited.append(self.connection)
+        self.connection = None
+
 
 class PostgresLoxBackend(BaseLoxBackend):
     """
     A lox provider that uses PostreSQL as the backend lock store.
-    Note that autocommit is not used, so that we can control transaction manually.
+    Every lock operation is a single autocommit round trip: its statements go out in one execute call and
+    run as one implicit transaction, with no BEGIN or COMMIT of their own. Exclusive acquires and releases
+    run server-side prepared statements; shared and fair acquires, extends and leaving a line send their SQL
+    as text, since it varies with the call. Only the schema checks, sweep_expired and clear use explicit
+    transactions.
+
+    Expiration is handled by the server: acquire takes over a row whose expire_ts has passed in the
+    same statement that inserts, so a crashed holder never needs cleaning up by hand.
+    Expired rows that nobody asks for again are deleted by sweep_expired, which also runs in the
+    background every "postgres_sweep_interval_seconds", if that is set.
+
+    Shared holders are rows of their own in the lox_shared table, keyed by lock key and owner token.
+    Acquires of either kind first take a transaction-level advisory lock on the key (shared for shared
+    acquires), so a shared and an exclusive acquire can't both see the other table without the other's row.
+
+    The line of waiters for a fair lock is the lox_queue table, of tickets ordered by a sequence, and each
+    release NOTIFYs the channel of the ticket at the head of the key's line, so only that waiter wakes up.
+
+    Connections come from a thread-safe pool, and each operation checks one out for the
+    duration of its own transaction, so a single backend can be shared by many threads.
+    Pool size is set with the "postgres_pool_min_connections" and "postgres_pool_max_connections"
+    config keys; set "postgres_pool_ping" to also run a round trip health check on every checkout.
+
+    The tables are "public"."lox", "lox_shared" and "lox_queue" by default; "postgres_schema" and "postgres_table"
+    change the schema and the names (the others get _shared and _queue added). Lock state is short-lived, so the
+    durability of a regular table can be traded for speed: "postgres_unlogged" creates UNLOGGED tables, which skip
+    the WAL (they are emptied after a crash and not replicated), and "postgres_synchronous_commit" set to False
+    commits without waiting for the WAL to be flushed (a crash can then lose the last moments' changes).
+    New tables get "postgres_storage_parameters", by default DEFAULT_STORAGE_PARAMETERS.
     """
 
-    server_handles_expiration = False
+    server_handles_expiration = True
 
     def __init__(self, config):
         super(PostgresLoxBackend, self).__init__(config)
         self.background_timer_delay = 0.5
+        self.pool = None
+        # psycopg2 pools raise instead of blocking when exhausted, so callers wait on this first
+        self._pool_available = threading.Condition()
+        self._max_connections = None
+        self._checked_out = 0
+        self._sweeper = None
+        self._sweeper_stop = threading.Event()
+        self.listener = ReleaseListener(self.config["backend"]["postgres"])
+        self.schema, self.table = configured_table(self.config)
+        self.tables = table_names(self.schema, self.table)
+        self.statements = dict((statement, statement.for_tables(self.tables)) for statement in STATEMENTS)
 
     def connect(self):
         url = self.config["backend"]["postgres"]
-        self.connection = psycopg2.connect(url)
-        self.cursor = self.connection.cursor()
-        self.ensure_schema()
+        min_connections = self.config.get("postgres_pool_min_connections", DEFAULT_POOL_MIN_CONNECTIONS)
+        max_connections = self.config.get("postgres_pool_max_connections", DEFAULT_POOL_MAX_CONNECTIONS)
+        if max_connections < 1 or min_connections > max_connections:
+            raise BackendConfigException("Postgres pool needs 1 <= min connections <= max connections.")
+        self.pool = ThreadedConnectionPool(min_connections, max_connections, url, connection_factory=LoxConnection)
+        self._max_connections = max_connections
+        self.ensure_schema_once()
+        self.start_sweeper()
+
+    def close(self):
+        """ Stop the sweeper and close every pooled connection. """
+        super(PostgresLoxBackend, self).close()
+        self._sweeper_stop.set()
+        if self._sweeper:
+            self._sweeper.join()
+            self._sweeper = None
+        if self.pool:
+            self.pool.closeall()
+            self.pool = None
+        self.listener.close()
+
+    def abandon(self):
+        """ In a forked child: leave the parent's pool alone, and its sweeper, whose thread didn't come along. """
+        super(PostgresLoxBackend, self).abandon()
+        _inherited.append(self.pool)
+        self.pool = None
+        self._sweeper = None
+        self.listener.abandon()
+
+    ## ------- connection pool ------- ##
+
+    def checkout(self, timeout=None):
+        """
+        Take a healthy connection out of the pool, blocking while all of them are in use
+        (for at most timeout seconds, if given). Must be handed back with checkin.
+        """
+        self.__reserve_slot(timeout)
+        try:
+            connection = self.pool.getconn()
+            if not self.__is_healthy(connection):
+                self.pool.putconn(connection, close=True)
+                connection = self.pool.getconn()
+        except Exception:
+            self.__free_slot()
+            raise
+        return connection
+
+    def checkin(self, connection):
+        """ Return a connection to the pool, discarding it if it is broken. """
+        try:
+            if not connection.closed and connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                # never hand the next caller someone else's open transaction
+                connection.rollback()
+        except psycopg2.Error:
+            pass
+        finally:
+            try:
+                self.pool.putconn(connection, close=bool(connection.closed))
+            finally:
+                self.__free_slot()
+
+    @contextmanager
+    def cursor(self, timeout=None, autocommit=False):
+        """
+        Run one operation on a checked out connection: commit if the block succeeds,
+        roll back if it raises, and always return the connection to the pool.
+        With autocommit, the block must make a single execute call instead, whose statements then run as
+        one implicit transaction in a single round trip, without the two more BEGIN and COMMIT take.
+        """
+        connection = self.checkout(timeout=timeout)
+        try:
+            connection.autocommit = autocommit
+            cursor = connection.cursor()
+            try:
+                yield cursor
+            except BaseException:
+                if not connection.closed and not autocommit:
+                    connection.rollback()
+                raise
+            else:
+                if not autocommit:
+                    connection.commit()
+            finally:
+                cursor.close()
+        finally:
+            if autocommit and not connection.closed:
+                connection.autocommit = False
+            self.checkin(connection)
+
+    def local_settings(self, timeout=None):
+        """
+        SQL to start a transaction with, and its params: SET LOCAL a statement timeout, if given, and
+        synchronous_commit off, if "postgres_synchronous_commit" is False.
+        """
+        sql, params = "", {}
+        if timeout is not None:
+            # 0 would mean no timeout at all, so never go below 1ms
+            sql += """SET LOCAL statement_timeout = %(timeout)s;"""
+            params["timeout"] = max(int(timeout * 1000), 1)
+        if not self.config.get("postgres_synchronous_commit", True):
+            sql += """SET LOCAL synchronous_commit = off;"""
+        return sql, params
+
+    def execute(self, cursor, statements, params, timeout=None):
+        """
+        Send Statements in one execute call, with params (a dict) for all of them, and a statement timeout if given.
+        Each connection prepares them the first time, in the same round trip, unless "postgres_prepared_statements"
+        is set to False (as it must be behind a pooler that doesn't keep sessions, like pgbouncer's transaction mode).
+        """
+        sql, settings_params = self.local_settings(timeout)
+        params = dict(params)
+        params.update(settings_params)
+        statements = [self.statements[statement] for statement in statements]
+        if not self.config.get("postgres_prepared_statements", True):
+            cursor.execute(sql + "".join(statement.text_sql for statement in statements), params)
+            return
+        connection = cursor.connection
+        if connection.prepared is None:
+            sql += """DEALLOCATE ALL;"""
+            connection.prepared = set()
+        for statement in statements:
+            if statement.name not in connection.prepared:
+                sql += statement.prepare_sql
+                connection.prepared.add(statement.name)
+            sql += statement.execute_sql
+        try:
+            cursor.execute(sql, params)
+        except BaseException:
+            # whether the PREPAREs took is anybody's guess now
+            connection.prepared = None
+            raise
+
+    def __reserve_slot(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._pool_available:
+            while self._checked_out >= self._max_connections:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise LockTimeoutException("Timed out waiting for a pooled postgres connection")
+                self._pool_available.wait(remaining)
+            self._checked_out += 1
+
+    def __free_slot(self):
+        with self._pool_available:
+            self._checked_out -= 1
+            self._pool_available.notify()
+
+    def __is_healthy(self, connection):
+        """
+        Cheap local checks always; an actual round trip only if "postgres_pool_ping" is configured.
+        """
+        if connection.closed or connection.get_transaction_status() == TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if self.config.get("postgres_pool_ping", False):
+            try:
+                cursor = connection.cursor()
+                cursor.execute("SELECT 1;")
+                cursor.close()
+                connection.rollback()
+            except psycopg2.Error:
+                return False
+        return True
 
     ## ------- schema ------- ##
 
+    def ensure_schema_once(self):
+        """ ensure_schema, unless a backend of this process already has for the same DSN, schema and table. """
+        key = (self.config["backend"]["postgres"], self.schema, self.table)
+        with _ensured_schemas_lock:
+            if key not in _ensured_schemas:
+                self.ensure_schema()
+                _ensured_schemas.add(key)
+
     def ensure_schema(self):
         """
+        0. make sure the schema exists
         1. make sure the lox table exists
         2. if not, create it
         3. if so, make sure the columns are what we expect
         4. if not, raise exception (someone else may be using this table)
         5. make sure the indexes we need are there
         """
-        try:
-            if self.__ensure_table():
-                if self.__ensure_columns():
-                    self.__ensure_pk()
-        except Exception as ex:
-            self.connection.rollback()
-            raise
-        else:
-            self.connection.commit()
+        with self.cursor() as cursor:
+            if self.__ensure_namespace(cursor) and self.__ensure_table(cursor):
+                if self.__ensure_columns(cursor):
+                    if self.__ensure_pk(cursor):
+                        if self.__ensure_expire_index(cursor):
+                            if self.__ensure_shared_table(cursor):
+                                self.__ensure_queue_table(cursor)
+
+    def __ensure_namespace(self, cursor):
+        """
+        1. make sure the schema exists
+        2. if not, create it
+        """
+        cursor.execute("""SELECT EXISTS (SELECT 1 FROM pg_catalog.pg_namespace WHERE nspname = %s);""",
+                       (self.schema,))
+        if not cursor.fetchone()[0]:
+            cursor.execute("""CREATE SCHEMA IF NOT EXISTS "{}";""".format(self.schema))
+        return True
+
+    def __create_table(self, cursor, sql):
+        """ Run a CREATE TABLE in sql, made UNLOGGED and given the storage parameters, as configured. """
+        options = table_options(self.config)
+        options.update(self.tables)
+        cursor.execute(sql.format(table=self.table, **options))
 
-    def __ensure_table(self):
+    def __ensure_table(self, cursor):
         """
         # 1. make sure the lox table exists
         # 2. if not, create it
         """
-        if not self.__exists_schema("public", "lox", "r"):
-            self.cursor.execute("""
-            CREATE TABLE lox (
+        if not self.__exists_schema(cursor, self.schema, self.table, "r"):
+            self.__create_table(cursor, """
+            CREATE {unlogged} TABLE {lox} (
                 key text NOT NULL,
                 acquire_ts timestamp with time zone NOT NULL,
                 expire_ts timestamp with time zone NULL,
-                CONSTRAINT pk_lox PRIMARY KEY (key)
-            );
+                CONSTRAINT "pk_{table}" PRIMARY KEY (key)
+            ) {storage};
             """)
         return True
 
-    def __ensure_columns(self):
+    def __ensure_columns(self, cursor):
         """ Test a query with the columns we expect. """
         try:
-            self.cursor.execute("""SELECT key, acquire_ts, expire_ts FROM lox LIMIT 1;""")
+            cursor.execute("""SELECT key, acquire_ts, expire_ts FROM {lox} LIMIT 1;""".format(**self.tables))
         except psycopg2.ProgrammingError as ex:
-            raise SchemaConflictException("Incorrect columns for postgres table public.lox")
+            raise SchemaConflictException("Incorrect columns for postgres table {}.{}".format(self.schema, self.table))
         else:
             return True
 
-    def __ensure_pk(self):
+    def __ensure_pk(self, cursor):
         """
         1. make sure the PK exists
         2. if not, create it
         """
-        if not self.__exists_schema("public", "pk_lox", "i"):
-            self.cursor.execute("""ALTER TABLE lox ADD CONSTRAINT pk_lox PRIMARY KEY (key);""")
+        if not self.__exists_schema(cursor, self.schema, "pk_{}".format(self.table), "i"):
+            cursor.execute("""ALTER TABLE {lox} ADD CONSTRAINT "pk_{table}" PRIMARY KEY (key);""".format(
+                table=self.table, **self.tables))
+        return True
+
+    def __ensure_expire_index(self, cursor):
+        """
+        1. make sure the expiration index (used by the sweeper) exists
+        2. if not, create it
+        """
+        if not self.__exists_schema(cursor, self.schema, "ix_{}_expire_ts".format(self.table), "i"):
+            cursor.execute("""CREATE INDEX "ix_{table}_expire_ts" ON {lox} (expire_ts)
+                              WHERE expire_ts IS NOT NULL;""".format(table=self.table, **self.tables))
         return True
 
-    def __exists_schema(self, namespace, relname, relkind):
-        self.cursor.execute("""
+    def __ensure_shared_table(self, cursor):
+        """
+        1. make sure the lox_shared table (shared holders, and writers waiting for them) exists
+        2. if not, create it
+        """
+        if not self.__exists_schema(cursor, self.schema, "{}_shared".format(self.table), "r"):
+            self.__create_table(cursor, """
+            CREATE {unlogged} TABLE {lox_shared} (
+                key text NOT NULL,
+                token text NOT NULL,
+                acquire_ts timestamp with time zone NOT NULL,
+                expire_ts timestamp with time zone NULL,
+                CONSTRAINT "pk_{table}_shared" PRIMARY KEY (key, token)
+            ) {storage};
+            CREATE INDEX "ix_{table}_shared_expire_ts" ON {lox_shared} (expire_ts) WHERE expire_ts IS NOT NULL;
+            """)
+        return True
+
+    def __ensure_queue_table(self, cursor):
+        """
+        1. make sure the lox_queue table (the lines of waiters for fair locks) exists
+        2. if not, create it
+        """
+        if not self.__exists_schema(cursor, self.schema, "{}_queue".format(self.table), "r"):
+            self.__create_table(cursor, """
+            CREATE {unlogged} TABLE {lox_queue} (
+                key text NOT NULL,
+                ticket text NOT NULL,
+                seq bigserial NOT NULL,
+                expire_ts timestamp with time zone NOT NULL,
+                CONSTRAINT "pk_{table}_queue" PRIMARY KEY (key, ticket)
+            ) {storage};
+            CREATE INDEX "ix_{table}_queue_key_seq" ON {lox_queue} (key, seq);
+            """)
+        return True
+
+    def __exists_schema(self, cursor, namespace, relname, relkind):
+        cursor.execute("""
             SELECT EXISTS (
                 SELECT 1
                 FROM   pg_catalog.pg_class c
@@ -92,33 +660,156 @@ class PostgresLoxBackend(BaseLoxBackend):
                 AND    c.relkind = %s
             );
         """, (namespace, relname, relkind))
-        return self.cursor.fetchone()[0]
+        return cursor.fetchone()[0]
 
     ## ------- acquire, release, clear ------- ##
 
-    def acquire(self, lox_name, lock_id, expires_seconds=None):
+    def acquire(self, lox_name, lock_id, expires_seconds=None, timeout=None):
         """
         insert a row into the postgres lox table to persist the lock
         commit and return a simple tuple with lock details
+        with a timeout, neither the pool checkout nor the statement may take longer than that
         """
         key = self.key(lox_name, lock_id)
-        acquire_ts = datetime.now(tz=pytz.UTC)
-        expire_ts = None
-        if expires_seconds:
-            expire_ts = acquire_ts + timedelta(seconds=expires_seconds)
+        acquire_ts, expire_ts = self.__insert_keys([key], expires_seconds, timeout)[key]
+        return BackendLock(key, lox_name, lock_id, acquire_ts=acquire_ts, expire_ts=expire_ts)
+
+    def acquire_many(self, lox_name, lock_ids, expires_seconds=None, timeout=None):
+        """
+        insert one row per lock with a single multi-row statement
+        if any of them is in use the whole transaction is rolled back, so it's all or nothing
+        """
+        keys = [self.key(lox_name, lock_id) for lock_id in lock_ids]
+        rows = self.__insert_keys(keys, expires_seconds, timeout)
+        return [BackendLock(key, lox_name, lock_id, acquire_ts=rows[key][0], expire_ts=rows[key][1])
+                for key, lock_id in zip(keys, lock_ids)]
+
+    def __insert_keys(self, keys, expires_seconds, timeout):
+        """
+        insert (or take over expired) rows for keys, returning {key: (acquire_ts, expire_ts)}
+        raises LockInUseException, having inserted none, unless every key was free (of shared holders too)
+        one round trip: the advisory locks and the insert run as one implicit transaction, and so does
+        marking the keys with shared holders as wanted by a writer, for "writer_preference_seconds", if it fails
+        """
+        # an expired row is taken over in the same statement; timestamps come from the server's clock
+        params = dict(namespace=SHARED_LOCK_NAMESPACE, keys=sorted(keys), seconds=expires_seconds,
+                      writer=WRITER_WAITING_TOKEN, writer_seconds=self.writer_preference_seconds or 0)
         try:
-            self.cursor.execute("""
-               INSERT INTO lox (key, acquire_ts, expire_ts)
-               VALUES (%s, %s, %s);
-            """, (key, acquire_ts, expire_ts)
-            )
-        except psycopg2.IntegrityError as ex:
-            self.connection.rollback()
-            raise LockInUseException("Lock {} has been acquired previously, possibly by another thread/process, "
+            with self.cursor(timeout=timeout, autocommit=True) as cursor:
+                self.execute(cursor, [LOCK_KEYS, ACQUIRE_KEYS], params, timeout)
+                rows = dict((row[0], row[1:]) for row in cursor.fetchall())
+                # no rows back means one of them has not expired, or has shared holders
+                in_use = [key for key in keys if key not in rows]
+                if in_use:
+                    raise LockInUseException("Lock {} has been acquired previously, possibly by another "
+                                             "thread/process, and is not available.".format(in_use[0]))
+        except QueryCanceledError as ex:
+            raise LockTimeoutException("Timed out acquiring lock {}, it is probably being acquired "
+                                       "by another thread/process.".format(", ".join(keys)))
+        return rows
+
+    def acquire_shared(self, lox_name, lock_id, expires_seconds=None, timeout=None, permits=None):
+        """
+        insert a row of our own into lox_shared, unless the lock has a live exclusive holder or a writer waiting
+        for a semaphore permit, also unless there are that many live rows already: counting them is only
+        safe with the advisory lock held exclusively, so permits are granted one at a time
+        """
+        key = self.key(lox_name, lock_id)
+        token = new_id()
+        sql = """
+           SELECT {advisory_lock}(%(namespace)s, hashtext(%(key)s));
+           INSERT INTO {lox_shared} (key, token, acquire_ts, expire_ts)
+           SELECT %(key)s, %(token)s, now(), now() + %(seconds)s::double precision * interval '1 second'
+           WHERE  NOT EXISTS (
+               SELECT 1 FROM {lox}
+               WHERE  key = %(key)s AND (expire_ts IS NULL OR expire_ts > now())
+           )
+           AND    NOT EXISTS (
+               SELECT 1 FROM {lox_shared}
+               WHERE  key = %(key)s AND token = %(writer)s AND expire_ts > now()
+           )
+           {permits_left}
+           RETURNING acquire_ts, expire_ts;
+        """.format(advisory_lock="pg_advisory_xact_lock" if permits else "pg_advisory_xact_lock_shared",
+                   permits_left="""AND (%(permits)s > ({}))""".format(self.SHARED_COUNT) if permits else "",
+                   **self.tables).format(**self.tables)
+        settings_sql, params = self.local_settings(timeout)
+        sql = settings_sql + sql
+        params.update(namespace=SHARED_LOCK_NAMESPACE, key=key, token=token, seconds=expires_seconds,
+                      writer=WRITER_WAITING_TOKEN, permits=permits)
+        try:
+            with self.cursor(timeout=timeout, autocommit=True) as cursor:
+                cursor.execute(sql, params)
+                row = cursor.fetchone()
+        except QueryCanceledError as ex:
+            raise LockTimeoutException("Timed out acquiring lock {}, it is probably being acquired "
+                                       "by another thread/process.".format(key))
+        if row is None:
+            raise LockInUseException("Lock {} has been acquired (or is wanted) exclusively, or has no permits "
+                                     "left, and is not available.".format(key))
+        return BackendLock(key, lox_name, lock_id, acquire_ts=row[0], expire_ts=row[1], provider_lock=token,
+                           shared=True)
+
+    def acquire_fair(self, lox_name, lock_id, ticket, ticket_seconds, expires_seconds=None, timeout=None):
+        """
+        in one transaction, under the key's advisory lock: drop expired tickets, (re)insert ours, and insert
+        the lox row only if the key is free and ours is the first ticket, deleting it from the line then
+        """
+        key = self.key(lox_name, lock_id)
+        sql = """
+           SELECT pg_advisory_xact_lock(%(namespace)s, hashtext(%(key)s));
+           DELETE FROM {lox_queue} WHERE key = %(key)s AND expire_ts <= now();
+           INSERT INTO {lox_queue} (key, ticket, expire_ts)
+           VALUES (%(key)s, %(ticket)s, now() + %(ticket_seconds)s::double precision * interval '1 second')
+           ON CONFLICT (key, ticket) DO UPDATE
+           SET    expire_ts = EXCLUDED.expire_ts;
+           WITH taken AS (
+               INSERT INTO {lox} AS l (key, acquire_ts, expire_ts)
+               SELECT %(key)s, now(), now() + %(seconds)s::double precision * interval '1 second'
+               WHERE  %(ticket)s = (SELECT ticket FROM {lox_queue} WHERE key = %(key)s ORDER BY seq LIMIT 1)
+               AND    NOT EXISTS (
+                   SELECT 1 FROM {lox_shared} s
+                   WHERE  s.key = %(key)s AND s.token <> %(writer)s AND (s.expire_ts IS NULL OR s.expire_ts > now())
+               )
+               ON CONFLICT (key) DO UPDATE
+               SET    acquire_ts = EXCLUDED.acquire_ts, expire_ts = EXCLUDED.expire_ts
+               WHERE  l.expire_ts <= EXCLUDED.acquire_ts
+               RETURNING acquire_ts, expire_ts
+           ), left_queue AS (
+               DELETE FROM {lox_queue}
+               WHERE  key = %(key)s AND ticket = %(ticket)s AND EXISTS (SELECT 1 FROM taken)
+           )
+           SELECT acquire_ts, expire_ts FROM taken;
+        """.format(**self.tables)
+        settings_sql, params = self.local_settings(timeout)
+        sql = settings_sql + sql
+        params.update(namespace=SHARED_LOCK_NAMESPACE, key=key, ticket=ticket, ticket_seconds=ticket_seconds,
+                      seconds=expires_seconds, writer=WRITER_WAITING_TOKEN)
+        try:
+            with self.cursor(timeout=timeout, autocommit=True) as cursor:
+                cursor.execute(sql, params)
+                row = cursor.fetchone()
+        except QueryCanceledError as ex:
+            raise LockTimeoutException("Timed out acquiring lock {}, it is probably being acquired "
+                                       "by another thread/process.".format(key))
+        if row is None:
+            raise LockInUseException("Lock {} has been acquired previously, or others are in line for it, "
                                      "and is not available.".format(key))
-        else:
-            self.connection.commit()
-            return BackendLock(key, lox_name, lock_id, acquire_ts=acquire_ts, expire_ts=expire_ts)
+        return BackendLock(key, lox_name, lock_id, acquire_ts=row[0], expire_ts=row[1])
+
+    def leave_queue(self, lox_name, lock_id, ticket):
+        key = self.key(lox_name, lock_id)
+        with self.cursor(autocommit=True) as cursor:
+            cursor.execute(self.local_settings()[0] + """
+               DELETE FROM {lox_queue} WHERE key = %(key)s AND ticket = %(ticket)s;
+            """.format(**self.tables) + self.statements[WAKE_QUEUE_HEADS].text_sql,
+                dict(key=key, ticket=ticket, ticket_prefix=TICKET_CHANNEL_PREFIX, released=[key]))
+
+    # how many live shared holders the key in the %(key)s param has, once formatted with the tables
+    SHARED_COUNT = """
+               SELECT count(*) FROM {lox_shared}
+               WHERE  key = %(key)s AND token <> %(writer)s AND (expire_ts IS NULL OR expire_ts > now())
+    """
 
     def release(self, lock):
         """
@@ -126,22 +817,184 @@ class PostgresLoxBackend(BaseLoxBackend):
         delete the corresponding row
         commit and return None
         """
-        self.cursor.execute("""
-           DELETE FROM lox
-           WHERE key = %s and acquire_ts = %s;
-        """, (lock.key, lock.acquire_ts)
-        )
-        self.connection.commit()
+        self.release_many([lock])
+
+    def release_many(self, locks):
+        """
+        delete the rows for a group of BackendLocks in one round trip, whichever their modes
+        rows that were taken over after expiring belong to someone else and are left alone
+        """
+        statements = []
+        params = dict(released=[lock.key for lock in locks], channel=RELEASE_CHANNEL,
+                      ticket_prefix=TICKET_CHANNEL_PREFIX)
+        exclusive = [lock for lock in locks if not lock.shared]
+        if exclusive:
+            statements.append(RELEASE_KEYS)
+            params.update(keys=[lock.key for lock in exclusive], acquire_ts=[lock.acquire_ts for lock in exclusive])
+        shared = [lock for lock in locks if lock.shared]
+        if shared:
+            statements.append(RELEASE_SHARED)
+            params.update(shared_keys=[lock.key for lock in shared], tokens=[lock.provider_lock for lock in shared])
+        if self.config.get("wait_for_release", False):
+            # delivered to listeners when the implicit transaction commits, in the same round trip as the delete
+            statements.append(NOTIFY_RELEASED)
+        # fair waiters are woken up whatever the config, one per key
+        statements.append(WAKE_QUEUE_HEADS)
+        with self.cursor(autocommit=True) as cursor:
+            self.execute(cursor, statements, params)
+
+    def extend_many(self, locks, expires_seconds):
+        """
+        push out expire_ts for a group of BackendLocks in one round trip, with an UPDATE of each table
+        they have rows in, as CTEs of a single autocommit statement
+        rows that already expired (or were taken over) are not ours any more, and are returned as lost
+        """
+        exclusive = [(lock, seconds) for lock, seconds in zip(locks, expires_seconds) if not lock.shared]
+        shared = [(lock, seconds) for lock, seconds in zip(locks, expires_seconds) if lock.shared]
+        updates, params = [], ()
+        if exclusive:
+            values = ", ".join(["""(%s, %s::timestamptz, %s::double precision)"""] * len(exclusive))
+            updates.append("""
+                   UPDATE {lox} AS l
+                   SET    expire_ts = now() + renew.seconds * interval '1 second'
+                   FROM   (VALUES {values}) AS renew (key, acquire_ts, seconds)
+                   WHERE  l.key = renew.key AND l.acquire_ts = renew.acquire_ts
+                   AND    (l.expire_ts IS NULL OR l.expire_ts > now())
+                   RETURNING l.key, NULL::text AS token, l.expire_ts
+            """.format(values=values, **self.tables))
+            params += tuple(param for lock, seconds in exclusive for param in (lock.key, lock.acquire_ts, seconds))
+        if shared:
+            values = ", ".join(["""(%s, %s, %s::double precision)"""] * len(shared))
+            updates.append("""
+                   UPDATE {lox_shared} AS s
+                   SET    expire_ts = now() + renew.seconds * interval '1 second'
+                   FROM   (VALUES {values}) AS renew (key, token, seconds)
+                   WHERE  s.key = renew.key AND s.token = renew.token
+                   AND    (s.expire_ts IS NULL OR s.expire_ts > now())
+                   RETURNING s.key, s.token, s.expire_ts
+            """.format(values=values, **self.tables))
+            params += tuple(param for lock, seconds in shared for param in (lock.key, lock.provider_lock, seconds))
+        sql = self.local_settings()[0] + "WITH " + ", ".join(
+            "renewed_{} AS ({})".format(i, update) for i, update in enumerate(updates)) + " " + " UNION ALL ".join(
+            "SELECT * FROM renewed_{}".format(i) for i in range(len(updates))) + ";"
+        with self.cursor(autocommit=True) as cursor:
+            cursor.execute(sql, params)
+            # (key, token) -> new expire_ts, where exclusive locks have no token
+            renewed = dict(((key, token), expire_ts) for key, token, expire_ts in cursor.fetchall())
+        lost = []
+        for lock in locks:
+            renewed_key = lock.key, lock.provider_lock if lock.shared else None
+            if renewed_key in renewed:
+                lock.expire_ts = renewed[renewed_key]
+            else:
+                lost.append(lock)
+        return lost
+
+    def wait_for_release(self, lox_name, lock_id, timeout, shared=False, permits=None, ticket=None):
+        """
+        Wait for a release notification from the backend's listener, returning when the lock's key
+        is announced, when it turns out to be free already (for the mode we want), or after timeout seconds.
+        Fair waiters wait on their ticket's own channel instead, which is only notified when it's their turn.
+        Only the check for a key that is free already takes a pooled connection, and only for one round trip.
+        """
+        key = self.key(lox_name, lock_id)
+        if ticket is None:
+            channel, payload = RELEASE_CHANNEL, key
+        else:
+            channel, payload = TICKET_CHANNEL_PREFIX + ticket, None
+        deadline = time.time() + timeout
+        event = self.listener.subscribe(channel, payload)
+        try:
+            # it may have been released between the failed acquire and the LISTEN
+            held_sql, held_params = self.held_query(key, shared=shared, permits=permits, ticket=ticket)
+            try:
+                with self.cursor(timeout=max(deadline - time.time(), 0), autocommit=True) as cursor:
+                    cursor.execute(held_sql, held_params)
+                    held = cursor.fetchone()[0]
+            except LockTimeoutException:
+                # the pool stayed busy for the whole wait: just try again
+                return
+            if held:
+                event.wait(max(deadline - time.time(), 0))
+        finally:
+            self.listener.unsubscribe(channel, payload, event)
+
+    def held_query(self, key, shared=False, permits=None, ticket=None):
+        """
+        SQL and params for a query returning whether the lock for key is currently held, in a way that keeps
+        out an acquire in the mode we want: exclusively or by shared holders, or for shared, by a waiting writer
+        (or for a semaphore permit, by as many shared holders as there are permits).
+        With ticket, it is also held while another ticket is first in line.
+        """
+        return """
+            SELECT EXISTS (
+                SELECT 1 FROM {lox}
+                WHERE key = %(key)s AND (expire_ts IS NULL OR expire_ts > now())
+            ) OR EXISTS (
+                SELECT 1 FROM {lox_shared}
+                WHERE key = %(key)s AND (token = %(writer)s) = %(shared)s
+                AND (expire_ts IS NULL OR expire_ts > now())
+            ) {permits_used} {queued};
+        """.format(permits_used="""OR %(permits)s <= ({})""".format(self.SHARED_COUNT) if permits else "",
+                   queued="""OR %(ticket)s <> (
+                SELECT ticket FROM {lox_queue}
+                WHERE key = %(key)s AND expire_ts > now() ORDER BY seq LIMIT 1
+            )""" if ticket else "", **self.tables).format(**self.tables), \
+            dict(key=key, writer=WRITER_WAITING_TOKEN, shared=shared, permits=permits, ticket=ticket)
+
+    ## ------- expiration ------- ##
+
+    def sweep_expired(self):
+        """
+        Bulk delete expired rows, returning how many there were.
+        Only tidies up the table: acquire already treats expired rows as free.
+        """
+        with self.cursor() as cursor:
+            cursor.execute(self.local_settings()[0] + """
+               DELETE FROM {lox}
+               WHERE expire_ts <= now();
+            """.format(**self.tables))
+            swept = cursor.rowcount
+            cursor.execute("""
+               DELETE FROM {lox_shared}
+               WHERE expire_ts <= now();
+            """.format(**self.tables))
+            swept += cursor.rowcount
+            cursor.execute("""
+               DELETE FROM {lox_queue}
+               WHERE expire_ts <= now();
+            """.format(**self.tables))
+            return swept + cursor.rowcount
+
+    def start_sweeper(self):
+        interval = self.config.get("postgres_sweep_interval_seconds")
+        if not interval or self._sweeper:
+            return
+        self._sweeper_stop.clear()
+        self._sweeper = threading.Thread(target=self.__sweep_forever, args=(interval,), name="lox-sweeper")
+        self._sweeper.daemon = True
+        self._sweeper.start()
+
+    def __sweep_forever(self, interval):
+        while not self._sweeper_stop.wait(interval):
+            try:
+                self.sweep_expired()
+            except (psycopg2.Error, LockTimeoutException):
+                # the database may be briefly unavailable; try again next time
+                pass
 
     def clear(self, lox_name, lock_id):
         """
         similar to release, but not dependent on lock tuple
         """
         key = self.key(lox_name, lock_id)
-        self.cursor.execute("""
-           DELETE FROM lox
-           WHERE key = %s;
-        """, (key,)
-        )
-        self.connection.commit()
-
+        with self.cursor() as cursor:
+            cursor.execute(self.local_settings()[0] + """
+               DELETE FROM {lox}
+               WHERE key = %s;
+               DELETE FROM {lox_shared}
+               WHERE key = %s;
+               DELETE FROM {lox_queue}
+               WHERE key = %s;
+            """.format(**self.tables), (key, key, key)
+            )
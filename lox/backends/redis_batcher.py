@@ -0,0 +1,101 @@
+from __future__ import unicode_literals
+
+import threading
+
+from redis.exceptions import NoScriptError
+
+# the most script calls one shared round trip carries
+MAX_BATCH_CALLS = 256
+
+
+def run_pipelined(connection, calls):
+    """
+    Run script calls, [(Script, keys, args)], in one pipeline, by SHA, and return their results in order,
+    with errors in place rather than raised. A script the server has lost (after a SCRIPT FLUSH, or a
+    failover) is loaded again, and the calls that needed it are rerun; the others are never run twice.
+    redis-py's own script support would check every script with SCRIPT EXISTS first, another round trip.
+    """
+    results = [None] * len(calls)
+    pending = list(range(len(calls)))
+    reloaded = False
+    while True:
+        pipeline = connection.pipeline(transaction=False)
+        for i in pending:
+            script, keys, args = calls[i]
+            pipeline.evalsha(script.sha, len(keys), *(list(keys) + list(args)))
+        for i, result in zip(pending, pipeline.execute(raise_on_error=False)):
+            results[i] = result
+        lost = [i for i in pending if isinstance(results[i], NoScriptError)]
+        if not lost or reloaded:
+            return results
+        for script in set(calls[i][0] for i in lost):
+            connection.script_load(script.script)
+        pending, reloaded = lost, True
+
+
+class ScriptBatcher(object):
+    """
+    Lets threads that share a connection pool share round trips too: each caller queues its script calls,
+    and whoever finds nobody sending sends everything queued so far (up to MAX_BATCH_CALLS) in one pipeline,
+    then hands every caller its own results. A caller that is alone goes out right away; under load,
+    each round trip carries many threads' calls, which saves both network and client time.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.condition = threading.Condition()
+        self.queued = []
+        self.sending = False
+
+    def run(self, calls):
+        """ Run [(Script, keys, args)], returning their results, and raising the first error among them. """
+        request = BatchedRequest(calls)
+        with self.condition:
+            self.queued.append(request)
+        while True:
+            with self.condition:
+                while self.sending and not request.done:
+                    self.condition.wait()
+                if request.done:
+                    return request.results()
+                self.sending = True
+                batch, size = [], 0
+                while self.queued and (not batch or size + len(self.queued[0].calls) <= MAX_BATCH_CALLS):
+                    batch.append(self.queued.pop(0))
+                    size += len(batch[-1].calls)
+            try:
+                self.send(batch)
+            finally:
+                with self.condition:
+                    self.sending = False
+                    self.condition.notify_all()
+
+    def send(self, batch):
+        try:
+            results = run_pipelined(self.connection, [call for request in batch for call in request.calls])
+        except BaseException as ex:
+            # the whole round trip failed, e.g. the connection did
+            for request in batch:
+                request.error, request.done = ex, True
+            return
+        for request in batch:
+            request.response, results = results[:len(request.calls)], results[len(request.calls):]
+            request.done = True
+
+
+class BatchedRequest(object):
+    """ One caller's script calls, waiting in a ScriptBatcher's queue, and then their results. """
+
+    def __init__(self, calls):
+        self.calls = calls
+        self.response = None
+        self.error = None
+        self.done = False
+
+    def results(self):
+        if self.error is not None:
+            raise self.error
+        for result in self.response:
+            if isinstance(result, Exception):
+                raise result
+        return self.response
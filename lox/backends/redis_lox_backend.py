@@ -1,35 +1,229 @@
 from __future__ import unicode_literals
 
+import time
+
 from redis import StrictRedis
-from redis.lock import Lock
+from redis.exceptions import ConnectionError, TimeoutError
 
 from lox.core.errors import *
-from base_lox_backend import BaseLoxBackend, BackendLock
+from lox.core.ids import new_id
+from lox.backends.base_lox_backend import BaseLoxBackend, BackendLock
+from lox.backends import redis_scripts
+from lox.backends.redis_batcher import ScriptBatcher, run_pipelined
+
+RELEASE_CHANNEL_PREFIX = "lox:released:"
+# keyspace events that mean the lock key is gone (only sent if the server has notify-keyspace-events on)
+KEYSPACE_RELEASE_EVENTS = {b"del", b"expired", b"evicted"}
 
 class RedisLoxBackend(BaseLoxBackend):
     """
     A lox provider that uses Redis as the backend lock store.
     Redis takes care of a lot of the details, including expiration, etc.
+    Every operation is one server-side script (see redis_scripts), including shared and fair locks.
+    The scripts are loaded when connecting, and called by SHA. With the "redis_pipelining" config setting,
+    script calls from all the threads sharing the backend are sent together in pipelines (see ScriptBatcher).
+    redis-py has no per-command timeouts, so acquire deadlines are bounded by the
+    "redis_socket_timeout" config setting rather than the remaining budget itself.
     """
 
     server_handles_expiration = True
 
     def connect(self):
         url = self.config["backend"]["redis"]
-        self.connection = StrictRedis.from_url(url)
+        socket_timeout = self.config.get("redis_socket_timeout")
+        self.connection = StrictRedis.from_url(url, socket_timeout=socket_timeout,
+                                               socket_connect_timeout=socket_timeout)
+        self.acquire_many_script = self.connection.register_script(redis_scripts.ACQUIRE_MANY)
+        self.release_many_script = self.connection.register_script(redis_scripts.RELEASE_MANY)
+        self.extend_many_script = self.connection.register_script(redis_scripts.EXTEND_MANY)
+        self.acquire_shared_script = self.connection.register_script(redis_scripts.ACQUIRE_SHARED)
+        self.release_shared_script = self.connection.register_script(redis_scripts.RELEASE_SHARED)
+        self.extend_shared_script = self.connection.register_script(redis_scripts.EXTEND_SHARED)
+        self.acquire_fair_script = self.connection.register_script(redis_scripts.ACQUIRE_FAIR)
+        self.leave_queue_script = self.connection.register_script(redis_scripts.LEAVE_QUEUE)
+        self.batcher = ScriptBatcher(self.connection) if self.config.get("redis_pipelining", False) else None
+        self.load_scripts()
 
-    def acquire(self, lox_name, lock_id, expires_seconds=None):
-        key = self.key(lox_name, lock_id)
-        lock = Lock(self.connection, key, timeout=expires_seconds)
+    def load_scripts(self):
+        """ Load every script in one round trip, so that none of them has to be sent along with a call. """
+        scripts = [self.acquire_many_script, self.release_many_script, self.extend_many_script,
+                   self.acquire_shared_script, self.release_shared_script, self.extend_shared_script,
+                   self.acquire_fair_script, self.leave_queue_script]
+        pipeline = self.connection.pipeline(transaction=False)
+        for script in scripts:
+            pipeline.script_load(script.script)
+        try:
+            pipeline.execute()
+        except (ConnectionError, TimeoutError):
+            # the server may just be unreachable for now; calls load what they need then
+            pass
+
+    def run_scripts(self, calls):
+        """
+        Run script calls, [(Script, keys, args)], returning their results: in one round trip, through the
+        batcher if there is one, in a pipeline of their own if there are several, or else as a plain EVALSHA.
+        """
+        if self.batcher is not None:
+            return self.batcher.run(calls)
+        if len(calls) == 1:
+            script, keys, args = calls[0]
+            return [script(keys=keys, args=args)]
+        results = run_pipelined(self.connection, calls)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def run_script(self, script, keys, args):
+        return self.run_scripts([(script, keys, args)])[0]
+
+    def acquire(self, lox_name, lock_id, expires_seconds=None, timeout=None):
         # retry logic is handled in core.lock, so no blocking here
-        if lock.acquire(blocking=False):
-            return BackendLock(key, lox_name, lock_id, provider_lock=lock)
-        else:
-            raise LockInUseException("Lock {} has been acquired previously, possibly by another thread/process, and is not available.".format(key))
+        return self.acquire_many(lox_name, [lock_id], expires_seconds=expires_seconds)[0]
 
     def release(self, lock):
-        return lock.provider_lock.release()
+        self.release_many([lock])
+
+    @staticmethod
+    def px(seconds):
+        """ An expiration in milliseconds for the scripts, where 0 means none. """
+        return max(int(seconds * 1000), 1) if seconds else 0
+
+    def acquire_many(self, lox_name, lock_ids, expires_seconds=None, timeout=None):
+        """
+        Check and set every key in one server-side script, so the group costs one round trip
+        and nobody can take one of the keys halfway through. A key that is held shared is in use too.
+        """
+        keys = [self.key(lox_name, lock_id) for lock_id in lock_ids]
+        token = new_id()
+        preference = self.px(self.writer_preference_seconds)
+        in_use = self.run_script(self.acquire_many_script, keys, [token, self.px(expires_seconds), preference])
+        if in_use:
+            raise LockInUseException("Lock {} has been acquired previously, possibly by another thread/process, "
+                                     "and is not available.".format(keys[in_use - 1]))
+        return [BackendLock(key, lox_name, lock_id, provider_lock=token) for key, lock_id in zip(keys, lock_ids)]
+
+    def acquire_shared(self, lox_name, lock_id, expires_seconds=None, timeout=None, permits=None):
+        key = self.key(lox_name, lock_id)
+        token = new_id()
+        if self.run_script(self.acquire_shared_script, [key], [token, self.px(expires_seconds), permits or 0]):
+            raise LockInUseException("Lock {} has been acquired (or is wanted) exclusively, or has no permits "
+                                     "left, and is not available.".format(key))
+        return BackendLock(key, lox_name, lock_id, provider_lock=token, shared=True)
+
+    def acquire_fair(self, lox_name, lock_id, ticket, ticket_seconds, expires_seconds=None, timeout=None):
+        """ Queue up and take the key if it's our turn in one script; the ticket doubles as the owner token. """
+        key = self.key(lox_name, lock_id)
+        if self.run_script(self.acquire_fair_script, [key], [ticket, self.px(expires_seconds), self.px(ticket_seconds)]):
+            raise LockInUseException("Lock {} has been acquired previously, or others are in line for it, "
+                                     "and is not available.".format(key))
+        return BackendLock(key, lox_name, lock_id, provider_lock=ticket)
+
+    def leave_queue(self, lox_name, lock_id, ticket):
+        self.run_script(self.leave_queue_script, [self.key(lox_name, lock_id)], [ticket])
+
+    def release_many(self, locks):
+        """
+        Compare-and-delete every key in one script, publishing releases too if configured.
+        Shared locks take a script of their own, in the same round trip.
+        """
+        channel_prefix = RELEASE_CHANNEL_PREFIX if self.config.get("wait_for_release", False) else ""
+        self.run_scripts([(script, [lock.key for lock in group], [channel_prefix] + [lock.provider_lock for lock in group])
+                          for script, group in self.by_mode(locks, self.release_many_script,
+                                                            self.release_shared_script)])
+
+    def extend_many(self, locks, expires_seconds):
+        """
+        Reset the TTL of every key (or share of one) we still own in one script.
+        Returns the locks that were lost, i.e. expired or taken by someone else.
+        """
+        seconds_by_lock = dict((id(lock), seconds) for lock, seconds in zip(locks, expires_seconds))
+        groups = self.by_mode(locks, self.extend_many_script, self.extend_shared_script)
+        calls = []
+        for script, group in groups:
+            args = []
+            for lock in group:
+                args += [lock.provider_lock, self.px(seconds_by_lock[id(lock)])]
+            calls.append((script, [lock.key for lock in group], args))
+        lost = []
+        for (script, group), indexes in zip(groups, self.run_scripts(calls)):
+            lost += [group[i - 1] for i in indexes]
+        return lost
+
+    @staticmethod
+    def by_mode(locks, exclusive_script, shared_script):
+        """ [(script, locks)] for the exclusive and the shared ones among locks, leaving out an empty group. """
+        groups = [(exclusive_script, [lock for lock in locks if not lock.shared]),
+                  (shared_script, [lock for lock in locks if lock.shared])]
+        return [(script, group) for script, group in groups if group]
 
     def clear(self, lox_name, lock_id):
+        """ Delete the key, along with its shared holders, waiting writer and line of waiters. """
+        key = self.key(lox_name, lock_id)
+        holders = key + redis_scripts.SHARED_SUFFIX
+        queue = key + redis_scripts.QUEUE_SUFFIX
+        holder_keys = ["{}:{}".format(holders, token.decode("utf-8")) for token in self.connection.smembers(holders)]
+        ticket_keys = ["{}:{}".format(queue, ticket.decode("utf-8")) for ticket in self.connection.zrange(queue, 0, -1)]
+        self.connection.delete(key, holders, key + redis_scripts.WRITER_SUFFIX, queue, queue + ":seq",
+                               *(holder_keys + ticket_keys))
+
+    ## ------- release notifications ------- ##
+
+    @staticmethod
+    def release_channel(key):
+        return "{}{}".format(RELEASE_CHANNEL_PREFIX, key)
+
+    def keyspace_channel(self, key):
+        db = self.connection.connection_pool.connection_kwargs.get("db", 0)
+        return "__keyspace@{}__:{}".format(db, key)
+
+    def wait_for_release(self, lox_name, lock_id, timeout, shared=False, permits=None, ticket=None):
+        """
+        Subscribe to the lock's release channel (and its keyspace channel, which catches TTL expiry
+        when the server publishes keyspace events), and return as soon as either says the key is gone.
+        Exclusive waiters also look out for shared holders, and shared waiters for a waiting writer.
+        Semaphore waiters also wait while all permits are taken, and for any permit's key to expire.
+        Fair waiters subscribe to their ticket's channel instead, which is only published on when it's their turn.
+        """
         key = self.key(lox_name, lock_id)
-        self.connection.delete(key)
+        holders = key + redis_scripts.SHARED_SUFFIX
+        blockers = [key, key + redis_scripts.WRITER_SUFFIX if shared else holders]
+        keyspace_channels = [self.keyspace_channel(blocker) for blocker in blockers]
+        deadline = time.time() + timeout
+        pubsub = self.connection.pubsub(ignore_subscribe_messages=True)
+        try:
+            if ticket is None:
+                pubsub.subscribe(self.release_channel(key), *keyspace_channels)
+            else:
+                pubsub.subscribe(redis_scripts.TICKET_CHANNEL_PREFIX + ticket, *keyspace_channels)
+            if permits:
+                # any event on a permit's own key (mostly: it expired) may have freed one up
+                pubsub.psubscribe(self.keyspace_channel(holders + ":*"))
+            # it may have been released between the failed acquire and the subscribe
+            pipeline = self.connection.pipeline(transaction=False)
+            for blocker in blockers:
+                pipeline.exists(blocker)
+            if permits:
+                pipeline.scard(holders)
+            if ticket is not None:
+                pipeline.zrange(key + redis_scripts.QUEUE_SUFFIX, 0, 0)
+            in_use = pipeline.execute()
+            if permits:
+                in_use[-1] = in_use[-1] >= permits
+            if ticket is not None:
+                # someone else's turn
+                in_use[-1] = in_use[-1] not in ([], [ticket.encode("utf-8")])
+            if not any(in_use):
+                return
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                message = pubsub.get_message(timeout=remaining)
+                if not message:
+                    continue
+                channel = message["channel"].decode("utf-8")
+                if channel not in keyspace_channels or message["data"] in KEYSPACE_RELEASE_EVENTS:
+                    return
+        finally:
+            pubsub.close()
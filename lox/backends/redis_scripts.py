@@ -0,0 +1,230 @@
+"""
+Lua scripts for the Redis backends. Every lock key holds its owner's token,
+so only the owner can release it.
+
+Shared holders of a lock are the set at the lock key plus SHARED_SUFFIX, of their tokens, and each
+of them also has a key of its own, that set's key plus ":" plus the token, which carries its expiration.
+A member whose own key is gone has expired, and is dropped by whichever script comes across it.
+An exclusive acquire that finds shared holders may set the lock key plus WRITER_SUFFIX, to keep
+new shared holders out for a while. The scripts derive these keys from the lock keys themselves.
+
+The line of waiters for a fair lock is the sorted set at the lock key plus QUEUE_SUFFIX, of their tickets
+scored by arrival (counted at that key plus ":seq"), and like shared holders, each ticket has a key of its own
+for its expiration. Releases publish on the channel TICKET_CHANNEL_PREFIX plus the ticket at the head of
+the line, so that only that waiter is woken up.
+"""
+
+from __future__ import unicode_literals
+
+SHARED_SUFFIX = ":shared"
+WRITER_SUFFIX = ":writer"
+QUEUE_SUFFIX = ":queue"
+TICKET_CHANNEL_PREFIX = "lox:ticket:"
+
+# Lua: whether the shared holders set has any live members, dropping the expired ones it finds
+SHARED_IN_USE = """
+local function shared_in_use(holders)
+    for _, token in ipairs(redis.call('smembers', holders)) do
+        if redis.call('exists', holders .. ':' .. token) == 1 then
+            return true
+        end
+        redis.call('srem', holders, token)
+    end
+    return false
+end
+"""
+
+# Lua: how many live members the shared holders set has, dropping the expired ones
+SHARED_COUNT = """
+local function shared_count(holders)
+    local count = 0
+    for _, token in ipairs(redis.call('smembers', holders)) do
+        if redis.call('exists', holders .. ':' .. token) == 1 then
+            count = count + 1
+        else
+            redis.call('srem', holders, token)
+        end
+    end
+    return count
+end
+"""
+
+# Lua: the live ticket at the head of a fair lock's line, dropping expired ones off the front, or nil,
+# and wake_queue_head, which tells that ticket's waiter it's its turn
+QUEUE_HEAD = """
+local function queue_head(queue)
+    while true do
+        local head = redis.call('zrange', queue, 0, 0)[1]
+        if not head or redis.call('exists', queue .. ':' .. head) == 1 then
+            return head
+        end
+        redis.call('zrem', queue, head)
+    end
+end
+
+local function wake_queue_head(key)
+    local head = queue_head(key .. ':queue')
+    if head then
+        redis.call('publish', '""" + TICKET_CHANNEL_PREFIX + """' .. head, '')
+    end
+end
+"""
+
+# KEYS: the lock keys
+# ARGV[1]: owner token, ARGV[2]: expiration in milliseconds, or 0 for none
+# ARGV[3] (optional): if a key is held shared, keep new shared holders out for this many milliseconds
+# returns 0 if every key was set, otherwise the (1-based) index of the first key that is in use
+ACQUIRE_MANY = SHARED_IN_USE + """
+for i, key in ipairs(KEYS) do
+    if redis.call('exists', key) == 1 then
+        return i
+    end
+    if shared_in_use(key .. ':shared') then
+        local preference = tonumber(ARGV[3] or '0')
+        if preference > 0 then
+            redis.call('set', key .. ':writer', 1, 'px', preference)
+        end
+        return i
+    end
+end
+local px = tonumber(ARGV[2])
+for i, key in ipairs(KEYS) do
+    if px > 0 then
+        redis.call('set', key, ARGV[1], 'px', px)
+    else
+        redis.call('set', key, ARGV[1])
+    end
+    redis.call('del', key .. ':writer')
+end
+return 0
+"""
+
+# KEYS[1]: the lock key
+# ARGV[1]: owner token, ARGV[2]: expiration in milliseconds, or 0 for none
+# ARGV[3] (optional): how many shared holders there may be at most (semaphore permits), or 0 for any number
+# returns 0 if it was taken, 1 if the key is held exclusively, a writer is waiting for it or no permits are left
+ACQUIRE_SHARED = SHARED_COUNT + """
+local key = KEYS[1]
+if redis.call('exists', key) == 1 or redis.call('exists', key .. ':writer') == 1 then
+    return 1
+end
+local holders = key .. ':shared'
+local permits = tonumber(ARGV[3] or '0')
+if permits > 0 and shared_count(holders) >= permits then
+    return 1
+end
+redis.call('sadd', holders, ARGV[1])
+local px = tonumber(ARGV[2])
+if px > 0 then
+    redis.call('set', holders .. ':' .. ARGV[1], 1, 'px', px)
+else
+    redis.call('set', holders .. ':' .. ARGV[1], 1)
+end
+return 0
+"""
+
+# KEYS[1]: the lock key
+# ARGV[1]: ticket, which is also the owner token if it's taken, ARGV[2]: expiration in milliseconds, or 0 for none
+# ARGV[3]: how long the ticket keeps its place in line, in milliseconds
+# returns 0 if it was taken, 1 if it is in use or another ticket is ahead of ours
+ACQUIRE_FAIR = SHARED_IN_USE + QUEUE_HEAD + """
+local key, ticket = KEYS[1], ARGV[1]
+local queue = key .. ':queue'
+if not redis.call('zscore', queue, ticket) then
+    redis.call('zadd', queue, redis.call('incr', queue .. ':seq'), ticket)
+end
+redis.call('set', queue .. ':' .. ticket, 1, 'px', ARGV[3])
+if queue_head(queue) ~= ticket or redis.call('exists', key) == 1 or shared_in_use(key .. ':shared') then
+    return 1
+end
+local px = tonumber(ARGV[2])
+if px > 0 then
+    redis.call('set', key, ticket, 'px', px)
+else
+    redis.call('set', key, ticket)
+end
+redis.call('zrem', queue, ticket)
+redis.call('del', queue .. ':' .. ticket)
+if redis.call('zcard', queue) == 0 then
+    redis.call('del', queue .. ':seq')
+end
+return 0
+"""
+
+# KEYS[1]: the lock key
+# ARGV[1]: the ticket leaving the line
+LEAVE_QUEUE = QUEUE_HEAD + """
+local queue = KEYS[1] .. ':queue'
+redis.call('zrem', queue, ARGV[1])
+redis.call('del', queue .. ':' .. ARGV[1])
+wake_queue_head(KEYS[1])
+return 0
+"""
+
+# KEYS: the lock keys
+# ARGV[1]: release channel prefix to publish each key on, or ''; every shared release is published,
+# since one freed permit is enough for a semaphore waiter
+# ARGV[2...]: owner token for each key
+RELEASE_SHARED = QUEUE_HEAD + """
+for i, key in ipairs(KEYS) do
+    local holders = key .. ':shared'
+    redis.call('srem', holders, ARGV[i + 1])
+    redis.call('del', holders .. ':' .. ARGV[i + 1])
+    if ARGV[1] ~= '' then
+        redis.call('publish', ARGV[1] .. key, '')
+    end
+    wake_queue_head(key)
+end
+return 0
+"""
+
+# KEYS: the lock keys
+# ARGV: owner token and new expiration in milliseconds, for each key in turn
+# returns the (1-based) indexes of the keys we were no longer a shared holder of
+EXTEND_SHARED = """
+local lost = {}
+for i, key in ipairs(KEYS) do
+    local holder = key .. ':shared:' .. ARGV[i * 2 - 1]
+    if redis.call('exists', holder) == 1 then
+        redis.call('pexpire', holder, ARGV[i * 2])
+    else
+        redis.call('srem', key .. ':shared', ARGV[i * 2 - 1])
+        table.insert(lost, i)
+    end
+end
+return lost
+"""
+
+# KEYS: the lock keys
+# ARGV[1]: release channel prefix to publish each released key on, or '' for no notifications
+# ARGV[2...]: owner token for each key
+# returns how many keys were still owned and got deleted
+RELEASE_MANY = QUEUE_HEAD + """
+local released = 0
+for i, key in ipairs(KEYS) do
+    if redis.call('get', key) == ARGV[i + 1] then
+        redis.call('del', key)
+        released = released + 1
+        if ARGV[1] ~= '' then
+            redis.call('publish', ARGV[1] .. key, '')
+        end
+        wake_queue_head(key)
+    end
+end
+return released
+"""
+
+# KEYS: the lock keys
+# ARGV: owner token and new expiration in milliseconds, for each key in turn
+# returns the (1-based) indexes of the keys that were no longer owned
+EXTEND_MANY = """
+local lost = {}
+for i, key in ipairs(KEYS) do
+    if redis.call('get', key) == ARGV[i * 2 - 1] then
+        redis.call('pexpire', key, ARGV[i * 2])
+    else
+        table.insert(lost, i)
+    end
+end
+return lost
+"""
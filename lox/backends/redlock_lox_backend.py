@@ -0,0 +1,210 @@
+from __future__ import unicode_literals
+
+from multiprocessing.pool import ThreadPool
+import time
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+from redis import StrictRedis
+from redis.exceptions import RedisError
+
+from lox.core.errors import *
+from lox.core.ids import new_id
+from lox.core.retry import monotonic
+from lox.backends.base_lox_backend import BaseLoxBackend, BackendLock
+from lox.backends import redis_scripts
+
+# how much the nodes' clocks may drift apart, as a fraction of the expiration
+DEFAULT_CLOCK_DRIFT_FACTOR = 0.01
+# plus a couple of milliseconds for the resolution of redis' own expiration
+CLOCK_DRIFT_MIN_SECONDS = 0.002
+# how long a node may take to connect or answer before it counts as down, unless "redis_socket_timeout" is set:
+# a small fraction of any sensible expiration, so one slow node doesn't eat into the others' validity
+DEFAULT_SOCKET_TIMEOUT_SECONDS = 0.1
+# worker pools a forked child inherited: their threads stayed in the parent, so the child never hands
+# them work, and keeps them around rather than have them terminated when garbage collected
+_inherited = []
+
+class RedlockLoxBackend(BaseLoxBackend):
+    """
+    A lox provider that uses several independent Redis nodes, per the Redlock algorithm.
+    A lock is held if it was set on a majority of the nodes within its expiration, less the time
+    that took and an allowance for clock drift: that is how long it is valid for, and what
+    BackendLock.expire_ts reports. Every command goes out to all the nodes at once, and acquires
+    and extends return as soon as their outcome is decided, so they cost about one round trip to the
+    slowest node of a majority, not one per node. Nodes that don't answer within "redis_socket_timeout"
+    (default DEFAULT_SOCKET_TIMEOUT_SECONDS) count as down, and an acquire stops waiting for answers
+    once the lock could no longer be valid: if a majority is reached too late, LockValidityException is raised.
+    Configure with {"backend": {"redis_quorum": [url, url, url, ...]}}.
+    Shared locks are not supported.
+    """
+
+    server_handles_expiration = True
+
+    def connect(self):
+        urls = self.config["backend"]["redis_quorum"]
+        if len(urls) < 1:
+            raise BackendConfigException("redis_quorum needs at least one Redis URL.")
+        self.socket_timeout = socket_timeout = self.config.get("redis_socket_timeout", DEFAULT_SOCKET_TIMEOUT_SECONDS)
+        self.nodes = [StrictRedis.from_url(url, socket_timeout=socket_timeout, socket_connect_timeout=socket_timeout)
+                      for url in urls]
+        self.quorum = len(self.nodes) // 2 + 1
+        self.clock_drift_factor = self.config.get("redlock_clock_drift_factor", DEFAULT_CLOCK_DRIFT_FACTOR)
+        self.acquire_many_scripts = [node.register_script(redis_scripts.ACQUIRE_MANY) for node in self.nodes]
+        self.release_many_scripts = [node.register_script(redis_scripts.RELEASE_MANY) for node in self.nodes]
+        self.extend_many_scripts = [node.register_script(redis_scripts.EXTEND_MANY) for node in self.nodes]
+        # a worker per node, so a slow node only holds up its own commands, and never those for the others
+        self.pools = [ThreadPool(1) for node in self.nodes]
+
+    def close(self):
+        super(RedlockLoxBackend, self).close()
+        for pool in self.pools:
+            pool.terminate()
+
+    def abandon(self):
+        """ In a forked child: the pools' workers didn't come along, see _inherited. """
+        super(RedlockLoxBackend, self).abandon()
+        _inherited.extend(self.pools)
+        self.pools = []
+
+    def fan_out(self, command, decided=None, timeout=None):
+        """
+        Run command(i) for every node index i concurrently.
+        Returns a list of (result, error) pairs in the order the nodes answered; an unreachable node is
+        just an error. With decided, a function of the pairs so far, returns as soon as it is true
+        rather than waiting for every node, and with timeout, once that many seconds have passed;
+        the answers of the nodes left behind are dropped.
+        """
+        answers = Queue()
+
+        def run(i):
+            try:
+                answers.put((command(i), None))
+            except Exception as ex:
+                answers.put((None, ex))
+
+        for i in range(len(self.nodes)):
+            self.pools[i].apply_async(run, (i,))
+        deadline = monotonic() + timeout if timeout is not None else None
+        results = []
+        while len(results) < len(self.nodes):
+            try:
+                if deadline is None:
+                    result, error = answers.get()
+                else:
+                    result, error = answers.get(timeout=max(deadline - monotonic(), 0))
+            except Empty:
+                break
+            if error is not None and not isinstance(error, RedisError):
+                raise error
+            results.append((result, error))
+            if decided is not None and decided(results):
+                break
+        return results
+
+    def validity_seconds(self, expires_seconds, started):
+        """ How long a lock set since started is still safe to hold, given clock drift. """
+        drift = expires_seconds * self.clock_drift_factor + CLOCK_DRIFT_MIN_SECONDS
+        return expires_seconds - (monotonic() - started) - drift
+
+    def acquire(self, lox_name, lock_id, expires_seconds=None, timeout=None):
+        return self.acquire_many(lox_name, [lock_id], expires_seconds=expires_seconds, timeout=timeout)[0]
+
+    def acquire_many(self, lox_name, lock_ids, expires_seconds=None, timeout=None):
+        """
+        Set the keys on every node at once, each node all or nothing, and keep them if a majority
+        of nodes took them while there is still time left on them. Otherwise they are released everywhere.
+        """
+        keys = [self.key(lox_name, lock_id) for lock_id in lock_ids]
+        token = new_id()
+        px = max(int(expires_seconds * 1000), 1) if expires_seconds else 0
+        # no point waiting for answers after the lock could have been valid, or past the caller's budget
+        budgets = [seconds for seconds in (expires_seconds, timeout) if seconds is not None]
+        most_refusals = len(self.nodes) - self.quorum
+        started = monotonic()
+        results = self.fan_out(
+            lambda i: self.acquire_many_scripts[i](keys=keys, args=[token, px]),
+            decided=lambda results: (self.count_granted(results) >= self.quorum or
+                                     len(results) - self.count_granted(results) > most_refusals),
+            timeout=min(budgets) if budgets else None)
+        acquired = self.count_granted(results)
+        validity = self.validity_seconds(expires_seconds, started) if expires_seconds else None
+
+        if acquired < self.quorum or (validity is not None and validity <= 0):
+            self.release_tokens(keys, [token] * len(keys))
+            failures = [error for in_use, error in results if error is not None]
+            if len(failures) > most_refusals:
+                # not a matter of contention: too many nodes are down to ever get a majority
+                raise failures[0]
+            if len(results) - acquired > most_refusals:
+                raise LockInUseException("Lock {} has been acquired previously, possibly by another thread/process, "
+                                         "and is not available on a majority of nodes.".format(", ".join(keys)))
+            raise LockValidityException("Lock {} could not be set on a majority of nodes while there was still time "
+                                        "left on it.".format(", ".join(keys)))
+
+        acquire_ts = time.time()
+        expire_ts = acquire_ts + validity if validity is not None else None
+        return [BackendLock(key, lox_name, lock_id, acquire_ts=acquire_ts, expire_ts=expire_ts, provider_lock=token)
+                for key, lock_id in zip(keys, lock_ids)]
+
+    @staticmethod
+    def count_granted(results):
+        return sum(1 for in_use, error in results if error is None and in_use == 0)
+
+    def release(self, lock):
+        self.release_many([lock])
+
+    def release_many(self, locks):
+        """ Compare-and-delete on every node at once; nodes that are down will expire the keys themselves. """
+        self.release_tokens([lock.key for lock in locks], [lock.provider_lock for lock in locks])
+
+    def release_tokens(self, keys, tokens):
+        """ Waits for the nodes for up to the socket timeout; slower ones release the keys in the background. """
+        self.fan_out(lambda i: self.release_many_scripts[i](keys=keys, args=[""] + tokens), timeout=self.socket_timeout)
+
+    def extend_many(self, locks, expires_seconds):
+        """
+        Reset the TTLs on every node at once. A lock is lost unless a majority of nodes
+        still had it, and there is still time left on it once they have all answered.
+        """
+        keys = [lock.key for lock in locks]
+        args = []
+        for lock, seconds in zip(locks, expires_seconds):
+            args += [lock.provider_lock, max(int(seconds * 1000), 1)]
+        most_refusals = len(self.nodes) - self.quorum
+
+        def count_extended(results):
+            extended = [0] * len(locks)
+            for lost, error in results:
+                if error is None:
+                    lost = set(lost)
+                    for i in range(len(locks)):
+                        if i + 1 not in lost:
+                            extended[i] += 1
+            return extended
+
+        def decided(results):
+            return all(count >= self.quorum or len(results) - count > most_refusals
+                       for count in count_extended(results))
+
+        started = monotonic()
+        results = self.fan_out(lambda i: self.extend_many_scripts[i](keys=keys, args=args),
+                               decided=decided, timeout=min(expires_seconds))
+        extended = count_extended(results)
+
+        now = time.time()
+        lost_locks = []
+        for lock, seconds, count in zip(locks, expires_seconds, extended):
+            validity = self.validity_seconds(seconds, started)
+            if count < self.quorum or validity <= 0:
+                lost_locks.append(lock)
+            else:
+                lock.expire_ts = now + validity
+        return lost_locks
+
+    def clear(self, lox_name, lock_id):
+        key = self.key(lox_name, lock_id)
+        self.fan_out(lambda i: self.nodes[i].delete(key))
@@ -0,0 +1,123 @@
+from __future__ import unicode_literals
+
+from lox.core.errors import *
+from lox.backends.base_lox_backend import BaseLoxBackend
+from lox.backends.factory import get_backend, release_backend
+from lox.backends.hash_ring import HashRing
+
+
+class ShardedLoxBackend(BaseLoxBackend):
+    """
+    A lox provider that spreads keys over several other backends with a consistent hash ring,
+    so lock traffic scales with the number of shards. Each key always goes to the same shard;
+    adding one only moves the keys it takes over. Configure with a list of backend settings,
+    each with an optional "weight" (default 1) and "name" (which places it on the ring, and
+    defaults to its URL):
+    {"backend": {"sharded": [{"redis": url}, {"redis": url, "weight": 2}, {"postgres": url}]}}.
+    Every other config setting applies to all of the shards.
+    """
+
+    def connect(self):
+        self.ring = HashRing()
+        self.shards = []
+        self.shard_configs = []
+        for settings in self.config["backend"]["sharded"]:
+            settings = dict(settings)
+            weight = settings.pop("weight", 1)
+            name = settings.pop("name", None) or "|".join("{}={}".format(k, v) for k, v in sorted(settings.items()))
+            # shared with any Lox that uses the same backend on its own
+            shard_config = dict(self.config, backend=settings)
+            shard = get_backend(shard_config)
+            self.shards.append(shard)
+            self.shard_configs.append(shard_config)
+            self.ring.add(name, shard, weight=weight)
+        if not self.shards:
+            raise BackendConfigException("sharded needs at least one backend.")
+        # Lock asks the backend this, so the shards have to agree
+        handles_expiration = set(shard.server_handles_expiration for shard in self.shards)
+        if len(handles_expiration) > 1:
+            raise BackendConfigException("Shards must either all expire locks on the server, or none of them.")
+        self.server_handles_expiration = handles_expiration.pop()
+
+    def close(self):
+        """ Give the shards back to the registry, which only closes those that nobody else got from it. """
+        super(ShardedLoxBackend, self).close()
+        for shard_config in self.shard_configs:
+            release_backend(shard_config)
+
+    def shard_for(self, key):
+        return self.ring.get(key)
+
+    def group_by_shard(self, keys):
+        """ Returns [(shard, [indexes of its keys])], in the order of the shards in the config. """
+        groups = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(id(self.shard_for(key)), []).append(i)
+        return [(shard, groups[id(shard)]) for shard in self.shards if id(shard) in groups]
+
+    def acquire(self, lox_name, lock_id, expires_seconds=None, timeout=None):
+        shard = self.shard_for(self.key(lox_name, lock_id))
+        return shard.acquire(lox_name, lock_id, **self.__kwargs(expires_seconds, timeout))
+
+    def acquire_shared(self, lox_name, lock_id, expires_seconds=None, timeout=None, permits=None):
+        kwargs = self.__kwargs(expires_seconds, timeout)
+        if permits:
+            kwargs["permits"] = permits
+        return self.shard_for(self.key(lox_name, lock_id)).acquire_shared(lox_name, lock_id, **kwargs)
+
+    def acquire_fair(self, lox_name, lock_id, ticket, ticket_seconds, expires_seconds=None, timeout=None):
+        return self.shard_for(self.key(lox_name, lock_id)).acquire_fair(
+            lox_name, lock_id, ticket, ticket_seconds, **self.__kwargs(expires_seconds, timeout))
+
+    def leave_queue(self, lox_name, lock_id, ticket):
+        self.shard_for(self.key(lox_name, lock_id)).leave_queue(lox_name, lock_id, ticket)
+
+    def acquire_many(self, lox_name, lock_ids, expires_seconds=None, timeout=None):
+        """
+        One acquire_many per shard involved, in a fixed shard order so that groups don't deadlock.
+        If a later shard's keys are in use, the ones already taken are released.
+        """
+        kwargs = self.__kwargs(expires_seconds, timeout)
+        locks = [None] * len(lock_ids)
+        taken = []
+        try:
+            for shard, indexes in self.group_by_shard([self.key(lox_name, lock_id) for lock_id in lock_ids]):
+                shard_locks = shard.acquire_many(lox_name, [lock_ids[i] for i in indexes], **kwargs)
+                taken.append((shard, shard_locks))
+                for i, lock in zip(indexes, shard_locks):
+                    locks[i] = lock
+        except BaseException:
+            for shard, shard_locks in reversed(taken):
+                shard.release_many(shard_locks)
+            raise
+        return locks
+
+    def release(self, lock):
+        self.shard_for(lock.key).release(lock)
+
+    def release_many(self, locks):
+        for shard, indexes in self.group_by_shard([lock.key for lock in locks]):
+            shard.release_many([locks[i] for i in indexes])
+
+    def extend_many(self, locks, expires_seconds):
+        lost = []
+        for shard, indexes in self.group_by_shard([lock.key for lock in locks]):
+            lost += shard.extend_many([locks[i] for i in indexes], [expires_seconds[i] for i in indexes])
+        return lost
+
+    def clear(self, lox_name, lock_id):
+        self.shard_for(self.key(lox_name, lock_id)).clear(lox_name, lock_id)
+
+    def wait_for_release(self, lox_name, lock_id, timeout, shared=False, permits=None, ticket=None):
+        shard = self.shard_for(self.key(lox_name, lock_id))
+        if ticket is not None:
+            shard.wait_for_release(lox_name, lock_id, timeout, ticket=ticket)
+        else:
+            shard.wait_for_release(lox_name, lock_id, timeout, shared=shared, permits=permits)
+
+    @staticmethod
+    def __kwargs(expires_seconds, timeout):
+        kwargs = {"expires_seconds": expires_seconds}
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        return kwargs
@@ -12,6 +12,10 @@ class LockNotFoundException(BaseException):
     """ thrown when trying to release a lock that hasn't yet been acquired """
     pass
 
+class LockExpiredException(BaseException):
+    """ thrown when trying to extend a lock that has already expired or been taken by someone else """
+    pass
+
 class BackendConfigException(BaseException):
     pass
 
@@ -20,3 +24,14 @@ class UnexpectedStateException(BaseException):
 
 class SchemaConflictException(BaseException):
     pass
+
+class LockTimeoutException(LockInUseException):
+    """ thrown when a lock cannot be acquired within the caller's time budget """
+    pass
+
+class LockValidityException(BaseException):
+    """
+    thrown when a lock was only got hold of (on a majority of redlock nodes) after it could have expired:
+    the nodes are too slow, rather than the lock in use, so it isn't retried
+    """
+    pass
@@ -0,0 +1,43 @@
+from __future__ import unicode_literals
+
+import os
+
+# the process the callbacks last ran for
+_pid = os.getpid()
+_callbacks = []
+_registered = hasattr(os, "register_at_fork")
+
+
+def at_fork_in_child(callback):
+    """
+    Have callback() run in every child process forked from now on, before lox is used there.
+    The modules with process-wide state (backends, the expiration scheduler, the local coordinator...)
+    use this to start over in the child: none of the parent's threads are running there, any lock
+    one of them held at the time of the fork stays locked for good, and the parent's connections
+    must not be used (or closed) by the child.
+    """
+    _callbacks.append(callback)
+
+
+def _after_fork_in_child():
+    global _pid
+    _pid = os.getpid()
+    for callback in list(_callbacks):
+        try:
+            callback()
+        except Exception:
+            # never break the child over it
+            pass
+
+
+def check_pid():
+    """
+    Run the callbacks if this is a child process they haven't run in yet. Only needed where
+    os.register_at_fork doesn't exist (python before 3.7), since it runs them right away otherwise.
+    """
+    if not _registered and _pid != os.getpid():
+        _after_fork_in_child()
+
+
+if _registered:
+    os.register_at_fork(after_in_child=_after_fork_in_child)
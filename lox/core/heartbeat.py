@@ -0,0 +1,52 @@
+from __future__ import unicode_literals
+
+import threading
+
+from .states import *
+from .errors import *
+from .lock import Lock
+
+
+class Heartbeat(object):
+    """
+    Background thread that keeps renewing every expiring lock a Lox holds, so they can use short
+    expirations without being lost mid-job. Each tick renews all of them with one backend call.
+    """
+
+    def __init__(self, lox, interval_seconds):
+        self.lox = lox
+        self.interval_seconds = interval_seconds
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="lox-heartbeat-{}".format(lox.name))
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def beat(self):
+        """
+        Renew every held lock that has an expiration to its own expires_seconds.
+        Returns the locks that turned out to be lost.
+        """
+        locks = [lock for lock in self.lox.held_locks()
+                 if lock.state in OK_TO_EXTEND and lock.expires_seconds]
+        if not locks:
+            return []
+        try:
+            return Lock.extend_group(locks, [lock.expires_seconds for lock in locks])
+        except UnexpectedStateException:
+            # one was released since we looked; it's gone from the next snapshot
+            return []
+
+    def _run(self):
+        while not self._stop.wait(self.interval_seconds):
+            try:
+                self.beat()
+            except Exception:
+                # the backend may be briefly unavailable; locks that were lost show up next time
+                pass
@@ -0,0 +1,27 @@
+from __future__ import unicode_literals
+
+import binascii
+import itertools
+import os
+import threading
+
+_reset_lock = threading.Lock()
+_pid = None
+_prefix = None
+_counter = None
+
+
+def new_id():
+    """
+    A short id, unique across threads, processes and hosts: a random prefix, new in every process
+    (forked ones too), and a counter. Much cheaper to make than a UUID, and shorter to send and store.
+    Used for lock ids, owner tokens and fair lock tickets.
+    """
+    global _pid, _prefix, _counter
+    if _pid != os.getpid():
+        with _reset_lock:
+            if _pid != os.getpid():
+                _prefix = binascii.hexlify(os.urandom(8)).decode("ascii")
+                _counter = itertools.count(1)
+                _pid = os.getpid()
+    return _prefix + format(next(_counter), "x")
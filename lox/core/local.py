@@ -0,0 +1,135 @@
+from __future__ import unicode_literals
+
+import threading
+
+from .fork import at_fork_in_child
+
+
+class LocalSlot(object):
+    """
+    In-process state for one backend key. All fields are guarded by the coordinator's mutex.
+    """
+
+    def __init__(self, condition):
+        # notified whenever the slot changes hands
+        self.condition = condition
+        # bumped on every change, so waiters don't miss a notification that came before they waited
+        self.version = 0
+        # the Lock that holds the backend lock, if it's held in this process
+        self.holder = None
+        # the Lock that is trying the backend (or taking a handoff) on behalf of the process
+        self.poller = None
+        # (backend, BackendLock, expires_seconds) released by the holder but kept for the next local waiter
+        self.handoff = None
+        # Locks that are acquiring or holding this key
+        self.users = 0
+
+
+class LocalCoordinator(object):
+    """
+    Resolves contention between threads of one process before it reaches the backend.
+    Only one Lock per key talks to the backend at a time; the others fail fast, or wait
+    on a local condition that the holder notifies when it lets go, and that may hand them
+    the backend lock directly instead of releasing it.
+    """
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._slots = {}
+
+    def join(self, key):
+        """ Register an acquiring Lock for key. Returns its slot, which must be left again. """
+        with self._mutex:
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = self._slots[key] = LocalSlot(threading.Condition(self._mutex))
+            slot.users += 1
+            return slot
+
+    def claim(self, slot, lock):
+        """
+        Decide how lock may try to acquire: returns a handoff tuple to take over,
+        True to go to the backend, or False if the key is busy in this process.
+        """
+        with self._mutex:
+            lock._slot_version = slot.version
+            if slot.holder is not None or slot.poller not in (None, lock):
+                return False
+            slot.poller = lock
+            handoff, slot.handoff = slot.handoff, None
+            return handoff or True
+
+    def acquired(self, slot, lock):
+        with self._mutex:
+            slot.holder = lock
+            if slot.poller is lock:
+                slot.poller = None
+
+    def hand_off(self, slot, lock, backend_lock):
+        """
+        Keep the backend lock held for the next local waiter instead of releasing it, if there is one.
+        Returns whether it was handed off.
+        """
+        with self._mutex:
+            if slot.holder is not lock or slot.users < 2:
+                return False
+            slot.handoff = (lock.backend, backend_lock, lock.expires_seconds)
+            slot.holder = None
+            self.__changed(slot)
+            return True
+
+    def leave(self, key, slot, lock):
+        """
+        Unregister lock, waking up the local waiters. Returns a handoff nobody is left to take,
+        which the caller must release to the backend.
+        """
+        with self._mutex:
+            if slot.holder is lock:
+                slot.holder = None
+            if slot.poller is lock:
+                slot.poller = None
+            slot.users -= 1
+            self.__changed(slot)
+            if slot.users:
+                return None
+            del self._slots[key]
+            handoff, slot.handoff = slot.handoff, None
+            return handoff
+
+    def wait(self, slot, lock, timeout):
+        """ Wait up to timeout seconds for the slot to change since lock last claimed it. """
+        with self._mutex:
+            if slot.version == lock._slot_version:
+                slot.condition.wait(timeout)
+
+    def __len__(self):
+        return len(self._slots)
+
+    @staticmethod
+    def __changed(slot):
+        slot.version += 1
+        slot.condition.notify_all()
+
+
+_coordinator = None
+_coordinator_lock = threading.Lock()
+
+
+def get_coordinator():
+    """ The process-wide local coordinator, created on first use. """
+    global _coordinator
+    if _coordinator is None:
+        with _coordinator_lock:
+            if _coordinator is None:
+                _coordinator = LocalCoordinator()
+    return _coordinator
+
+
+def _reset_after_fork():
+    # the slots are those of the parent's threads, which the child doesn't have
+    global _coordinator, _coordinator_lock
+    _coordinator = None
+    _coordinator_lock = threading.Lock()
+
+
+at_fork_in_child(_reset_after_fork)
@@ -1,137 +1,471 @@
 from __future__ import unicode_literals
 
-from datetime import datetime
 import time
-import uuid
-import threading
-
-import pytz
 
 from .states import *
 from .errors import *
+from .fork import check_pid
+from .ids import new_id
+from .retry import Retrier, FixedRetryPolicy, get_retry_policy, monotonic
+from .scheduler import get_scheduler
+from .local import get_coordinator
+
+# lock modes: an exclusive lock has one holder at a time, a shared one any number of holders
+# (readers), but never alongside an exclusive holder (a writer)
+MODE_EXCLUSIVE = "exclusive"
+MODE_SHARED = "shared"
+MODES = {MODE_EXCLUSIVE, MODE_SHARED}
+# how long a fair lock's waiter keeps its place in line without trying again, see "fair_ticket_seconds"
+DEFAULT_FAIR_TICKET_SECONDS = 5
 
 class Lock(object):
     """
     A basic object that uses a backend to acquire, hold, and release a distributed lock.
+    Slotted, since a process may hold a great many.
     """
+    __slots__ = ("state", "parent", "backend", "config", "id", "mode", "permits", "fair", "ticket", "_lock",
+                 "expires_seconds", "_expiration", "_slot", "_slot_version", "observer", "_acquired_at")
 
-    def __init__(self, parent, id=None):
+    def __init__(self, parent, id=None, mode=MODE_EXCLUSIVE, permits=None, fair=False):
         # immediately set state
         self.state = STATE_INIT
         # parent Lox wrapper class
         self.parent = parent
+        # kept even if the parent moves on to a new backend, since ours is the one that holds the lock
         self.backend = parent.backend
-        self.lox_name = parent.name
         # configuration (may be overriden here?)
         self.config = parent.config
         self.id = id or Lock.generate_id()
+        if mode not in MODES:
+            raise ValueError("Param 'mode' must be one of {}".format(", ".join(sorted(MODES))))
+        self.mode = mode
+        # for a semaphore permit (a shared lock), how many holders the key may have at once
+        self.permits = permits
+        if fair and self.shared:
+            raise ValueError("Only exclusive locks can be fair")
+        # whether to wait in line for the lock, see Lox.acquire; the ticket is our place while acquiring
+        self.fair = fair
+        self.ticket = None
         # this will hold the lock object from the backend
         self._lock = None
         # default to not auto-expire
         self.expires_seconds = None
-        # holds the timer thread for background auto expiration
-        self._expiration_thread = None
+        # pending entry in the expiration scheduler, for locks the backend doesn't expire itself
+        self._expiration = None
+        # slot in the local coordinator while acquiring or holding, if "local_coordination" is configured
+        self._slot = None
+        self._slot_version = None
+        # instrumentation, see Lox(observer=...)
+        self.observer = getattr(parent, "observer", None)
+        self._acquired_at = None
 
     @staticmethod
     def generate_id():
-        return uuid.uuid1()
+        return new_id()
+
+    @property
+    def lox_name(self):
+        return self.parent.name
+
+    @property
+    def shared(self):
+        return self.mode == MODE_SHARED
 
     @property
     def key(self):
         if self._lock:
             return self._lock.key
 
-    def acquire(self, expires_seconds=None, retry=False, num_tries=None, retry_interval_seconds=None):
+    def acquire(self, expires_seconds=None, retry=False, num_tries=None, retry_interval_seconds=None,
+                wait_for_release=None, timeout=None):
         """
         Acquire a lock, with optional retry logic. See Lox.acquire for param details.
         """
-        if self.state not in OK_TO_ACQUIRE:
-            raise UnexpectedStateException("Unable to acquire lock {} because state is {}".format(self.id, self.state))
+        Lock.acquire_group([self], expires_seconds=expires_seconds, retry=retry, num_tries=num_tries,
+                           retry_interval_seconds=retry_interval_seconds, wait_for_release=wait_for_release,
+                           timeout=timeout)
+        return self
+
+    @staticmethod
+    def acquire_group(locks, expires_seconds=None, retry=False, num_tries=None, retry_interval_seconds=None,
+                      wait_for_release=None, timeout=None):
+        """
+        Acquire locks from the same Lox all or nothing, with optional retry logic. See Lox.acquire for param details.
+        More than one lock takes a single backend.acquire_many call per try, and retries just sleep,
+        since there is no single lock to wait on.
+        """
+        for lock in locks:
+            if lock.state not in OK_TO_ACQUIRE:
+                raise UnexpectedStateException("Unable to acquire lock {} because state is {}".format(lock.id, lock.state))
+        if timeout is not None and timeout < 0:
+            raise ValueError("Param 'timeout' must be None, or at least 0")
+        if expires_seconds == 0:
+            raise ValueError("Param 'expires_seconds' must be None, or greater than 0")
 
-        self.state = STATE_ACQUIRING
+        first = locks[0]
+        if len(locks) == 1:
+            description = "lock {} because it is".format(first.id)
+        else:
+            description = "locks {} because one of them is".format(", ".join("{}".format(lock.id) for lock in locks))
+        Lock.__set_state(locks, STATE_ACQUIRING)
 
+        if timeout is not None:
+            # a deadline only makes sense if we keep trying until it passes
+            retry = True
         if not retry:
             num_tries = 1
-        if not num_tries:
-            num_tries = self.config.get("num_tries", 3)
+        if not num_tries and timeout is None:
+            num_tries = first.config.get("num_tries", 3)
         if retry_interval_seconds is None:
-            retry_interval_seconds = self.config.get("retry_interval_seconds", 1)
-        if expires_seconds == 0:
-            raise ValueError("Param 'expires_seconds' must be None, or greater than 0")
-        self.expires_seconds = expires_seconds
+            retry_interval_seconds = first.config.get("retry_interval_seconds", 1)
+        if wait_for_release is None:
+            wait_for_release = first.config.get("wait_for_release", False)
 
-        counter = 1
-        while counter <= num_tries:
-            try:
-                self._lock = self.backend.acquire(self.parent.name, self.id, expires_seconds=expires_seconds)
-            except LockInUseException as ex:
-                if not retry:
-                    self.state = STATE_ACQUIRING_EXCEPTION
-                    raise LockInUseException("Could not acquire lock {} because it is in use. " \
-                                             "Not retrying.".format(self.id))
-                counter += 1
-                self.state = STATE_ACQUIRING_RETRYING
-                if retry_interval_seconds:
-                    time.sleep(retry_interval_seconds)
+        if first.fair:
+            first.ticket = new_id()
+            # waiters are woken up in turn, so only poll in case a holder expired without releasing,
+            # often enough to keep our place in line
+            policy = FixedRetryPolicy(first.ticket_seconds / 2.0)
+        else:
+            policy = get_retry_policy(first.config, retry_interval_seconds)
+        retrier = Retrier(policy, num_tries=num_tries, timeout=timeout)
+        observer = first.observer
+        if observer is not None:
+            started = monotonic()
+            waited = 0
+        attempts = 0
+        if len(locks) == 1:
+            first.join_local()
+        try:
+            while True:
+                attempts += 1
+                try:
+                    if len(locks) == 1:
+                        backend_locks = [first.local_acquire(expires_seconds, retrier.remaining())]
+                    else:
+                        backend_locks = first.backend_acquire_many([lock.id for lock in locks], expires_seconds,
+                                                                   retrier.remaining())
+                except LockInUseException as ex:
+                    if observer is not None:
+                        observer.contended(first.lox_name)
+                    if not retry:
+                        Lock.__set_state(locks, STATE_ACQUIRING_EXCEPTION)
+                        raise LockInUseException("Could not acquire {} in use. " \
+                                                 "Not retrying.".format(description))
+                    delay = retrier.next_delay()
+                    if delay is None:
+                        break
+                    Lock.__set_state(locks, STATE_ACQUIRING_RETRYING)
+                    if observer is not None:
+                        wait_started = monotonic()
+                    if delay and first._slot is not None and first._slot.poller is not first:
+                        # another thread of ours has it, and wakes us up when it lets go
+                        get_coordinator().wait(first._slot, first, delay)
+                    elif delay and (wait_for_release or first.fair) and len(locks) == 1:
+                        # wakes up early when the holder releases; the delay is just the poll fallback
+                        first.backend_wait_for_release(delay)
+                    elif delay:
+                        time.sleep(delay)
+                    if observer is not None:
+                        waited += monotonic() - wait_started
+                else:
+                    for lock, backend_lock in zip(locks, backend_locks):
+                        lock._lock = backend_lock
+                        lock.expires_seconds = expires_seconds
+                        lock.state = STATE_ACQUIRED
+                        if expires_seconds and not lock.backend.server_handles_expiration:
+                            lock.auto_expire(expires_seconds=expires_seconds)
+                    break
+        finally:
+            if first.state != STATE_ACQUIRED:
+                first.leave_local()
+                first.leave_queue()
+            first.ticket = None
+            if observer is not None:
+                now = monotonic()
+                if first.state == STATE_ACQUIRED:
+                    for lock in locks:
+                        lock._acquired_at = now
+                        observer.acquired(first.lox_name, now - started, attempts, waited)
+                else:
+                    for lock in locks:
+                        observer.acquire_failed(first.lox_name, now - started, attempts, waited)
+
+        if first.state != STATE_ACQUIRED:
+            Lock.__set_state(locks, STATE_ACQUIRING_TIMEDOUT)
+            if retrier.timed_out:
+                raise LockTimeoutException("Could not acquire {} in use after " \
+                                           "{} seconds".format(description, timeout))
+            raise LockInUseException("Could not acquire {} in use after " \
+                                     "{} attempts".format(description, retrier.tries))
+
+        return locks
+
+    @staticmethod
+    def __set_state(locks, state):
+        for lock in locks:
+            lock.state = state
+
+    @property
+    def ticket_seconds(self):
+        return self.config.get("fair_ticket_seconds", DEFAULT_FAIR_TICKET_SECONDS)
+
+    def backend_acquire(self, expires_seconds, timeout=None):
+        """
+        One acquire attempt against the backend. A timeout (what is left of the caller's budget)
+        is only passed along when there is one, so backends can bound their own waits by it.
+        """
+        kwargs = {"expires_seconds": expires_seconds}
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        if self.ticket is not None:
+            return self.call_backend("acquire_fair", self.backend.acquire_fair, self.parent.name, self.id,
+                                     self.ticket, self.ticket_seconds, **kwargs)
+        if self.shared:
+            if self.permits:
+                kwargs["permits"] = self.permits
+            return self.call_backend("acquire_shared", self.backend.acquire_shared, self.parent.name, self.id, **kwargs)
+        return self.call_backend("acquire", self.backend.acquire, self.parent.name, self.id, **kwargs)
+
+    def backend_acquire_many(self, ids, expires_seconds, timeout=None):
+        """ Same as backend_acquire, for a whole group of ids in one call. """
+        kwargs = {"expires_seconds": expires_seconds}
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        return self.call_backend("acquire_many", self.backend.acquire_many, self.parent.name, ids, **kwargs)
+
+    def backend_wait_for_release(self, timeout):
+        """ Wait for the backend to say the lock may be free for our mode, for at most timeout seconds. """
+        if self.ticket is not None:
+            self.backend.wait_for_release(self.parent.name, self.id, timeout, ticket=self.ticket)
+        elif self.permits:
+            self.backend.wait_for_release(self.parent.name, self.id, timeout, shared=True, permits=self.permits)
+        elif self.shared:
+            self.backend.wait_for_release(self.parent.name, self.id, timeout, shared=True)
+        else:
+            self.backend.wait_for_release(self.parent.name, self.id, timeout)
+
+    def call_backend(self, operation, method, *args, **kwargs):
+        """ Call a backend method, timing the round trip if there is an observer. """
+        if self.observer is None:
+            return method(*args, **kwargs)
+        started = monotonic()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self.observer.backend_call(self.lox_name, operation, monotonic() - started)
+
+    def observe_end(self, expired=False):
+        """ Report how long the lock was held, now that it was released or expired. """
+        if self.observer is not None and self._acquired_at is not None:
+            held = monotonic() - self._acquired_at
+            self._acquired_at = None
+            if expired:
+                self.observer.expired(self.lox_name, held)
             else:
-                self.state = STATE_ACQUIRED
-                if expires_seconds and not self.backend.server_handles_expiration:
-                    self.auto_expire(expires_seconds=expires_seconds)
-                break
+                self.observer.released(self.lox_name, held)
 
-        if self.state == STATE_ACQUIRING_RETRYING:
-            self.state = STATE_ACQUIRING_TIMEDOUT
-            raise LockInUseException("Could not acquire lock {} after {} attempts because " \
-                                     "it is in use".format(self.id, num_tries))
+    def join_local(self):
+        # shared holders don't exclude each other, so there is nothing to settle locally,
+        # and fair ones wait in the backend's line instead
+        if self.config.get("local_coordination", False) and not self.shared and not self.fair:
+            self._slot = get_coordinator().join(self.backend.local_key(self.lox_name, self.id))
 
-        return self
+    def leave_local(self):
+        """ Stop coordinating with the other threads of the process, releasing a handoff nobody took. """
+        if self._slot is not None:
+            slot, self._slot = self._slot, None
+            handoff = get_coordinator().leave(self.backend.local_key(self.lox_name, self.id), slot, self)
+            if handoff:
+                handoff[0].release(handoff[1])
+
+    def leave_queue(self):
+        """
+        Give up our place in a fair lock's line, if we have one. Best effort, since it times out anyway.
+        """
+        if self.ticket is not None:
+            ticket, self.ticket = self.ticket, None
+            try:
+                self.call_backend("leave_queue", self.backend.leave_queue, self.lox_name, self.id, ticket)
+            except Exception:
+                pass
+
+    def local_acquire(self, expires_seconds, timeout=None):
+        """
+        One acquire attempt, settled in-process first when "local_coordination" is configured:
+        while another thread of the process holds or is trying the key, this fails without
+        a backend call, and a lock handed off by the last local holder is taken over directly.
+        """
+        if self._slot is None:
+            return self.backend_acquire(expires_seconds, timeout)
+        coordinator = get_coordinator()
+        claim = coordinator.claim(self._slot, self)
+        if not claim:
+            raise LockInUseException("Lock {} is in use in this process".format(self.id))
+        backend_lock = None
+        if claim is not True:
+            backend_lock = self.take_handoff(expires_seconds, *claim)
+        if backend_lock is None:
+            backend_lock = self.backend_acquire(expires_seconds, timeout)
+        coordinator.acquired(self._slot, self)
+        return backend_lock
+
+    def take_handoff(self, expires_seconds, backend, backend_lock, handoff_expires_seconds):
+        """
+        Take over a backend lock that a local holder handed to us. It costs nothing if neither
+        wants an expiration, and one extend call if we do. Returns None if it can't be used as is,
+        after giving it back to the backend.
+        """
+        if backend is self.backend:
+            if expires_seconds:
+                if not backend.extend_many([backend_lock], [expires_seconds]):
+                    return backend_lock
+                # expired in the meantime, and maybe taken by someone else
+                return None
+            if not handoff_expires_seconds or not backend.server_handles_expiration:
+                return backend_lock
+        # another backend instance, or it would expire when we want it not to
+        backend.release(backend_lock)
+        return None
 
-    def auto_expire(self, **kwargs):
+    def auto_expire(self, expires_seconds):
         """
-        Set up a background timer to expire the lock in expires_seconds from now, with some padding
+        Have the shared expiration scheduler expire the lock in expires_seconds from now.
         """
-        expires_seconds = kwargs.get("expires_seconds", 0)
-        counter = kwargs.get("counter", 0)
-        # double check expiration time
-        if self._lock.expire_ts < datetime.now(tz=pytz.UTC):
+        self._expiration = get_scheduler().schedule(expires_seconds, self.__expire_if_held)
+
+    def __expire_if_held(self):
+        # it may have been released in the meantime
+        if self.state in OK_TO_EXPIRE:
             self.expire()
-        # don't keep doing this forever...
-        elif counter < 10:
-            # first attempt, delay = expiration seconds, plus padding; after that, delay for half a second
-            delay = expires_seconds + 0.1 if counter == 0 else 0.5
-            counter += 1
-            kwargs = {"expires_seconds": expires_seconds, "counter": counter}
-            timer = threading.Timer(delay, self.auto_expire, kwargs=kwargs)
-            timer.start()
-            self._expiration_thread = timer
+
+    def cancel_expiration(self):
+        if self._expiration is not None:
+            get_scheduler().cancel(self._expiration)
+            self._expiration = None
+
+    def forget(self):
+        """
+        Let go of the lock without touching the backend or the scheduler, in a forked child process:
+        the lock is the parent's, which still holds (and releases) it. Releasing, extending or expiring
+        this copy of it raises UnexpectedStateException.
+        """
+        self._lock = None
+        self._expiration = None
+        self._slot = None
+        self._slot_version = None
 
     def release(self):
         """
         Explicitly release a lock.
         """
-        if self.state not in OK_TO_RELEASE or not self._lock:
-            raise UnexpectedStateException("Unable to release lock {} because state is {}".format(self.id, self.state))
+        Lock.release_group([self])
+        return self
+
+    @staticmethod
+    def release_group(locks):
+        """
+        Release locks from the same Lox, with a single backend.release_many call if there is more than one.
+        """
+        check_pid()
+        for lock in locks:
+            if lock.state not in OK_TO_RELEASE or not lock._lock:
+                raise UnexpectedStateException("Unable to release lock {} because state is {}".format(lock.id, lock.state))
 
-        self.state = STATE_RELEASING
+        for lock in locks:
+            lock.state = STATE_RELEASING
+            lock.cancel_expiration()
 
         # hit the actual backend here...
-        self.backend.release(self._lock)
+        try:
+            if len(locks) == 1:
+                locks[0].backend_release()
+            else:
+                locks[0].call_backend("release_many", locks[0].backend.release_many, [lock._lock for lock in locks])
+                for lock in locks:
+                    lock.leave_local()
+        except LockExpiredException:
+            # the backend found (one of) them lost already, e.g. with an advisory session; either way they're gone
+            for lock in locks:
+                lock.leave_local()
+                lock.observe_end(expired=True)
+            Lock.__set_state(locks, STATE_EXPIRED)
+            raise
+
+        for lock in locks:
+            lock.observe_end()
+        Lock.__set_state(locks, STATE_RELEASED)
+        return locks
+
+    def backend_release(self):
+        """
+        Release the backend lock, unless "local_handoff" is configured and another thread
+        of the process is waiting for it: then it is handed to that thread instead.
+        """
+        if not (self._slot is not None and self.config.get("local_handoff", False) and
+                get_coordinator().hand_off(self._slot, self, self._lock)):
+            self.call_backend("release", self.backend.release, self._lock)
+        self.leave_local()
 
-        self.state = STATE_RELEASED
+    def extend(self, expires_seconds):
+        """
+        Renew the lease: the lock will now expire expires_seconds from now.
+        Raises LockExpiredException if it had already been lost.
+        """
+        if Lock.extend_group([self], [expires_seconds]):
+            raise LockExpiredException("Unable to extend lock {} because it has expired".format(self.id))
         return self
 
+    @staticmethod
+    def extend_group(locks, expires_seconds):
+        """
+        Renew the leases of locks from the same Lox with a single backend.extend_many call.
+        expires_seconds is a parallel list. Returns the locks that had already been lost; they are marked expired.
+        """
+        check_pid()
+        for lock in locks:
+            if lock.state not in OK_TO_EXTEND or not lock._lock:
+                raise UnexpectedStateException("Unable to extend lock {} because state is {}".format(lock.id, lock.state))
+        for seconds in expires_seconds:
+            if not seconds or seconds < 0:
+                raise ValueError("Param 'expires_seconds' must be greater than 0")
+
+        backend = locks[0].backend
+        lost_backend_locks = set(id(backend_lock) for backend_lock in
+                                 locks[0].call_backend("extend_many", backend.extend_many,
+                                                       [lock._lock for lock in locks], expires_seconds))
+        lost = []
+        for lock, seconds in zip(locks, expires_seconds):
+            if id(lock._lock) in lost_backend_locks:
+                lost.append(lock)
+                # unless it was released while we were at it
+                if lock.state in OK_TO_EXPIRE:
+                    lock.cancel_expiration()
+                    lock.leave_local()
+                    lock.observe_end(expired=True)
+                    lock.state = STATE_EXPIRED
+            else:
+                lock.expires_seconds = seconds
+                if not backend.server_handles_expiration:
+                    lock.cancel_expiration()
+                    lock.auto_expire(expires_seconds=seconds)
+        return lost
+
     def expire(self):
         """
         Explicitly expire a lock. Similar to release, but uses different states to be explicit as to what happened.
         """
+        check_pid()
         if self.state not in OK_TO_EXPIRE or not self._lock:
             raise UnexpectedStateException("Unable to expire lock {} because state is {}".format(self.id, self.state))
 
         self.state = STATE_EXPIRING
+        self.cancel_expiration()
 
         # expiring a lock is the same thing as releasing from the backend's perspective
-        self.backend.release(self._lock)
+        self.backend_release()
 
+        self.observe_end(expired=True)
         self.state = STATE_EXPIRED
         return self
 
@@ -139,4 +473,6 @@ class Lock(object):
         """
         Delete a lock without releasing it (meant as a cleanup / admin / testing function).
         """
+        self.cancel_expiration()
         self.backend.clear(self.parent.name, self.id)
+        self.leave_local()
@@ -0,0 +1,171 @@
+from __future__ import unicode_literals
+
+import math
+import threading
+
+# sub-buckets per power of two, i.e. histogram values are accurate to within about 1/8th
+SUB_BUCKETS = 4
+
+
+class LoxObserver(object):
+    """
+    Instrumentation interface: pass one as Lox(observer=...) and its Locks report to it.
+    Every method is a no-op here, so subclasses only override what they are interested in.
+    Times are in seconds, from a monotonic clock. Observers are called from whichever thread
+    did the work (including the expiration and heartbeat threads), so must be thread-safe.
+    Without an observer, none of this is measured at all.
+    """
+
+    def acquired(self, lox_name, seconds, tries, wait_seconds):
+        """ A lock was acquired, seconds after we started, in tries attempts, wait_seconds of it between them. """
+
+    def acquire_failed(self, lox_name, seconds, tries, wait_seconds):
+        """ Same as acquired, for a lock we gave up on (or that raised). """
+
+    def contended(self, lox_name):
+        """ One attempt found the lock in use. """
+
+    def released(self, lox_name, held_seconds):
+        """ A lock was released after being held for held_seconds. """
+
+    def expired(self, lox_name, held_seconds):
+        """ A lock was expired, or found to have been, after being held for held_seconds. """
+
+    def backend_call(self, lox_name, operation, seconds):
+        """ One round trip to the backend: operation is "acquire", "release_many", etc. """
+
+
+class Histogram(object):
+    """
+    Log-linear histogram: values are counted in buckets a power of two wide, split into SUB_BUCKETS,
+    so it takes a few dozen counters to cover anything from microseconds to hours.
+    Not thread-safe on its own; HistogramCollector guards it.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    @staticmethod
+    def bucket(value):
+        if value <= 0:
+            return None
+        mantissa, exponent = math.frexp(value)
+        return exponent * SUB_BUCKETS + int((mantissa - 0.5) * 2 * SUB_BUCKETS)
+
+    @staticmethod
+    def bucket_upper_bound(bucket):
+        if bucket is None:
+            return 0.0
+        exponent, sub_bucket = divmod(bucket, SUB_BUCKETS)
+        return math.ldexp(0.5 + (sub_bucket + 1) / (2.0 * SUB_BUCKETS), exponent)
+
+    def record(self, value):
+        bucket = self.bucket(value)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def percentile(self, percent):
+        """ The value that percent of the recorded values are at most, to the histogram's accuracy. """
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        # the zero bucket sorts first
+        for bucket in sorted(self.buckets, key=lambda bucket: -1 if bucket is None else bucket):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                # never report more than was actually seen
+                return min(self.bucket_upper_bound(bucket), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.mean,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+        }
+
+
+class HistogramCollector(LoxObserver):
+    """
+    Keeps counters and histograms of everything it observes in memory, labeled by Lox name:
+    counters "acquired", "acquire_failed", "contended", "released" and "expired", and histograms
+    "acquire_seconds", "acquire_wait_seconds", "acquire_tries", "hold_seconds" and
+    "backend_<operation>_seconds". snapshot() returns them all as plain data.
+    """
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, lox_name, name):
+        key = (lox_name, name)
+        with self._mutex:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def record(self, lox_name, name, value):
+        key = (lox_name, name)
+        with self._mutex:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.record(value)
+
+    def acquired(self, lox_name, seconds, tries, wait_seconds):
+        self.count(lox_name, "acquired")
+        self.record(lox_name, "acquire_seconds", seconds)
+        self.record(lox_name, "acquire_wait_seconds", wait_seconds)
+        self.record(lox_name, "acquire_tries", tries)
+
+    def acquire_failed(self, lox_name, seconds, tries, wait_seconds):
+        self.count(lox_name, "acquire_failed")
+        self.record(lox_name, "acquire_wait_seconds", wait_seconds)
+        self.record(lox_name, "acquire_tries", tries)
+
+    def contended(self, lox_name):
+        self.count(lox_name, "contended")
+
+    def released(self, lox_name, held_seconds):
+        self.count(lox_name, "released")
+        self.record(lox_name, "hold_seconds", held_seconds)
+
+    def expired(self, lox_name, held_seconds):
+        self.count(lox_name, "expired")
+        self.record(lox_name, "hold_seconds", held_seconds)
+
+    def backend_call(self, lox_name, operation, seconds):
+        self.record(lox_name, "backend_{}_seconds".format(operation), seconds)
+
+    def snapshot(self):
+        """ {lox_name: {counter name: count, histogram name: summary dict}} """
+        snapshot = {}
+        with self._mutex:
+            for (lox_name, name), count in self.counters.items():
+                snapshot.setdefault(lox_name, {})[name] = count
+            for (lox_name, name), histogram in self.histograms.items():
+                snapshot.setdefault(lox_name, {})[name] = histogram.summary()
+        return snapshot
+
+    def reset(self):
+        with self._mutex:
+            self.counters = {}
+            self.histograms = {}
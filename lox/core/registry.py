@@ -0,0 +1,147 @@
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+import threading
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+# how many independently locked parts a registry is split into
+DEFAULT_STRIPES = 16
+
+
+class LockRegistry(MutableMapping):
+    """
+    The locks a Lox is tracking, by ID: a dict that threads can share. Its IDs are spread over stripes,
+    each a dict with a mutex of its own, so threads working on different IDs rarely wait on each other.
+    Checking for an ID and adding it (add, add_all), or removing several (pop_all), happen atomically.
+    Iterating, keys, values, items and comparisons work from a snapshot, taken one stripe at a time.
+    """
+
+    def __init__(self, stripes=DEFAULT_STRIPES):
+        self.stripes = [(threading.Lock(), {}) for i in range(stripes)]
+
+    def stripe(self, id):
+        return self.stripes[hash(id) % len(self.stripes)]
+
+    @contextmanager
+    def locked(self, ids):
+        """ Hold the mutexes of the stripes of all of ids at once, taken in stripe order so we can't deadlock. """
+        indexes = sorted(set(hash(id) % len(self.stripes) for id in ids))
+        held = []
+        try:
+            for i in indexes:
+                self.stripes[i][0].acquire()
+                held.append(self.stripes[i][0])
+            yield
+        finally:
+            for mutex in reversed(held):
+                mutex.release()
+
+    def __getitem__(self, id):
+        mutex, locks = self.stripe(id)
+        with mutex:
+            return locks[id]
+
+    def __setitem__(self, id, lock):
+        mutex, locks = self.stripe(id)
+        with mutex:
+            locks[id] = lock
+
+    def __delitem__(self, id):
+        mutex, locks = self.stripe(id)
+        with mutex:
+            del locks[id]
+
+    def __contains__(self, id):
+        mutex, locks = self.stripe(id)
+        with mutex:
+            return id in locks
+
+    def __len__(self):
+        return sum(len(locks) for mutex, locks in self.stripes)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, id, default=None):
+        mutex, locks = self.stripe(id)
+        with mutex:
+            return locks.get(id, default)
+
+    def pop(self, id, *default):
+        mutex, locks = self.stripe(id)
+        with mutex:
+            return locks.pop(id, *default)
+
+    def add(self, id, lock):
+        """ Register lock under id, unless there is one already. Returns whether it was added. """
+        mutex, locks = self.stripe(id)
+        with mutex:
+            if id in locks:
+                return False
+            locks[id] = lock
+            return True
+
+    def add_all(self, locks_by_id):
+        """
+        Register every (id, lock) pair, or none of them if one of the ids is taken already.
+        Returns None if they were all added, or else the first taken id.
+        """
+        with self.locked([id for id, lock in locks_by_id]):
+            for id, lock in locks_by_id:
+                if id in self.stripe(id)[1]:
+                    return id
+            for id, lock in locks_by_id:
+                self.stripe(id)[1][id] = lock
+        return None
+
+    def pop_all(self, ids):
+        """ Remove and return the locks for every one of ids, or none of them (raising KeyError) if one is missing. """
+        with self.locked(ids):
+            for id in ids:
+                if id not in self.stripe(id)[1]:
+                    raise KeyError(id)
+            return [self.stripe(id)[1].pop(id) for id in ids]
+
+    def snapshot(self):
+        """ A plain dict of everything in the registry. """
+        snapshot = {}
+        for mutex, locks in self.stripes:
+            with mutex:
+                snapshot.update(locks)
+        return snapshot
+
+    def drain(self):
+        """ Empty the registry, returning a plain dict of what was in it. """
+        drained = {}
+        for mutex, locks in self.stripes:
+            with mutex:
+                drained.update(locks)
+                locks.clear()
+        return drained
+
+    def clear(self):
+        self.drain()
+
+    def keys(self):
+        return list(self.snapshot().keys())
+
+    def values(self):
+        return list(self.snapshot().values())
+
+    def items(self):
+        return list(self.snapshot().items())
+
+    def __eq__(self, other):
+        if isinstance(other, LockRegistry):
+            other = other.snapshot()
+        return self.snapshot() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.snapshot())
@@ -0,0 +1,113 @@
+from __future__ import unicode_literals
+
+import random
+import time
+
+# time.monotonic is python 3 only
+monotonic = getattr(time, "monotonic", time.time)
+
+
+class RetryPolicy(object):
+    """
+    Decides how long to wait before each retry of an acquire.
+    Subclasses implement delays(); every delay is capped at max_interval_seconds, if given.
+    """
+    def __init__(self, interval_seconds, max_interval_seconds=None):
+        self.interval_seconds = interval_seconds
+        self.max_interval_seconds = max_interval_seconds
+
+    def delays(self):
+        """ Endless generator of seconds to wait before the 1st, 2nd, ... retry. """
+        raise NotImplementedError
+
+    def cap(self, delay):
+        if self.max_interval_seconds is not None:
+            return min(delay, self.max_interval_seconds)
+        return delay
+
+
+class FixedRetryPolicy(RetryPolicy):
+    """ Always wait interval_seconds. This is how lox has always retried. """
+    def delays(self):
+        while True:
+            yield self.cap(self.interval_seconds)
+
+
+class ExponentialRetryPolicy(RetryPolicy):
+    """ Wait interval_seconds, then keep doubling it. """
+    multiplier = 2
+
+    def delays(self):
+        delay = self.interval_seconds
+        while True:
+            yield self.cap(delay)
+            delay *= self.multiplier
+
+
+class DecorrelatedJitterRetryPolicy(RetryPolicy):
+    """
+    Each wait is random, between interval_seconds and three times the previous wait,
+    so contending processes drift apart instead of retrying in lockstep.
+    """
+    def delays(self):
+        delay = self.interval_seconds
+        while True:
+            delay = self.cap(random.uniform(self.interval_seconds, delay * 3))
+            yield delay
+
+
+RETRY_POLICIES = {
+    "fixed": FixedRetryPolicy,
+    "exponential": ExponentialRetryPolicy,
+    "decorrelated_jitter": DecorrelatedJitterRetryPolicy,
+}
+
+
+def get_retry_policy(config, interval_seconds):
+    """
+    Build the retry policy named by the "retry_policy" config setting (default "fixed"),
+    which may also be a RetryPolicy subclass. "retry_max_interval_seconds" caps every wait.
+    """
+    policy = config.get("retry_policy", "fixed")
+    if not isinstance(policy, type):
+        if policy not in RETRY_POLICIES:
+            raise ValueError("Unknown retry policy {}, expected one of {}".format(policy, sorted(RETRY_POLICIES)))
+        policy = RETRY_POLICIES[policy]
+    return policy(interval_seconds, config.get("retry_max_interval_seconds"))
+
+
+class Retrier(object):
+    """
+    Keeps track of one acquire's retry budget: a number of tries, a deadline, or both.
+    """
+    def __init__(self, policy, num_tries=None, timeout=None):
+        self.num_tries = num_tries
+        self.tries = 0
+        self.deadline = None if timeout is None else monotonic() + timeout
+        self._delays = policy.delays()
+
+    def remaining(self):
+        """ Seconds left before the deadline, or None if there is no deadline. """
+        if self.deadline is None:
+            return None
+        return max(self.deadline - monotonic(), 0)
+
+    @property
+    def timed_out(self):
+        return self.deadline is not None and monotonic() >= self.deadline
+
+    def next_delay(self):
+        """
+        Record a failed try. Returns the seconds to wait before trying again,
+        or None if the budget is spent. Waits never run past the deadline.
+        """
+        self.tries += 1
+        if self.num_tries and self.tries >= self.num_tries:
+            return None
+        remaining = self.remaining()
+        if remaining == 0:
+            return None
+        delay = next(self._delays)
+        if remaining is not None:
+            delay = min(delay, remaining)
+        return delay
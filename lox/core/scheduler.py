@@ -0,0 +1,114 @@
+from __future__ import unicode_literals
+
+import heapq
+import itertools
+import threading
+
+from .retry import monotonic
+from .fork import at_fork_in_child
+
+# don't bother compacting tiny heaps
+COMPACT_MIN_CANCELLED = 64
+
+
+class ExpirationScheduler(object):
+    """
+    Runs expiration callbacks from a single daemon thread, in due order.
+    Pending expirations live in one heap, so holding many expiring locks costs
+    one small list per lock rather than one timer thread per lock.
+    """
+
+    def __init__(self, name="lox-expiration"):
+        self.name = name
+        # entries are [due, sequence, callback]; a cancelled entry has its callback set to None
+        self._heap = []
+        self._sequence = itertools.count()
+        self._cancelled = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def __len__(self):
+        """ Number of pending (not cancelled) expirations. """
+        with self._condition:
+            return len(self._heap) - self._cancelled
+
+    def schedule(self, delay, callback):
+        """
+        Call callback() in delay seconds, on the scheduler thread.
+        Returns an entry that can be passed to cancel.
+        """
+        entry = [monotonic() + delay, next(self._sequence), callback]
+        with self._condition:
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._heap[0] is entry:
+                # due before whatever the thread is sleeping on
+                self._condition.notify()
+        return entry
+
+    def cancel(self, entry):
+        """ Cancel a pending expiration; a no-op if it already ran or was cancelled. """
+        with self._condition:
+            if entry[2] is None:
+                return
+            entry[2] = None
+            self._cancelled += 1
+            # cancelled entries are dropped lazily, so rebuild once they are most of the heap
+            if self._cancelled > COMPACT_MIN_CANCELLED and self._cancelled * 2 > len(self._heap):
+                self._heap = [e for e in self._heap if e[2] is not None]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def _next_due(self):
+        """ Block until an entry is due, then pop it and return its callback. """
+        with self._condition:
+            while True:
+                while self._heap and self._heap[0][2] is None:
+                    heapq.heappop(self._heap)
+                    self._cancelled -= 1
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                delay = self._heap[0][0] - monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                entry = heapq.heappop(self._heap)
+                callback, entry[2] = entry[2], None
+                return callback
+
+    def _run(self):
+        while True:
+            callback = self._next_due()
+            try:
+                callback()
+            except BaseException:
+                # e.g. the lock was released while we were popping it; keep the thread alive
+                pass
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """ The process-wide expiration scheduler, created on first use. """
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = ExpirationScheduler()
+    return _scheduler
+
+
+def _reset_after_fork():
+    # the thread didn't survive the fork, and the pending expirations are those of the parent's locks
+    global _scheduler, _scheduler_lock
+    _scheduler = None
+    _scheduler_lock = threading.Lock()
+
+
+at_fork_in_child(_reset_after_fork)
@@ -0,0 +1,78 @@
+from __future__ import unicode_literals
+
+import threading
+
+from .errors import *
+from .lock import Lock, MODE_SHARED
+
+
+class Semaphore(object):
+    """
+    A distributed counting semaphore: up to permits holders at once, across threads and processes.
+    Each permit is a shared Lock on the semaphore's id that the backend only grants while fewer than
+    permits others are held, so it is acquired in one round trip, expires, is extended and waited for
+    just like any other lock. Get one from Lox.semaphore.
+    """
+
+    def __init__(self, parent, id, permits):
+        if not isinstance(permits, int) or isinstance(permits, bool) or permits < 1:
+            raise ValueError("Param 'permits' must be an int, at least 1")
+        self.parent = parent
+        self.id = id
+        self.permits = permits
+        # the permits we hold, oldest first
+        self.held = []
+        self._mutex = threading.Lock()
+
+    def acquire(self, expires_seconds=None, retry=False, num_tries=None, retry_interval_seconds=None,
+                wait_for_release=None, timeout=None):
+        """
+        Take one permit. See Lox.acquire for param details.
+        :return: the permit, a Lock to pass to release
+        """
+        permit = Lock(self.parent, self.id, mode=MODE_SHARED, permits=self.permits)
+        permit.acquire(expires_seconds=expires_seconds,
+                       retry=retry,
+                       num_tries=num_tries,
+                       retry_interval_seconds=retry_interval_seconds,
+                       wait_for_release=wait_for_release,
+                       timeout=timeout)
+        with self._mutex:
+            self.held.append(permit)
+        if expires_seconds:
+            self.parent.start_heartbeat()
+        return permit
+
+    def release(self, permit=None):
+        """
+        Give a permit back.
+        :param permit: one returned by acquire; defaults to the oldest one we hold
+        :return: the released permit
+        """
+        with self._mutex:
+            if permit is None:
+                if not self.held:
+                    raise LockNotFoundException("No permits of semaphore %s to release" % self.id)
+                permit = self.held.pop(0)
+            elif permit in self.held:
+                self.held.remove(permit)
+            else:
+                raise LockNotFoundException("Permit not held from semaphore %s" % self.id)
+        return permit.release()
+
+    def clear(self):
+        """
+        Purge the semaphore from the backend, including permits held by others. For admin, testing, etc.
+        """
+        with self._mutex:
+            held, self.held = self.held, []
+        for permit in held:
+            permit.cancel_expiration()
+        self.parent.backend.clear(self.parent.name, self.id)
+
+    def forget(self):
+        """ In a forked child process: forget the permits, which are the parent's. See Lock.forget. """
+        held, self.held = self.held, []
+        self._mutex = threading.Lock()
+        for permit in held:
+            permit.forget()
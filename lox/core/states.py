@@ -17,3 +17,4 @@ STATE_EXPIRED = 11
 OK_TO_ACQUIRE = {STATE_INIT, STATE_RELEASED, STATE_EXPIRED}
 OK_TO_RELEASE = {STATE_ACQUIRED}
 OK_TO_EXPIRE = {STATE_ACQUIRED}
+OK_TO_EXTEND = {STATE_ACQUIRED}
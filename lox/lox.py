@@ -1,9 +1,15 @@
 from __future__ import unicode_literals
 
-from .core.lock import Lock
+import weakref
+
+from .core.lock import Lock, MODE_EXCLUSIVE
+from .core.semaphore import Semaphore
+from .core.heartbeat import Heartbeat
+from .core.registry import LockRegistry
 from .core.errors import *
-from .backends.redis_lox_backend import RedisLoxBackend
-from .backends.postgres_lox_backend import PostgresLoxBackend
+from .core.fork import at_fork_in_child, check_pid
+from .backends.base_lox_backend import BaseLoxBackend
+from .backends.factory import get_backend
 
 
 DEFAULT_LOX_CONFIG = {
@@ -12,11 +18,17 @@ DEFAULT_LOX_CONFIG = {
     }
 }
 
+# every Lox in the process, so a forked child can have them forget the parent's locks
+_instances = weakref.WeakSet()
+
+
 class Lox(object):
     """
     Main API for distributed locking, with schmear.
+    Safe to share between threads: a whole thread pool can use one Lox, as long as each lock ID
+    is only released by whoever acquired it.
     """
-    def __init__(self, name=None, config=None):
+    def __init__(self, name=None, config=None, observer=None):
         # you might want to have multiple of these around, so allow naming each
         self.name = name or "Lox"
         # configuration: default to redis, for now
@@ -24,42 +36,151 @@ class Lox(object):
             self.config = DEFAULT_LOX_CONFIG
         else:
             self.config = config
-        # will hold a list of locks we're managing here
-        self.locks = {}
+        # will hold the locks we're managing here, by ID
+        self.locks = LockRegistry()
+        # semaphores by ID, see semaphore()
+        self.semaphores = {}
         # will hold the lock when used as a context manager
         self.context_lock = None
-        # may want to do lazy connection...
-        self.connect_backend()
+        # renews expiring locks in the background, if "heartbeat_interval_seconds" is configured
+        self.heartbeat = None
+        # connected on first use
+        self._backend = None
+        # a core.metrics.LoxObserver (e.g. a HistogramCollector) that our locks report their timings to
+        self.observer = observer
+        _instances.add(self)
+
+    @property
+    def backend(self):
+        check_pid()
+        if self._backend is None or self._backend.closed:
+            self.connect_backend()
+        return self._backend
 
     def connect_backend(self):
-        self.backend = None
-        if "redis" in self.config.get("backend"):
-            self.backend = RedisLoxBackend(self.config)
-        elif "postgres" in self.config.get("backend"):
-            self.backend = PostgresLoxBackend(self.config)
-        if not self.backend:
-            raise BackendConfigException("No backend specified in settings.")
-        self.backend.connect()
+        """
+        Get the backend for our config, connecting it if no other Lox in the process has yet.
+        Happens automatically the first time the backend is needed.
+        """
+        self._backend = get_backend(self.config)
 
-    def acquire(self, id=None, expires_seconds=None, retry=False, num_tries=None, retry_interval_seconds=None):
+    def acquire(self, id=None, expires_seconds=None, retry=False, num_tries=None, retry_interval_seconds=None,
+                wait_for_release=None, timeout=None, mode=MODE_EXCLUSIVE, fair=None):
         """
         Get a lock with the given ID, using the configured backend provider.
+        With the "local_coordination" config setting, threads of this process that want the same lock
+        settle it among themselves first: only one of them talks to the backend at a time, and the rest
+        wait for it locally. With "local_handoff" too, a released lock goes straight to the next local
+        waiter, without a round trip to the backend.
         :param id: unique identifier for this lock, within this Lox instance.
         :param expires_seconds: Automatically expire (i.e release) the lock after this number of seconds.
                                 Defaults to never expire the lock based on a timer.
         :param retry: if the lock cannot be acquired immediately, should we try to acquire it again later?
         :param num_tries: try to get this lock this many times before giving up.
-        :param retry_interval_seconds: wait this number of seconds between retries.
+        :param retry_interval_seconds: wait this number of seconds between retries. This is the starting point
+                                       for the "retry_policy" config setting: "fixed" (the default),
+                                       "exponential" or "decorrelated_jitter", capped at
+                                       "retry_max_interval_seconds" if that is set.
+        :param wait_for_release: between retries, wait to be notified that the lock was released instead of
+                                 sleeping; retry_interval_seconds is then the longest wait before polling anyway.
+                                 Defaults to the "wait_for_release" config setting, which also makes
+                                 releases send the notifications.
+        :param timeout: give up after this many seconds in total. Implies retry; num_tries still applies
+                        if given. Backends also bound their own calls by whatever is left of it.
+        :param mode: "exclusive" (the default) for a lock with one holder at a time, or "shared" for a reader lock:
+                     any number of shared holders at once, but not while there is an exclusive holder.
+                     An exclusive acquire that finds shared holders keeps new ones out for
+                     "writer_preference_seconds" (default 2, 0 to turn it off), so writers don't starve.
+                     Shared locks expire and are extended just like exclusive ones.
+        :param fair: wait in line for the lock: the backend keeps a queue of waiters, and each release wakes up
+                     only the one at its head, which is the only one that can take it. Defaults to the "fair"
+                     config setting. Instead of retrying every retry_interval_seconds, waiters only check
+                     back every "fair_ticket_seconds" / 2 (default 5 / 2), in case a holder expired without
+                     releasing; a waiter that hasn't checked back for "fair_ticket_seconds" loses its place.
+                     Only exclusive locks can be fair, and acquires that aren't fair skip the line,
+                     so every acquire of the key should be. Supported by the Redis, PostgreSQL table mode
+                     and in-memory backends.
         :return: the acquired Lock object
         """
-        if id and id in self.locks:
+        if fair is None:
+            fair = self.config.get("fair", False) and mode == MODE_EXCLUSIVE
+        lock = Lock(self, id, mode=mode, fair=fair)
+        # checked and added at once, so two threads can't both get past this with the same ID
+        if not self.locks.add(lock.id, lock):
             raise LockAlreadyAcquiredException("Lock %s cannot be acquired more than once." % id)
-        lock = Lock(self, id)
-        self.locks[lock.id] = lock
-        return lock.acquire(expires_seconds=expires_seconds,
-                            retry=retry,
-                            num_tries=num_tries,
-                            retry_interval_seconds=retry_interval_seconds)
+        try:
+            lock.acquire(expires_seconds=expires_seconds,
+                         retry=retry,
+                         num_tries=num_tries,
+                         retry_interval_seconds=retry_interval_seconds,
+                         wait_for_release=wait_for_release,
+                         timeout=timeout)
+        except BaseException:
+            # it wasn't acquired, so don't keep tracking it
+            self.locks.pop(lock.id, None)
+            raise
+        if expires_seconds:
+            self.start_heartbeat()
+        return lock
+
+    def acquire_many(self, ids, expires_seconds=None, retry=False, num_tries=None, retry_interval_seconds=None,
+                     timeout=None):
+        """
+        Get locks for all of the given IDs, or none of them, with one backend round trip per try.
+        See acquire for the other params; retries sleep rather than wait for a release notification.
+        :param ids: unique identifiers for the locks, within this Lox instance.
+        :return: list of the acquired Lock objects, in a stable order (that of their backend keys)
+        """
+        ids = sorted(ids, key=lambda id: BaseLoxBackend.key(self.name, id))
+        if not ids:
+            raise ValueError("Param 'ids' must not be empty")
+        if len(set(ids)) != len(ids):
+            raise ValueError("Param 'ids' must not contain duplicates")
+        locks = [Lock(self, id) for id in ids]
+        taken = self.locks.add_all([(lock.id, lock) for lock in locks])
+        if taken is not None:
+            raise LockAlreadyAcquiredException("Lock %s cannot be acquired more than once." % taken)
+        try:
+            Lock.acquire_group(locks,
+                               expires_seconds=expires_seconds,
+                               retry=retry,
+                               num_tries=num_tries,
+                               retry_interval_seconds=retry_interval_seconds,
+                               timeout=timeout)
+        except BaseException:
+            # none of them were acquired, so don't keep tracking them
+            for lock in locks:
+                self.locks.pop(lock.id, None)
+            raise
+        if expires_seconds:
+            self.start_heartbeat()
+        return locks
+
+    def semaphore(self, id, permits):
+        """
+        Get the semaphore with the given ID, which lets up to permits holders in at once, across
+        threads and processes: acquire and release its permits one at a time. Each permit is its own
+        shared lock on the ID, with the same retry, wait_for_release and expiration options as acquire.
+        Not supported by the file and advisory Postgres backends.
+        :param id: unique identifier for this semaphore, within this Lox instance.
+        :param permits: how many holders there may be at once; every user of the semaphore must agree on it.
+        :return: the Semaphore object, the same one every time for the same ID
+        """
+        semaphore = self.semaphores.get(id)
+        if semaphore is None:
+            semaphore = self.semaphores.setdefault(id, Semaphore(self, id, permits))
+        if semaphore.permits != permits:
+            raise ValueError("Semaphore %s has %s permits, not %s" % (id, semaphore.permits, permits))
+        return semaphore
+
+    def held_locks(self):
+        """
+        Every lock of ours, including semaphore permits.
+        """
+        locks = self.locks.values()
+        for semaphore in list(self.semaphores.values()):
+            locks += list(semaphore.held)
+        return locks
 
     def release(self, id=None):
         """
@@ -69,21 +190,78 @@ class Lox(object):
         """
         if not self.locks:
             raise LockNotFoundException("No locks to release")
-        if id and id not in self.locks:
-            raise LockNotFoundException("Lock %s not found" % id)
         # free it from the instance level tracking
-        lock = self.locks.pop(id)
+        lock = self.locks.pop(id, None)
+        if lock is None:
+            raise LockNotFoundException("Lock %s not found" % id)
         return lock.release()
 
+    def release_many(self, ids):
+        """
+        Release the locks with the given IDs, with one backend round trip.
+        :param ids: unique identifiers for the locks, within this Lox instance
+        :return: list of the released lock objects
+        """
+        # free them from the instance level tracking, all or none
+        try:
+            locks = self.locks.pop_all(ids)
+        except KeyError as ex:
+            raise LockNotFoundException("Lock %s not found" % ex.args[0])
+        return Lock.release_group(locks)
+
+    def extend(self, id, expires_seconds):
+        """
+        Renew the lease on the lock with the given ID: it will now expire expires_seconds from now.
+        :return: the extended lock object
+        """
+        lock = self.locks.get(id)
+        if lock is None:
+            raise LockNotFoundException("Lock %s not found" % id)
+        return lock.extend(expires_seconds)
+
+    def start_heartbeat(self):
+        """
+        Start renewing expiring locks every "heartbeat_interval_seconds", if that is configured.
+        Happens automatically when the first expiring lock is acquired.
+        """
+        interval = self.config.get("heartbeat_interval_seconds")
+        if interval and not self.heartbeat:
+            self.heartbeat = Heartbeat(self, interval)
+            self.heartbeat.start()
+
+    def stop_heartbeat(self):
+        if self.heartbeat:
+            self.heartbeat.stop()
+            self.heartbeat = None
+
     def clear_all(self):
         """
         Purge all locks from the backend without releasing them.
         This effectively resets the data store.
         Should only be used for admin, testing, etc.
         """
-        for id, lock in self.locks.iteritems():
+        for lock in self.locks.drain().values():
             lock.clear()
-        self.locks = {}
+        for semaphore in list(self.semaphores.values()):
+            semaphore.clear()
+
+    def forget_locks(self):
+        """
+        Forget every lock we hold, without releasing any, and stop tracking them: for a child process
+        forked while we held them, where they are still the parent's. Happens automatically after a fork.
+        """
+        stripes, self.locks = self.locks.stripes, LockRegistry()
+        # a thread of the parent may have held one of the stripe mutexes, so don't take them
+        for mutex, locks in stripes:
+            for lock in locks.values():
+                lock.forget()
+        for semaphore in list(self.semaphores.values()):
+            semaphore.forget()
+        if self.context_lock is not None:
+            self.context_lock.forget()
+        # its thread didn't come along
+        self.heartbeat = None
+        self._backend = None
 
     def __enter__(self):
         """
@@ -100,3 +278,11 @@ class Lox(object):
         if exc_val:
             return False
         return self
+
+
+def _forget_inherited_locks():
+    for lox in list(_instances):
+        lox.forget_locks()
+
+
+at_fork_in_child(_forget_inherited_locks)
@@ -0,0 +1,68 @@
+from __future__ import unicode_literals
+
+import unittest
+
+from lox.backends.hash_ring import HashRing
+
+
+class HashRingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = ["bagel_{}".format(i) for i in range(10000)]
+
+    def counts(self, ring):
+        counts = dict((name, 0) for name in ring.nodes)
+        for key in self.keys:
+            counts[ring.get_name(key)] += 1
+        return counts
+
+    def test_get__stable(self):
+        ring = HashRing()
+        ring.add("a")
+        ring.add("b")
+        other = HashRing()
+        other.add("b")
+        other.add("a")
+        # placement only depends on the names, not the order they were added in
+        self.assertEqual([ring.get(key) for key in self.keys], [other.get(key) for key in self.keys])
+
+    def test_get__empty(self):
+        with self.assertRaises(LookupError):
+            HashRing().get("bagel")
+
+    def test_distribution__weights(self):
+        ring = HashRing()
+        ring.add("a")
+        ring.add("b")
+        ring.add("c", weight=2)
+        counts = self.counts(ring)
+        # roughly 1:1:2
+        self.assertAlmostEqual(counts["a"] / 10000.0, 0.25, delta=0.05)
+        self.assertAlmostEqual(counts["b"] / 10000.0, 0.25, delta=0.05)
+        self.assertAlmostEqual(counts["c"] / 10000.0, 0.5, delta=0.05)
+
+    def test_add__minimal_remapping(self):
+        ring = HashRing()
+        for name in "abc":
+            ring.add(name)
+        before = dict((key, ring.get_name(key)) for key in self.keys)
+        ring.add("d")
+        moved = [key for key in self.keys if ring.get_name(key) != before[key]]
+        # only about a quarter of the keys move, and all of them to the new node
+        self.assertAlmostEqual(len(moved) / 10000.0, 0.25, delta=0.05)
+        self.assertEqual(set(ring.get_name(key) for key in moved), {"d"})
+        # and taking it away puts them back
+        ring.remove("d")
+        self.assertEqual(dict((key, ring.get_name(key)) for key in self.keys), before)
+
+    def test_add__bad_params(self):
+        ring = HashRing()
+        ring.add("a")
+        with self.assertRaises(ValueError):
+            ring.add("a")
+        with self.assertRaises(ValueError):
+            ring.add("b", weight=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
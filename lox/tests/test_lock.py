@@ -1,14 +1,17 @@
 from __future__ import unicode_literals
 
+import threading
+import time
 import unittest
-from uuid import UUID
 
 import mox
 
 from lox.lox import Lox
 from lox.core.lock import Lock
+from lox.backends.base_lox_backend import BackendLock
 from lox.core import states
 from lox.core import errors
+from lox.core.metrics import HistogramCollector
 
 class LockTests(mox.MoxTestBase):
 
@@ -45,11 +48,22 @@ class LockTests(mox.MoxTestBase):
 
     def test_acquire__without_id(self):
         self.lock = Lock(self.lox)
-        # should assign a UUID automatically
-        self.assertIsInstance(self.lock.id, UUID)
+        # should assign a unique id automatically
+        self.assertIsInstance(self.lock.id, type(""))
+        self.assertNotEqual(self.lock.id, Lock(self.lox).id)
         self.lock.acquire()
         self.assertEqual(self.lock.state, states.STATE_ACQUIRED)
 
+    def test_init__compact(self):
+        # no per-lock __dict__, on either side
+        self.lock = Lock(self.lox, 1)
+        self.assertFalse(hasattr(self.lock, "__dict__"))
+        backend_lock = BackendLock(None, "sesamebagel", 1, acquire_ts=0.0)
+        self.assertFalse(hasattr(backend_lock, "__dict__"))
+        # details are built when asked for
+        self.assertEqual(backend_lock.key, "sesamebagel_1")
+        self.assertEqual(backend_lock.acquire_ts.year, 1970)
+
     def test_acquire__with_retry(self):
         self.lock = Lock(self.lox)
         self.lock.acquire(retry=True)
@@ -82,6 +96,42 @@ class LockTests(mox.MoxTestBase):
 
         self.assertEqual(self.lock.state, states.STATE_ACQUIRED)
 
+    def test_acquire__wait_for_release(self):
+        self.lock = Lock(self.lox)
+
+        # stub out the back end so we can simulate a release notification
+        self.mox.StubOutWithMock(self.lock.backend, "acquire")
+        self.mox.StubOutWithMock(self.lock.backend, "wait_for_release")
+
+        # one fail, then wait instead of sleeping, then success
+        self.lock.backend.acquire(self.lock.parent.name, self.lock.id, expires_seconds=None).AndRaise(errors.LockInUseException)
+        self.lock.backend.wait_for_release(self.lock.parent.name, self.lock.id, 5)
+        self.lock.backend.acquire(self.lock.parent.name, self.lock.id, expires_seconds=None).AndReturn("notified")
+
+        self.mox.ReplayAll()
+
+        self.lock.acquire(retry=True, num_tries=2, retry_interval_seconds=5, wait_for_release=True)
+
+        self.assertEqual(self.lock.state, states.STATE_ACQUIRED)
+
+    def test_acquire__shared(self):
+        self.lock = Lock(self.lox, mode="shared")
+
+        # shared locks go through acquire_shared, and wait for release as shared
+        self.mox.StubOutWithMock(self.lock.backend, "acquire_shared")
+        self.mox.StubOutWithMock(self.lock.backend, "wait_for_release")
+
+        self.lock.backend.acquire_shared(self.lock.parent.name, self.lock.id, expires_seconds=None).AndRaise(errors.LockInUseException)
+        self.lock.backend.wait_for_release(self.lock.parent.name, self.lock.id, 5, shared=True)
+        self.lock.backend.acquire_shared(self.lock.parent.name, self.lock.id, expires_seconds=None).AndReturn("shared")
+
+        self.mox.ReplayAll()
+
+        self.lock.acquire(retry=True, num_tries=2, retry_interval_seconds=5, wait_for_release=True)
+
+        self.assertEqual(self.lock.state, states.STATE_ACQUIRED)
+        self.assertTrue(self.lock.shared)
+
     def test_acquire__fails_multiple_tries(self):
         self.lock = Lock(self.lox)
 
@@ -100,6 +150,29 @@ class LockTests(mox.MoxTestBase):
 
         self.assertEqual(self.lock.state, states.STATE_ACQUIRING_TIMEDOUT)
 
+    def test_acquire__timeout(self):
+        self.lock = Lock(self.lox)
+        budgets = []
+
+        def in_use(lox_name, lock_id, expires_seconds=None, timeout=None):
+            budgets.append(timeout)
+            raise errors.LockInUseException
+
+        self.stubs.Set(self.lock.backend, "acquire", in_use)
+
+        start = time.time()
+        with self.assertRaises(errors.LockTimeoutException):
+            self.lock.acquire(timeout=0.5, retry_interval_seconds=0.1)
+        elapsed = time.time() - start
+
+        self.assertEqual(self.lock.state, states.STATE_ACQUIRING_TIMEDOUT)
+        self.assertGreaterEqual(elapsed, 0.5)
+        self.assertLess(elapsed, 1)
+        # every backend call gets the remaining budget, which keeps shrinking
+        self.assertGreater(len(budgets), 2)
+        self.assertEqual(budgets, sorted(budgets, reverse=True))
+        self.assertLessEqual(budgets[0], 0.5)
+
     def test_acquire__fails_no_retries(self):
         self.lock = Lock(self.lox)
 
@@ -130,6 +203,149 @@ class LockTests(mox.MoxTestBase):
         self.lock.acquire(expires_seconds=1)
         self.assertEqual(self.lock.expires_seconds, 1)
 
+    def test_acquire_group__one_backend_call(self):
+        locks = [Lock(self.lox, 1), Lock(self.lox, 2)]
+        backend = self.lox.backend
+
+        # stub out the back end so we can count calls
+        self.mox.StubOutWithMock(backend, "acquire")
+        self.mox.StubOutWithMock(backend, "acquire_many")
+
+        backend.acquire_many(self.lox.name, [1, 2], expires_seconds=None).AndRaise(errors.LockInUseException)
+        backend.acquire_many(self.lox.name, [1, 2], expires_seconds=None).AndReturn(["one", "two"])
+
+        self.mox.ReplayAll()
+
+        Lock.acquire_group(locks, retry=True, num_tries=2, retry_interval_seconds=0.1)
+
+        self.assertEqual([lock.state for lock in locks], [states.STATE_ACQUIRED] * 2)
+        self.assertEqual([lock._lock for lock in locks], ["one", "two"])
+
+    def test_acquire_group__fails(self):
+        locks = [Lock(self.lox, 1), Lock(self.lox, 2)]
+        self.mox.StubOutWithMock(self.lox.backend, "acquire_many")
+        self.lox.backend.acquire_many(self.lox.name, [1, 2], expires_seconds=None).AndRaise(errors.LockInUseException)
+
+        self.mox.ReplayAll()
+
+        with self.assertRaises(errors.LockInUseException):
+            Lock.acquire_group(locks)
+
+        self.assertEqual([lock.state for lock in locks], [states.STATE_ACQUIRING_EXCEPTION] * 2)
+
+    ## ---- local coordination ---- ##
+
+    def __stub_backend_calls(self, lox):
+        calls = []
+
+        def acquire(lox_name, lock_id, expires_seconds=None, timeout=None):
+            calls.append("acquire")
+            return BackendLock(None, lox_name, lock_id)
+
+        def release(lock):
+            calls.append("release")
+
+        self.stubs.Set(lox.backend, "acquire", acquire)
+        self.stubs.Set(lox.backend, "release", release)
+        return calls
+
+    def test_acquire__local_contention(self):
+        lox = Lox("sesamebagel", config=dict(self.config, local_coordination=True))
+        calls = self.__stub_backend_calls(lox)
+        first, second = Lock(lox, 1), Lock(lox, 1)
+        first.acquire()
+        # settled in-process, without asking the backend
+        with self.assertRaises(errors.LockInUseException):
+            second.acquire()
+        self.assertEqual(second.state, states.STATE_ACQUIRING_EXCEPTION)
+        first.release()
+        third = Lock(lox, 1)
+        third.acquire()
+        third.release()
+        self.assertEqual(calls, ["acquire", "release", "acquire", "release"])
+
+    def test_release__local_handoff(self):
+        lox = Lox("sesamebagel", config=dict(self.config, local_coordination=True, local_handoff=True))
+        calls = self.__stub_backend_calls(lox)
+        first, second = Lock(lox, 1), Lock(lox, 1)
+        first.acquire()
+        waiter = threading.Thread(target=second.acquire, kwargs={"timeout": 5, "retry_interval_seconds": 5})
+        waiter.start()
+        while second.state != states.STATE_ACQUIRING_RETRYING:
+            time.sleep(0.01)
+        start = time.time()
+        first.release()
+        waiter.join()
+        # woken up right away, and given the backend lock as is
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(second.state, states.STATE_ACQUIRED)
+        self.assertIs(second._lock, first._lock)
+        second.release()
+        self.assertEqual(calls, ["acquire", "release"])
+
+    ## ---- instrumentation ---- ##
+
+    def test_observer(self):
+        collector = HistogramCollector()
+        lox = Lox("sesamebagel", config=self.config, observer=collector)
+        lock = Lock(lox, 1)
+        self.mox.StubOutWithMock(lox.backend, "acquire")
+        self.mox.StubOutWithMock(lox.backend, "release")
+        lox.backend.acquire(lox.name, 1, expires_seconds=None).AndRaise(errors.LockInUseException)
+        lox.backend.acquire(lox.name, 1, expires_seconds=None).AndReturn(BackendLock(None, lox.name, 1))
+        lox.backend.release(mox.IsA(BackendLock))
+
+        self.mox.ReplayAll()
+
+        lock.acquire(retry=True, retry_interval_seconds=0.1)
+        lock.release()
+
+        metrics = collector.snapshot()[lox.name]
+        self.assertEqual(metrics["acquired"], 1)
+        self.assertEqual(metrics["contended"], 1)
+        self.assertEqual(metrics["released"], 1)
+        self.assertEqual(metrics["acquire_tries"]["max"], 2)
+        self.assertGreaterEqual(metrics["acquire_wait_seconds"]["max"], 0.1)
+        self.assertGreaterEqual(metrics["acquire_seconds"]["max"], metrics["acquire_wait_seconds"]["max"])
+        self.assertEqual(metrics["backend_acquire_seconds"]["count"], 2)
+        self.assertEqual(metrics["backend_release_seconds"]["count"], 1)
+        self.assertEqual(metrics["hold_seconds"]["count"], 1)
+
+    ## ---- extend ---- ##
+
+    def test_extend_group__one_backend_call(self):
+        locks = [Lock(self.lox, 1), Lock(self.lox, 2)]
+        for lock in locks:
+            lock.state = states.STATE_ACQUIRED
+            lock._lock = BackendLock(None, self.lox.name, lock.id)
+        backend_locks = [lock._lock for lock in locks]
+
+        self.mox.StubOutWithMock(self.lox.backend, "extend_many")
+        # the 2nd one has been lost in the meantime
+        self.lox.backend.extend_many(backend_locks, [5, 10]).AndReturn([backend_locks[1]])
+
+        self.mox.ReplayAll()
+
+        lost = Lock.extend_group(locks, [5, 10])
+
+        self.assertEqual(lost, [locks[1]])
+        self.assertEqual(locks[0].state, states.STATE_ACQUIRED)
+        self.assertEqual(locks[0].expires_seconds, 5)
+        self.assertEqual(locks[1].state, states.STATE_EXPIRED)
+
+    def test_extend__lost(self):
+        self.lock = Lock(self.lox)
+        self.lock.acquire(expires_seconds=0.2)
+        time.sleep(0.4)
+        with self.assertRaises(errors.LockExpiredException):
+            self.lock.extend(1)
+        self.assertEqual(self.lock.state, states.STATE_EXPIRED)
+
+    def test_extend__unexpected_state(self):
+        self.lock = Lock(self.lox)
+        with self.assertRaises(errors.UnexpectedStateException):
+            self.lock.extend(1)
+
     ## ---- release ---- ##
 
     def test_release(self):
@@ -1,5 +1,11 @@
 from __future__ import unicode_literals
 
+import os
+import threading
+import time
+import traceback
+import unittest
+
 from lox.lox import DEFAULT_LOX_CONFIG
 from lox.lox import Lox
 from lox.core.lock import Lock
@@ -8,9 +14,19 @@ from lox.core.states import *
 
 class LoxTestsBaseMixin(object):
 
+    # whether the backend wakes up waiters when a lock is released, rather than have them sleep
+    notifies_releases = True
+
     def tearDown(self):
         self.lox.clear_all()
 
+    def test_backend__lazy_and_shared(self):
+        # nothing connects until a backend is needed
+        self.assertIsNone(self.lox._backend)
+        other = Lox("{}_other".format(self.lox.name), config=self.config)
+        # and then all the Lox with the same settings share one, whatever their names
+        self.assertIs(other.backend, self.lox.backend)
+
     def test_acquire__basic(self):
         # get a lock
         lock = self.lox.acquire(1)
@@ -31,12 +47,87 @@ class LoxTestsBaseMixin(object):
         with self.assertRaises(LockAlreadyAcquiredException):
             self.lox.acquire(1)
 
+    def test_acquire__failed_not_tracked(self):
+        self.lox.acquire(1)
+        other = Lox(self.lox.name, config=self.config)
+        with self.assertRaises(LockInUseException):
+            other.acquire(1)
+        self.assertEqual(other.locks, {})
+        with self.assertRaises(ValueError):
+            other.acquire(2, timeout=-1)
+        self.assertEqual(other.locks, {})
+        # neither failure keeps the ID from being acquired later
+        other.acquire(2)
+        other.release(2)
+        self.lox.release(1)
+        other.acquire(1)
+        other.release(1)
+
     def test_acquire__twice_separate_threads_raises(self):
         lock = self.lox.acquire(1)
         # make sure it busts if we try this again, even without the local in the instance dict
         del self.lox.locks[1]
         with self.assertRaises(LockInUseException):
             self.lox.acquire(1)
+        # no longer tracked, so clear_all won't let go of it for us
+        lock.release()
+
+    def test_acquire__same_id_shared_lox(self):
+        # threads sharing one Lox: only one of them gets to track (and so acquire) the ID
+        results = []
+
+        def worker():
+            try:
+                results.append(self.lox.acquire(1))
+            except BaseException as ex:
+                results.append(ex)
+
+        threads = [threading.Thread(target=worker) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for result in results:
+            if not isinstance(result, (Lock, LockAlreadyAcquiredException)):
+                raise result
+        locks = [result for result in results if isinstance(result, Lock)]
+        self.assertEqual(len(locks), 1)
+        self.assertEqual(self.lox.locks, {1: locks[0]})
+        self.lox.release(1)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs os.fork")
+    def test_fork__child_starts_over(self):
+        lock = self.lox.acquire(1)
+        backend = self.lox.backend
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # never return into the test runner from the child
+            code = 1
+            try:
+                os.close(read_fd)
+                # with a backend of our own
+                self.assertIsNot(self.lox.backend, backend)
+                # the parent's lock is still the parent's: forgotten, and not ours to release
+                self.assertEqual(self.lox.locks, {})
+                with self.assertRaises(UnexpectedStateException):
+                    lock.release()
+                self.lox.acquire(2)
+                self.lox.release(2)
+                code = 0
+            except BaseException:
+                os.write(write_fd, traceback.format_exc().encode("utf-8"))
+            finally:
+                os._exit(code)
+        os.close(write_fd)
+        with os.fdopen(read_fd, "rb") as reader:
+            error = reader.read().decode("utf-8")
+        status = os.waitpid(pid, 0)[1]
+        self.assertEqual(status, 0, error)
+        # and the parent's connections weren't touched by the child
+        self.assertIs(self.lox.backend, backend)
+        self.assertEqual(self.lox.locks, {1: lock})
+        self.lox.release(1)
 
     def test_release__basic(self):
         # get two locks
@@ -74,3 +165,321 @@ class LoxTestsBaseMixin(object):
             self.assertEqual(test_lox.context_lock.state, STATE_ACQUIRED)
         self.assertEqual(test_lox.context_lock.state, STATE_RELEASED)
         return test_lox
+
+    def test_acquire__wait_for_release(self):
+        if not self.notifies_releases:
+            return
+        config = dict(self.config, wait_for_release=True)
+        holder = Lox(self.lox.name, config=config)
+        waiter = Lox(self.lox.name, config=config)
+        holder.acquire(1)
+        timer = threading.Timer(0.3, holder.release, args=(1,))
+        timer.start()
+        start = time.time()
+        # without a notification this would sit out the whole interval
+        lock = waiter.acquire(1, retry=True, num_tries=2, retry_interval_seconds=5)
+        elapsed = time.time() - start
+        timer.join()
+        waiter.release(1)
+        self.assertEqual(lock.state, STATE_RELEASED)
+        self.assertLess(elapsed, 3)
+
+    def test_acquire_many__basic(self):
+        locks = self.lox.acquire_many([3, 1, 2])
+        # stable order, whatever order they were asked for in
+        self.assertEqual([lock.id for lock in locks], [1, 2, 3])
+        for lock in locks:
+            self.assertEqual(lock.state, STATE_ACQUIRED)
+        self.assertEqual(self.lox.locks, {1: locks[0], 2: locks[1], 3: locks[2]})
+        released = self.lox.release_many([1, 2, 3])
+        for lock in released:
+            self.assertEqual(lock.state, STATE_RELEASED)
+        self.assertEqual(self.lox.locks, {})
+        # and they really are free again
+        self.lox.acquire_many([1, 2, 3])
+
+    def test_acquire_many__all_or_nothing(self):
+        other = Lox(self.lox.name, config=self.config)
+        other.acquire(2)
+        with self.assertRaises(LockInUseException):
+            self.lox.acquire_many([1, 2, 3])
+        self.assertEqual(self.lox.locks, {})
+        # 1 and 3 must not have been left behind
+        other.acquire(1)
+        other.acquire(3)
+        other.release_many([1, 2, 3])
+
+    def test_acquire_many__bad_ids(self):
+        with self.assertRaises(ValueError):
+            self.lox.acquire_many([])
+        with self.assertRaises(ValueError):
+            self.lox.acquire_many([1, 1])
+        self.lox.acquire(1)
+        with self.assertRaises(LockAlreadyAcquiredException):
+            self.lox.acquire_many([1, 2])
+
+    def test_release_many__not_found(self):
+        self.lox.acquire_many([1, 2])
+        with self.assertRaises(LockNotFoundException):
+            self.lox.release_many([1, 3])
+        # nothing was released
+        self.assertEqual(sorted(self.lox.locks), [1, 2])
+
+    def test_extend(self):
+        lock = self.lox.acquire(1, expires_seconds=0.5)
+        self.lox.extend(1, 2)
+        self.assertEqual(lock.expires_seconds, 2)
+        # well past the original expiration, it's still ours
+        time.sleep(0.8)
+        self.assertEqual(lock.state, STATE_ACQUIRED)
+        other = Lox(self.lox.name, config=self.config)
+        with self.assertRaises(LockInUseException):
+            other.acquire(1)
+        with self.assertRaises(LockNotFoundException):
+            self.lox.extend(2, 1)
+
+    def test_heartbeat(self):
+        config = dict(self.config, heartbeat_interval_seconds=0.2)
+        beating_lox = Lox(self.lox.name, config=config)
+        self.addCleanup(beating_lox.stop_heartbeat)
+        lock = beating_lox.acquire(1, expires_seconds=0.5)
+        self.assertIsNotNone(beating_lox.heartbeat)
+        time.sleep(1.2)
+        self.assertEqual(lock.state, STATE_ACQUIRED)
+        with self.assertRaises(LockInUseException):
+            self.lox.acquire(1)
+        beating_lox.release(1)
+
+
+class SharedLocksTestsMixin(object):
+    """ For backends that support mode="shared"; writer_preference says whether they implement that too. """
+
+    writer_preference = True
+
+    def test_shared__readers_share(self):
+        config = dict(self.config, writer_preference_seconds=0)
+        reader = Lox(self.lox.name, config=config)
+        lock = self.lox.acquire(1, mode="shared")
+        self.assertEqual(lock.mode, "shared")
+        reader.acquire(1, mode="shared")
+        # no writer while there are readers
+        with self.assertRaises(LockInUseException):
+            Lox(self.lox.name, config=config).acquire(1)
+        self.lox.release(1)
+        with self.assertRaises(LockInUseException):
+            Lox(self.lox.name, config=config).acquire(1)
+        reader.release(1)
+        writer = Lox(self.lox.name, config=config)
+        writer.acquire(1)
+        # and no readers while there is a writer
+        with self.assertRaises(LockInUseException):
+            Lox(self.lox.name, config=config).acquire(1, mode="shared")
+        writer.release(1)
+
+    def test_shared__bad_mode(self):
+        with self.assertRaises(ValueError):
+            self.lox.acquire(1, mode="sideways")
+        self.assertEqual(self.lox.locks, {})
+
+    def test_shared__writer_preference(self):
+        if not self.writer_preference:
+            return
+        self.lox.acquire(1, mode="shared")
+        with self.assertRaises(LockInUseException):
+            Lox(self.lox.name, config=self.config).acquire(1)
+        # the writer has been turned away, so new readers are kept out until it gets its turn
+        with self.assertRaises(LockInUseException):
+            Lox(self.lox.name, config=self.config).acquire(1, mode="shared")
+        self.lox.release(1)
+        writer = Lox(self.lox.name, config=self.config)
+        writer.acquire(1)
+        writer.release(1)
+        # and once it has, readers are welcome again
+        reader = Lox(self.lox.name, config=self.config)
+        reader.acquire(1, mode="shared")
+        reader.release(1)
+
+    def test_shared__no_writer_preference(self):
+        config = dict(self.config, writer_preference_seconds=0)
+        self.lox.acquire(1, mode="shared")
+        with self.assertRaises(LockInUseException):
+            Lox(self.lox.name, config=config).acquire(1)
+        reader = Lox(self.lox.name, config=config)
+        reader.acquire(1, mode="shared")
+        reader.release(1)
+
+    def test_shared__expiration(self):
+        # a reader that never comes back doesn't keep writers out for good
+        Lox(self.lox.name, config=self.config).acquire(1, mode="shared", expires_seconds=0.2)
+        time.sleep(0.4)
+        writer = Lox(self.lox.name, config=self.config)
+        writer.acquire(1)
+        writer.release(1)
+
+    def test_shared__extend(self):
+        lock = self.lox.acquire(1, mode="shared", expires_seconds=0.3)
+        self.lox.extend(1, 2)
+        time.sleep(0.5)
+        self.assertEqual(lock.state, STATE_ACQUIRED)
+        with self.assertRaises(LockInUseException):
+            Lox(self.lox.name, config=dict(self.config, writer_preference_seconds=0)).acquire(1)
+        self.lox.release(1)
+
+    def test_shared__wait_for_release(self):
+        if not self.notifies_releases:
+            return
+        config = dict(self.config, wait_for_release=True, writer_preference_seconds=0)
+        reader = Lox(self.lox.name, config=config)
+        writer = Lox(self.lox.name, config=config)
+        reader.acquire(1, mode="shared")
+        timer = threading.Timer(0.3, reader.release, args=(1,))
+        timer.start()
+        start = time.time()
+        writer.acquire(1, retry=True, num_tries=2, retry_interval_seconds=5)
+        self.assertLess(time.time() - start, 3)
+        timer.join()
+        # and the other way around
+        timer = threading.Timer(0.3, writer.release, args=(1,))
+        timer.start()
+        start = time.time()
+        reader.acquire(1, mode="shared", retry=True, num_tries=2, retry_interval_seconds=5)
+        self.assertLess(time.time() - start, 3)
+        timer.join()
+        reader.release(1)
+
+
+class SemaphoreTestsMixin(object):
+    """ For backends that support Lox.semaphore. """
+
+    def test_semaphore__permits(self):
+        semaphore = self.lox.semaphore("pool", permits=2)
+        self.assertIs(self.lox.semaphore("pool", permits=2), semaphore)
+        first = semaphore.acquire()
+        other = Lox(self.lox.name, config=self.config).semaphore("pool", permits=2)
+        other.acquire()
+        # all permits are taken
+        with self.assertRaises(LockInUseException):
+            other.acquire()
+        with self.assertRaises(LockInUseException):
+            semaphore.acquire()
+        semaphore.release(first)
+        self.assertEqual(first.state, STATE_RELEASED)
+        self.assertEqual(semaphore.held, [])
+        other.acquire()
+        other.release()
+        other.release()
+        with self.assertRaises(LockNotFoundException):
+            other.release()
+
+    def test_semaphore__bad_permits(self):
+        with self.assertRaises(ValueError):
+            self.lox.semaphore("pool", permits=0)
+        self.lox.semaphore("pool", permits=2)
+        with self.assertRaises(ValueError):
+            self.lox.semaphore("pool", permits=3)
+
+    def test_semaphore__no_writer(self):
+        # permits are shared locks on the semaphore's ID, so they don't mix with an exclusive lock on it
+        self.lox.semaphore("pool", permits=2).acquire()
+        with self.assertRaises(LockInUseException):
+            Lox(self.lox.name, config=dict(self.config, writer_preference_seconds=0)).acquire("pool")
+
+    def test_semaphore__expiration(self):
+        semaphore = self.lox.semaphore("pool", permits=1)
+        permit = semaphore.acquire(expires_seconds=0.2)
+        other = Lox(self.lox.name, config=self.config).semaphore("pool", permits=1)
+        with self.assertRaises(LockInUseException):
+            other.acquire()
+        time.sleep(0.4)
+        other.release(other.acquire())
+        self.assertIn(permit.state, (STATE_ACQUIRED, STATE_EXPIRED))
+
+    def test_semaphore__wait_for_release(self):
+        config = dict(self.config, wait_for_release=True)
+        semaphore = Lox(self.lox.name, config=config).semaphore("pool", permits=1)
+        other = Lox(self.lox.name, config=config).semaphore("pool", permits=1)
+        semaphore.acquire()
+        timer = threading.Timer(0.3, semaphore.release)
+        timer.start()
+        start = time.time()
+        other.acquire(retry=True, num_tries=2, retry_interval_seconds=5)
+        self.assertLess(time.time() - start, 3)
+        timer.join()
+        other.release()
+
+
+class FairLocksTestsMixin(object):
+    """ For backends that support fair=True. """
+
+    def test_fair__in_turn(self):
+        config = dict(self.config, fair_ticket_seconds=2)
+        holder = Lox(self.lox.name, config=config)
+        holder.acquire(1, fair=True)
+        order = []
+
+        def wait_in_line(name):
+            waiter = Lox(self.lox.name, config=config)
+            waiter.acquire(1, fair=True, timeout=5)
+            order.append(name)
+            time.sleep(0.1)
+            waiter.release(1)
+
+        threads = []
+        for name in ("first", "second"):
+            threads.append(threading.Thread(target=wait_in_line, args=(name,)))
+            threads[-1].start()
+            time.sleep(0.2)
+        start = time.time()
+        holder.release(1)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ["first", "second"])
+        # each was woken up by the release before it, rather than polling every second
+        self.assertLess(time.time() - start, 0.9)
+
+    def test_fair__no_skipping_the_line(self):
+        backend = self.lox.backend
+        holder = backend.acquire_fair(self.lox.name, 1, "holder", 10)
+        with self.assertRaises(LockInUseException):
+            backend.acquire_fair(self.lox.name, 1, "first", 10)
+        with self.assertRaises(LockInUseException):
+            backend.acquire_fair(self.lox.name, 1, "second", 10)
+        backend.release(holder)
+        # free, but not second's turn yet
+        with self.assertRaises(LockInUseException):
+            backend.acquire_fair(self.lox.name, 1, "second", 10)
+        backend.release(backend.acquire_fair(self.lox.name, 1, "first", 10))
+        backend.release(backend.acquire_fair(self.lox.name, 1, "second", 10))
+
+    def test_fair__abandoned_ticket(self):
+        backend = self.lox.backend
+        holder = backend.acquire_fair(self.lox.name, 1, "holder", 10)
+        with self.assertRaises(LockInUseException):
+            backend.acquire_fair(self.lox.name, 1, "gone", 0.2)
+        with self.assertRaises(LockInUseException):
+            backend.acquire_fair(self.lox.name, 1, "patient", 10)
+        backend.release(holder)
+        with self.assertRaises(LockInUseException):
+            backend.acquire_fair(self.lox.name, 1, "patient", 10)
+        # "gone" never came back for its turn
+        time.sleep(0.3)
+        backend.release(backend.acquire_fair(self.lox.name, 1, "patient", 10))
+
+    def test_fair__give_up(self):
+        holder = Lox(self.lox.name, config=self.config)
+        holder.acquire(1, fair=True)
+        with self.assertRaises(LockTimeoutException):
+            Lox(self.lox.name, config=self.config).acquire(1, fair=True, timeout=0.2)
+        holder.release(1)
+        # the one that gave up left the line
+        waiter = Lox(self.lox.name, config=self.config)
+        waiter.acquire(1, fair=True)
+        waiter.release(1)
+
+    def test_fair__exclusive_only(self):
+        with self.assertRaises(ValueError):
+            self.lox.acquire(1, mode="shared", fair=True)
+        # but the config setting only applies to exclusive locks
+        reader = Lox(self.lox.name, config=dict(self.config, fair=True))
+        self.assertFalse(reader.acquire(2, mode="shared").fair)
+        reader.release(2)
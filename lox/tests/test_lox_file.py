@@ -0,0 +1,70 @@
+from __future__ import unicode_literals
+
+import multiprocessing
+import shutil
+import tempfile
+import time
+import unittest
+
+from lox.lox import Lox
+from lox.backends.file_lox_backend import FileLoxBackend
+from lox.core.errors import *
+from lox.core.states import *
+
+from test_lox_base import LoxTestsBaseMixin, SharedLocksTestsMixin
+
+
+def hold(config, acquired, done):
+    lox = Lox("ryebagel", config=config)
+    lox.acquire(1)
+    acquired.set()
+    done.wait(5)
+    # exits without releasing
+
+
+class LoxFileTests(LoxTestsBaseMixin, SharedLocksTestsMixin, unittest.TestCase):
+
+    writer_preference = False
+    notifies_releases = False
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.config = {"backend": {"file": self.directory}}
+        self.lox = Lox("ryebagel", config=self.config)
+        self.lox.clear_all()
+
+    def test_init(self):
+        self.assertIsInstance(self.lox.backend, FileLoxBackend)
+        self.assertEqual(self.lox.locks, {})
+
+    def test_semaphore__unsupported(self):
+        with self.assertRaises(NotImplementedError):
+            self.lox.semaphore("pool", permits=2).acquire()
+
+    def test_fair__unsupported(self):
+        with self.assertRaises(NotImplementedError):
+            self.lox.acquire(1, fair=True)
+
+    def test_acquire__other_process(self):
+        acquired, done = multiprocessing.Event(), multiprocessing.Event()
+        holder = multiprocessing.Process(target=hold, args=(self.config, acquired, done))
+        holder.start()
+        self.assertTrue(acquired.wait(5))
+        with self.assertRaises(LockInUseException):
+            Lox(self.lox.name, config=self.config).acquire(1)
+        # the lock goes away with the process that held it
+        done.set()
+        holder.join()
+        lock = self.lox.acquire(1)
+        self.assertEqual(lock.state, STATE_ACQUIRED)
+
+    def test_acquire__expiration__check_state(self):
+        lock = self.lox.acquire(1, expires_seconds=0.2)
+        time.sleep(0.5)
+        self.assertEqual(lock.state, STATE_EXPIRED)
+        Lox(self.lox.name, config=self.config).acquire(1)
+
+
+if __name__ == '__main__':
+    unittest.main()
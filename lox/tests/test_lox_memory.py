@@ -0,0 +1,46 @@
+from __future__ import unicode_literals
+
+import unittest
+import time
+
+from lox.lox import Lox
+from lox.backends.memory_lox_backend import MemoryLoxBackend
+from lox.core.errors import *
+from lox.core.states import *
+
+from test_lox_base import LoxTestsBaseMixin, SharedLocksTestsMixin, SemaphoreTestsMixin, \
+    FairLocksTestsMixin
+
+class LoxMemoryTests(LoxTestsBaseMixin, SharedLocksTestsMixin, SemaphoreTestsMixin, FairLocksTestsMixin,
+                     unittest.TestCase):
+
+    def setUp(self):
+        self.config = {"backend": {"memory": "tests"}}
+        self.lox = Lox("pumpernickelbagel", config=self.config)
+        self.lox.clear_all()
+
+    def test_init(self):
+        self.assertIsInstance(self.lox.backend, MemoryLoxBackend)
+        self.assertEqual(self.lox.locks, {})
+
+    def test_acquire__expiration__takeover(self):
+        lock = self.lox.acquire(1, expires_seconds=0.2)
+        with self.assertRaises(LockInUseException):
+            Lox(self.lox.name, config=self.config).acquire(1)
+        time.sleep(0.3)
+        other = Lox(self.lox.name, config=self.config)
+        other.acquire(1)
+        # the old holder releasing late must not free the new holder's lock
+        lock.release()
+        with self.assertRaises(LockInUseException):
+            Lox(self.lox.name, config=self.config).acquire(1)
+        other.release(1)
+
+    def test_namespaces(self):
+        self.lox.acquire(1)
+        elsewhere = Lox(self.lox.name, config={"backend": {"memory": "elsewhere"}})
+        elsewhere.release(elsewhere.acquire(1).id)
+
+
+if __name__ == '__main__':
+    unittest.main()
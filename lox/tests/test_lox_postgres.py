@@ -2,18 +2,22 @@ from __future__ import unicode_literals
 
 import unittest
 from datetime import datetime
+import threading
 import time
 
 import psycopg2
 import pytz
 
 from lox.lox import Lox
+from lox.backends.postgres_lox_backend import PostgresLoxBackend
 from lox.core.lock import Lock
 from lox.core.errors import *
 from lox.core.states import *
-from test_lox_base import LoxTestsBaseMixin
+from test_lox_base import LoxTestsBaseMixin, SharedLocksTestsMixin, SemaphoreTestsMixin, \
+    FairLocksTestsMixin
 
-class LoxPostgresTests(LoxTestsBaseMixin, unittest.TestCase):
+class LoxPostgresTests(LoxTestsBaseMixin, SharedLocksTestsMixin, SemaphoreTestsMixin, FairLocksTestsMixin,
+                       unittest.TestCase):
 
     def setUp(self):
         super(LoxPostgresTests, self).setUp()
@@ -30,7 +34,7 @@ class LoxPostgresTests(LoxTestsBaseMixin, unittest.TestCase):
     def test_ensure_schema__basic(self):
         # make sure the lox table doesn't exist in the db
         # NOTE this is destructive, we should really run this on a test db
-        self.lox.backend.cursor.execute("""
+        self.__execute("""
           drop table if exists lox;
         """)
 
@@ -38,29 +42,34 @@ class LoxPostgresTests(LoxTestsBaseMixin, unittest.TestCase):
         self.lox.backend.ensure_schema()
 
         # validate we can directly talk to the lox table in the db
+        cursor = self.__checkout_cursor()
+
+        # and that the expiration index is there
+        cursor.execute("""SELECT to_regclass('public.ix_lox_expire_ts') IS NOT NULL;""")
+        self.assertTrue(cursor.fetchone()[0])
 
         # first with not null expiration
-        test_row = self.__insert_test_row(expire_null=False)
-        db_row = self.__select_test_row(test_row, expire_null=False)
+        test_row = self.__insert_test_row(cursor, expire_null=False)
+        db_row = self.__select_test_row(cursor, test_row, expire_null=False)
         self.assertEqual(db_row, test_row)
 
         # then with null expiration
-        test_row = self.__insert_test_row(expire_null=True)
-        db_row = self.__select_test_row(test_row, expire_null=True)
+        test_row = self.__insert_test_row(cursor, expire_null=True)
+        db_row = self.__select_test_row(cursor, test_row, expire_null=True)
         self.assertEqual(db_row, test_row)
 
-        # don't persist
-        self.lox.backend.connection.rollback()
-
     def test_ensure_schema__wrong_columns(self):
         # make sure the lox table doesn't exist in the db
         # NOTE this is destructive, we should really run this on a test db
 
         # and create another table with the same name but different schema
-        self.lox.backend.cursor.execute("""
+        self.__execute("""
           drop table if exists lox;
           create table lox (blah int);
         """)
+        # put things back for the next tests, which share the backend that already checked the schema
+        self.addCleanup(self.lox.backend.ensure_schema)
+        self.addCleanup(self.__execute, "drop table if exists lox;")
 
         # create the table
         with self.assertRaises(SchemaConflictException):
@@ -71,7 +80,7 @@ class LoxPostgresTests(LoxTestsBaseMixin, unittest.TestCase):
         # NOTE this is destructive, we should really run this on a test db
 
         # and create another table with the same name but no primary key
-        self.lox.backend.cursor.execute("""
+        self.__execute("""
           drop table if exists lox;
           create table lox (
             key text NOT NULL,
@@ -84,34 +93,44 @@ class LoxPostgresTests(LoxTestsBaseMixin, unittest.TestCase):
         self.lox.backend.ensure_schema()
 
         # make sure the pk gets created by trying to insert 2 rows with the same key
-        test_row = self.__insert_test_row(expire_null=False)
-        db_row = self.__select_test_row(test_row, expire_null=False)
+        cursor = self.__checkout_cursor()
+        test_row = self.__insert_test_row(cursor, expire_null=False)
+        db_row = self.__select_test_row(cursor, test_row, expire_null=False)
         self.assertEqual(db_row, test_row)
 
         # 2nd insert should get a PK violation
         with self.assertRaises(psycopg2.IntegrityError):
-            self.__do_insert(test_row)
+            self.__do_insert(cursor, test_row)
+
+    def __execute(self, sql):
+        # runs and commits on a pooled connection
+        with self.lox.backend.cursor() as cursor:
+            cursor.execute(sql)
 
-        # don't persist
-        self.lox.backend.connection.rollback()
+    def __checkout_cursor(self):
+        # a connection of our own, rolled back and returned to the pool after the test so nothing persists
+        connection = self.lox.backend.checkout()
+        self.addCleanup(self.lox.backend.checkin, connection)
+        self.addCleanup(connection.rollback)
+        return connection.cursor()
 
-    def __insert_test_row(self, expire_null):
+    def __insert_test_row(self, cursor, expire_null):
         test_key = "test_{}".format(Lock.generate_id())
         test_ts = datetime.now(tz=pytz.UTC)
         if expire_null:
             test_row = (test_key, test_ts, None)
         else:
             test_row = (test_key, test_ts, test_ts)
-        self.__do_insert(test_row)
+        self.__do_insert(cursor, test_row)
         return test_row
 
-    def __do_insert(self, test_row):
-        self.lox.backend.cursor.execute("""
+    def __do_insert(self, cursor, test_row):
+        cursor.execute("""
           insert into lox (key, acquire_ts, expire_ts)
           values (%s, %s, %s);
         """, test_row)
 
-    def __select_test_row(self, test_row, expire_null):
+    def __select_test_row(self, cursor, test_row, expire_null):
         sql = """
           select * from lox
           where key = %s and acquire_ts = %s and expire_ts """
@@ -119,17 +138,173 @@ class LoxPostgresTests(LoxTestsBaseMixin, unittest.TestCase):
             sql += "is %s"
         else:
             sql += "= %s"
-        self.lox.backend.cursor.execute(sql, test_row)
-        return self.lox.backend.cursor.fetchone()
+        cursor.execute(sql, test_row)
+        return cursor.fetchone()
+
+    def test_ensure_schema__once_per_dsn(self):
+        self.lox.acquire(1)
+        calls = []
+        original = PostgresLoxBackend.ensure_schema
+        PostgresLoxBackend.ensure_schema = lambda backend: calls.append(backend)
+        self.addCleanup(setattr, PostgresLoxBackend, "ensure_schema", original)
+        # a backend of its own, since the pool settings differ, but on a DSN we have already checked
+        other = Lox("everythingbagel", config=dict(self.config, postgres_pool_max_connections=3))
+        self.assertIsNot(other.backend, self.lox.backend)
+        self.assertEqual(calls, [])
+        other.backend.close()
+
+    def test_pool__concurrent_acquire(self):
+        # more threads than pooled connections, all sharing one Lox
+        config = dict(self.config, postgres_pool_max_connections=2)
+        shared_lox = Lox("everythingbagel", config=config)
+        errors = []
+
+        def worker(lock_id):
+            try:
+                shared_lox.backend.release(shared_lox.backend.acquire(shared_lox.name, lock_id))
+            except BaseException as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        shared_lox.backend.close()
+        self.assertEqual(errors, [])
+
+    def test_wait_for_release__more_waiters_than_connections(self):
+        # waiters don't hold pooled connections, so the release they wait for still gets one
+        config = dict(self.config, postgres_pool_max_connections=2)
+        shared_lox = Lox("everythingbagel", config=config)
+        self.addCleanup(shared_lox.backend.close)
+        backend = shared_lox.backend
+        held = backend.acquire(shared_lox.name, 1)
+        errors = []
+        woken = []
+
+        def waiter():
+            try:
+                backend.wait_for_release(shared_lox.name, 1, 10)
+                woken.append(time.time())
+            except BaseException as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=waiter) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.5)
+        released = time.time()
+        backend.release(held)
+        for thread in threads:
+            thread.join()
+        for error in errors:
+            raise error
+        self.assertEqual(len(woken), 6)
+        self.assertLess(max(woken) - released, 5)
+
+    def test_pool__discards_broken_connection(self):
+        connection = self.lox.backend.checkout()
+        connection.close()
+        self.lox.backend.checkin(connection)
+        # the next checkout must still work
+        lock = self.lox.acquire(1)
+        self.assertEqual(lock.state, STATE_ACQUIRED)
+
+    def test_pool__bad_config(self):
+        bad_lox = Lox(config=dict(self.config, postgres_pool_min_connections=3, postgres_pool_max_connections=2))
+        # connecting is lazy
+        with self.assertRaises(BackendConfigException):
+            bad_lox.acquire(1)
 
     def test_acquire__expiration(self):
         lock = self.lox.acquire(expires_seconds=0.5)
 
-    def test_acquire__expiration__check_state(self):
-        lock = self.lox.acquire(expires_seconds=1)
+    def test_acquire__expiration__takeover(self):
+        lock = self.lox.acquire(1, expires_seconds=1)
         self.assertEqual(lock.state, STATE_ACQUIRED)
-        time.sleep(1.5)
-        self.assertEqual(lock.state, STATE_EXPIRED)
+        other = Lox("everythingbagel", config=self.config)
+        with self.assertRaises(LockInUseException):
+            other.acquire(1)
+        # the holder "crashed": nobody releases it, but it is free once it expires
+        time.sleep(1.2)
+        other_lock = other.acquire(1)
+        self.assertEqual(other_lock.state, STATE_ACQUIRED)
+        # the old holder releasing late must not free the new holder's lock
+        lock.release()
+        self.assertTrue(self.__row_exists(other_lock.key))
+        other.release(1)
+        self.assertFalse(self.__row_exists(other_lock.key))
+
+    def test_prepared_statements__off(self):
+        config = dict(self.config, postgres_prepared_statements=False)
+        unprepared = Lox(self.lox.name, config=config)
+        unprepared.acquire_many([1, 2], expires_seconds=5)
+        with self.assertRaises(LockInUseException):
+            Lox(self.lox.name, config=self.config).acquire(2)
+        unprepared.release_many([1, 2])
+        self.lox.release(self.lox.acquire(2).id)
+
+    def test_prepared_statements__lost(self):
+        # one connection, so the next acquire is sure to get the one we tamper with
+        config = dict(self.config, postgres_pool_max_connections=1)
+        backend = Lox(self.lox.name, config=config).backend
+        connection = backend.checkout()
+        connection.prepared.add("lox_acquire_keys")
+        backend.checkin(connection)
+        with self.assertRaises(psycopg2.Error):
+            Lox(self.lox.name, config=config).acquire(1)
+        # it doesn't know what it has prepared any more, so starts over
+        lox = Lox(self.lox.name, config=config)
+        lox.release(lox.acquire(1).id)
+
+    def test_table__options(self):
+        config = dict(self.config, postgres_schema="lox_test", postgres_table="fastlox", postgres_unlogged=True,
+                      postgres_synchronous_commit=False, postgres_storage_parameters={"fillfactor": 50})
+        self.__execute("""DROP SCHEMA IF EXISTS lox_test CASCADE;""")
+        self.addCleanup(self.__execute, """DROP SCHEMA IF EXISTS lox_test CASCADE;""")
+        fast_lox = Lox(self.lox.name, config=config)
+        lock = fast_lox.acquire(1, expires_seconds=5)
+        self.assertFalse(self.__row_exists(lock.key))
+        with self.lox.backend.cursor() as cursor:
+            cursor.execute("""
+                SELECT c.relname, c.relpersistence, c.reloptions FROM pg_catalog.pg_class c
+                JOIN   pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+                WHERE  n.nspname = 'lox_test' AND c.relkind = 'r' ORDER BY 1;
+            """)
+            self.assertEqual(cursor.fetchall(), [("fastlox", "u", ["fillfactor=50"]),
+                                                 ("fastlox_queue", "u", ["fillfactor=50"]),
+                                                 ("fastlox_shared", "u", ["fillfactor=50"])])
+            cursor.execute("""SELECT EXISTS (SELECT 1 FROM lox_test.fastlox WHERE key = %s);""", (lock.key,))
+            self.assertTrue(cursor.fetchone()[0])
+        with self.assertRaises(LockInUseException):
+            Lox(self.lox.name, config=config).acquire(1)
+        fast_lox.release(1)
+        fast_lox.backend.close()
+
+    def test_table__bad_name(self):
+        with self.assertRaises(BackendConfigException):
+            Lox(config=dict(self.config, postgres_table="lox; DROP TABLE lox")).acquire(1)
+
+    def test_sweep_expired(self):
+        lock = self.lox.acquire(1, expires_seconds=0.5)
+        lock2 = self.lox.acquire(2)
+        time.sleep(0.7)
+        self.assertGreaterEqual(self.lox.backend.sweep_expired(), 1)
+        self.assertFalse(self.__row_exists(lock.key))
+        self.assertTrue(self.__row_exists(lock2.key))
+
+    def test_sweeper(self):
+        sweeping_lox = Lox("everythingbagel", config=dict(self.config, postgres_sweep_interval_seconds=0.2))
+        self.addCleanup(sweeping_lox.backend.close)
+        lock = self.lox.acquire(1, expires_seconds=0.2)
+        time.sleep(0.8)
+        self.assertFalse(self.__row_exists(lock.key))
+
+    def __row_exists(self, key):
+        with self.lox.backend.cursor() as cursor:
+            cursor.execute("""SELECT EXISTS (SELECT 1 FROM lox WHERE key = %s);""", (key,))
+            return cursor.fetchone()[0]
 
 if __name__ == '__main__':
     unittest.main()
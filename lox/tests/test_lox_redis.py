@@ -1,13 +1,16 @@
 from __future__ import unicode_literals
 
+import threading
 import unittest
 import time
 
 from lox.lox import Lox
 
-from test_lox_base import LoxTestsBaseMixin
+from test_lox_base import LoxTestsBaseMixin, SharedLocksTestsMixin, SemaphoreTestsMixin, \
+    FairLocksTestsMixin
 
-class LoxRedisTests(LoxTestsBaseMixin, unittest.TestCase):
+class LoxRedisTests(LoxTestsBaseMixin, SharedLocksTestsMixin, SemaphoreTestsMixin, FairLocksTestsMixin,
+                    unittest.TestCase):
 
     def setUp(self):
         self.config = {"backend": {"redis": "redis://:@localhost:6379/0"}}
@@ -26,11 +29,48 @@ class LoxRedisTests(LoxTestsBaseMixin, unittest.TestCase):
     def test_acquire__timeout(self):
         lock = self.lox.acquire(expires_seconds=0.5)
         # make sure the underlying key exists
-        self.assertTrue(lock._lock.provider_lock.redis.exists(lock.key))
+        self.assertTrue(self.lox.backend.connection.exists(lock.key))
         # wait long enough for the lock to expire
         time.sleep(0.7)
         # make sure redis removed the lock
-        self.assertFalse(lock._lock.provider_lock.redis.exists(lock.key))
+        self.assertFalse(self.lox.backend.connection.exists(lock.key))
+
+    def test_scripts__flushed(self):
+        # the server forgetting our scripts (a restart, a failover) must not fail any calls
+        self.lox.backend.connection.script_flush()
+        self.lox.acquire_many(["a", "b"])
+        self.lox.release_many(["a", "b"])
+        self.assertEqual(self.lox.locks, {})
+
+
+class LoxRedisPipeliningTests(LoxRedisTests):
+
+    def setUp(self):
+        self.config = {"backend": {"redis": "redis://:@localhost:6379/0"}, "redis_pipelining": True}
+        self.lox = Lox("poppyseedbagel", config=self.config)
+        self.lox.clear_all()
+
+    def test_pipelining__threads(self):
+        results, errors = [], []
+
+        def worker(i):
+            lox = Lox("poppyseedbagel", config=self.config)
+            try:
+                for j in range(20):
+                    lox.acquire("{}-{}".format(i, j), expires_seconds=5)
+                    lox.release("{}-{}".format(i, j))
+            except Exception as ex:
+                errors.append(ex)
+            results.append(i)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        self.assertEqual(sorted(results), list(range(8)))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,111 @@
+from __future__ import unicode_literals
+
+import unittest
+import time
+from datetime import datetime
+
+import pytz
+from redis.exceptions import ConnectionError
+
+from lox.lox import Lox
+from lox.backends.redlock_lox_backend import RedlockLoxBackend
+from lox.core.errors import *
+
+from test_lox_base import LoxTestsBaseMixin
+
+# three local redis-server processes
+NODES = ["redis://:@localhost:6379/0", "redis://:@localhost:6380/0", "redis://:@localhost:6381/0"]
+
+class LoxRedlockTests(LoxTestsBaseMixin, unittest.TestCase):
+
+    notifies_releases = False
+
+    def setUp(self):
+        self.config = {"backend": {"redis_quorum": NODES}}
+        self.lox = Lox("bialy", config=self.config)
+        self.lox.clear_all()
+
+    def tearDown(self):
+        self.lox.clear_all()
+
+    def test_init(self):
+        self.assertEqual(self.lox.name, "bialy")
+        self.assertEqual(self.lox.config, self.config)
+        self.assertEqual(self.lox.backend.quorum, 2)
+
+    def test_acquire__validity(self):
+        lock = self.lox.acquire(1, expires_seconds=1)
+        remaining = (lock._lock.expire_ts - datetime.now(tz=pytz.UTC)).total_seconds()
+        # a little less than asked for, to allow for the round trip and clock drift
+        self.assertLess(remaining, 1)
+        self.assertGreater(remaining, 0.5)
+        for node in self.lox.backend.nodes:
+            self.assertTrue(node.exists(lock.key))
+        time.sleep(1.2)
+        for node in self.lox.backend.nodes:
+            self.assertFalse(node.exists(lock.key))
+
+    def test_acquire__majority(self):
+        key = self.lox.backend.key(self.lox.name, 1)
+        # someone else holds it on one node: that's still a majority for us
+        self.lox.backend.nodes[0].set(key, "someone else")
+        lock = self.lox.acquire(1)
+        self.lox.release(1)
+        self.assertEqual(self.lox.backend.nodes[0].get(key), b"someone else")
+        # on two of them it isn't, and whatever we did get is given back
+        self.lox.backend.nodes[1].set(key, "someone else")
+        with self.assertRaises(LockInUseException):
+            self.lox.acquire(1)
+        self.assertFalse(self.lox.backend.nodes[2].exists(key))
+        self.lox.backend.nodes[0].delete(key)
+        self.lox.backend.nodes[1].delete(key)
+
+    def test_acquire__node_down(self):
+        down = Lox("bialy", config={"backend": {"redis_quorum": NODES[:2] + ["redis://:@localhost:6399/0"]}})
+        lock = down.acquire(1)
+        down.release(1)
+        # with two of three down there can't be a majority, which is an error rather than contention
+        down = Lox("bialy", config={"backend": {"redis_quorum": NODES[:1] + ["redis://:@localhost:6399/0"] * 2}})
+        with self.assertRaises(ConnectionError):
+            down.acquire(1)
+
+    def test_acquire__slow_node(self):
+        # nodes stood in for by scripts that answer after a delay, so this needs no servers
+        backend = RedlockLoxBackend({"backend": {"redis_quorum": NODES}})
+        backend.connect()
+        self.addCleanup(backend.close)
+
+        def answer(seconds, result):
+            def script(keys, args):
+                time.sleep(seconds)
+                return result
+            return script
+
+        backend.release_many_scripts = [answer(0, 0)] * 3
+        # a majority answering quickly doesn't wait for the slowest node
+        backend.acquire_many_scripts = [answer(0.01, 0), answer(0.01, 0), answer(1.5, 0)]
+        started = time.time()
+        backend.acquire("bialy", 1, expires_seconds=1)
+        self.assertLess(time.time() - started, 0.5)
+        # nor does a majority refusing it
+        backend.acquire_many_scripts = [answer(0.01, 1), answer(0.01, 1), answer(1.5, 0)]
+        started = time.time()
+        with self.assertRaises(LockInUseException):
+            backend.acquire("bialy", 1, expires_seconds=1)
+        self.assertLess(time.time() - started, 0.5)
+        # and a majority that comes too late isn't contention
+        backend.acquire_many_scripts = [answer(0.01, 0), answer(1.2, 0), answer(1.5, 0)]
+        with self.assertRaises(LockValidityException):
+            backend.acquire("bialy", 1, expires_seconds=1)
+
+    def test_extend__lost_on_majority(self):
+        lock = self.lox.acquire(1, expires_seconds=5)
+        self.lox.backend.nodes[0].delete(lock.key)
+        self.lox.extend(1, 5)
+        self.lox.backend.nodes[1].delete(lock.key)
+        with self.assertRaises(LockExpiredException):
+            self.lox.extend(1, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+from __future__ import unicode_literals
+
+import unittest
+
+from lox.core.metrics import Histogram, HistogramCollector
+
+
+class HistogramTests(unittest.TestCase):
+
+    def test_summary(self):
+        histogram = Histogram()
+        for i in range(1, 101):
+            histogram.record(i / 1000.0)
+        summary = histogram.summary()
+        self.assertEqual(summary["count"], 100)
+        self.assertAlmostEqual(summary["sum"], 5.05)
+        self.assertEqual(summary["min"], 0.001)
+        self.assertEqual(summary["max"], 0.1)
+        self.assertAlmostEqual(summary["mean"], 0.0505)
+        # percentiles are bucket upper bounds, so within an eighth or so above the real value
+        self.assertGreaterEqual(summary["p50"], 0.05)
+        self.assertLess(summary["p50"], 0.05 * 1.25)
+        self.assertGreaterEqual(summary["p99"], 0.099)
+        self.assertLessEqual(summary["p99"], 0.1)
+
+    def test_zero_and_empty(self):
+        histogram = Histogram()
+        self.assertIsNone(histogram.percentile(50))
+        histogram.record(0)
+        histogram.record(0)
+        histogram.record(2)
+        self.assertEqual(histogram.percentile(50), 0)
+        self.assertEqual(histogram.percentile(100), 2)
+
+    def test_bucket_bounds(self):
+        for value in (1e-6, 0.003, 0.5, 1, 7, 3600):
+            upper = Histogram.bucket_upper_bound(Histogram.bucket(value))
+            self.assertGreaterEqual(upper, value)
+            self.assertLessEqual(upper, value * 1.25)
+
+
+class HistogramCollectorTests(unittest.TestCase):
+
+    def test_snapshot(self):
+        collector = HistogramCollector()
+        collector.acquired("bagel", 0.01, 2, 0.005)
+        collector.contended("bagel")
+        collector.released("bagel", 1.5)
+        collector.backend_call("bagel", "acquire", 0.002)
+        collector.acquire_failed("onion", 3, 4, 2.9)
+        snapshot = collector.snapshot()
+        self.assertEqual(snapshot["bagel"]["acquired"], 1)
+        self.assertEqual(snapshot["bagel"]["contended"], 1)
+        self.assertEqual(snapshot["bagel"]["hold_seconds"]["max"], 1.5)
+        self.assertEqual(snapshot["bagel"]["acquire_tries"]["sum"], 2)
+        self.assertEqual(snapshot["bagel"]["backend_acquire_seconds"]["count"], 1)
+        self.assertEqual(snapshot["onion"]["acquire_failed"], 1)
+        collector.reset()
+        self.assertEqual(collector.snapshot(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+from __future__ import unicode_literals
+
+import threading
+import unittest
+
+from lox.core.registry import LockRegistry
+
+
+class LockRegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = LockRegistry(stripes=4)
+
+    def test_mapping(self):
+        self.registry[1] = "a"
+        self.registry["two"] = "b"
+        self.assertEqual(self.registry, {1: "a", "two": "b"})
+        self.assertEqual(len(self.registry), 2)
+        self.assertEqual(sorted(self.registry, key=str), [1, "two"])
+        self.assertIn(1, self.registry)
+        del self.registry[1]
+        self.assertNotIn(1, self.registry)
+        with self.assertRaises(KeyError):
+            del self.registry[1]
+        self.assertEqual(self.registry.pop("two"), "b")
+        self.assertEqual(self.registry, {})
+        self.assertFalse(self.registry)
+
+    def test_add(self):
+        self.assertTrue(self.registry.add(1, "a"))
+        self.assertFalse(self.registry.add(1, "b"))
+        self.assertEqual(self.registry[1], "a")
+
+    def test_add_all(self):
+        self.registry[3] = "c"
+        # all or nothing
+        self.assertEqual(self.registry.add_all([(1, "a"), (2, "b"), (3, "x")]), 3)
+        self.assertEqual(self.registry, {3: "c"})
+        self.assertIsNone(self.registry.add_all([(1, "a"), (2, "b")]))
+        self.assertEqual(self.registry, {1: "a", 2: "b", 3: "c"})
+
+    def test_pop_all(self):
+        self.registry.update({1: "a", 2: "b"})
+        with self.assertRaises(KeyError):
+            self.registry.pop_all([1, 5])
+        self.assertEqual(self.registry, {1: "a", 2: "b"})
+        self.assertEqual(self.registry.pop_all([2, 1]), ["b", "a"])
+        self.assertEqual(self.registry, {})
+
+    def test_drain(self):
+        self.registry.update({1: "a", 2: "b"})
+        self.assertEqual(self.registry.drain(), {1: "a", 2: "b"})
+        self.assertEqual(self.registry, {})
+
+    def test_threads(self):
+        # every thread adds and removes IDs of its own, and all of them race for one shared ID
+        winners = []
+
+        def worker(n):
+            for i in range(500):
+                self.assertTrue(self.registry.add((n, i), i))
+                self.assertEqual(self.registry.pop_all([(n, i)]), [i])
+            if self.registry.add("shared", n):
+                winners.append(n)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(winners), 1)
+        self.assertEqual(self.registry, {"shared": winners[0]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+from __future__ import unicode_literals
+
+import itertools
+import time
+import unittest
+
+from lox.core.retry import *
+
+
+class RetryPolicyTests(unittest.TestCase):
+
+    def take(self, policy, n=6):
+        return list(itertools.islice(policy.delays(), n))
+
+    def test_fixed(self):
+        self.assertEqual(self.take(FixedRetryPolicy(0.5)), [0.5] * 6)
+
+    def test_exponential(self):
+        self.assertEqual(self.take(ExponentialRetryPolicy(0.1, max_interval_seconds=1)),
+                         [0.1, 0.2, 0.4, 0.8, 1, 1])
+
+    def test_decorrelated_jitter(self):
+        delays = self.take(DecorrelatedJitterRetryPolicy(0.1, max_interval_seconds=2), 50)
+        for previous, delay in zip([0.1] + delays, delays):
+            self.assertGreaterEqual(delay, 0.1)
+            self.assertLessEqual(delay, min(previous * 3, 2))
+        # they should not all be the same
+        self.assertGreater(len(set(delays)), 1)
+
+    def test_get_retry_policy(self):
+        policy = get_retry_policy({"retry_policy": "exponential", "retry_max_interval_seconds": 3}, 0.2)
+        self.assertIsInstance(policy, ExponentialRetryPolicy)
+        self.assertEqual(policy.interval_seconds, 0.2)
+        self.assertEqual(policy.max_interval_seconds, 3)
+        # default
+        self.assertIsInstance(get_retry_policy({}, 1), FixedRetryPolicy)
+        # pluggable
+        self.assertIsInstance(get_retry_policy({"retry_policy": DecorrelatedJitterRetryPolicy}, 1),
+                              DecorrelatedJitterRetryPolicy)
+
+    def test_get_retry_policy__unknown(self):
+        with self.assertRaises(ValueError):
+            get_retry_policy({"retry_policy": "whenever"}, 1)
+
+
+class RetrierTests(unittest.TestCase):
+
+    def test_num_tries(self):
+        retrier = Retrier(FixedRetryPolicy(0.1), num_tries=3)
+        self.assertEqual(retrier.next_delay(), 0.1)
+        self.assertEqual(retrier.next_delay(), 0.1)
+        self.assertIsNone(retrier.next_delay())
+        self.assertIsNone(retrier.remaining())
+        self.assertFalse(retrier.timed_out)
+
+    def test_deadline(self):
+        retrier = Retrier(FixedRetryPolicy(10), timeout=0.2)
+        # never waits past the deadline
+        delay = retrier.next_delay()
+        self.assertLessEqual(delay, 0.2)
+        time.sleep(delay)
+        self.assertTrue(retrier.timed_out)
+        self.assertEqual(retrier.remaining(), 0)
+        self.assertIsNone(retrier.next_delay())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+from __future__ import unicode_literals
+
+import threading
+import time
+import unittest
+
+from lox.core.scheduler import ExpirationScheduler, get_scheduler
+
+
+class ExpirationSchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = ExpirationScheduler()
+        self.fired = []
+        self.done = threading.Event()
+
+    def fire(self, name):
+        def callback():
+            self.fired.append(name)
+            if len(self.fired) == 3:
+                self.done.set()
+        return callback
+
+    def test_runs_in_due_order(self):
+        self.scheduler.schedule(0.3, self.fire("c"))
+        self.scheduler.schedule(0.1, self.fire("a"))
+        self.scheduler.schedule(0.2, self.fire("b"))
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(self.fired, ["a", "b", "c"])
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_cancel(self):
+        entry = self.scheduler.schedule(0.1, self.fire("cancelled"))
+        self.scheduler.schedule(0.2, self.fire("kept"))
+        self.scheduler.cancel(entry)
+        # cancelling twice is fine
+        self.scheduler.cancel(entry)
+        self.assertEqual(len(self.scheduler), 1)
+        time.sleep(0.4)
+        self.assertEqual(self.fired, ["kept"])
+
+    def test_one_thread_bounded_heap(self):
+        threads_before = threading.active_count()
+        entries = [self.scheduler.schedule(60, self.fire(i)) for i in range(1000)]
+        # one thread, however many expirations are pending
+        self.assertEqual(threading.active_count(), threads_before + 1)
+        for entry in entries:
+            self.scheduler.cancel(entry)
+        self.assertEqual(len(self.scheduler), 0)
+        # cancelled entries don't pile up
+        self.assertLess(len(self.scheduler._heap), 200)
+
+    def test_callback_errors_dont_stop_the_thread(self):
+        def boom():
+            raise ValueError("boom")
+        self.scheduler.schedule(0.05, boom)
+        self.scheduler.schedule(0.1, self.fire("a"))
+        self.scheduler.schedule(0.1, self.fire("b"))
+        self.scheduler.schedule(0.1, self.fire("c"))
+        self.assertTrue(self.done.wait(2))
+
+    def test_get_scheduler(self):
+        self.assertIs(get_scheduler(), get_scheduler())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -44,5 +44,12 @@ setup(
         "pytz>=2015.4",
         "redis>=2.10.3"
     ],
+    extras_require={
+        # lox.aio, python 3 only
+        "aio": [
+            "asyncpg>=0.18",
+            "redis>=4.2",
+        ],
+    },
     zip_safe=False
 )